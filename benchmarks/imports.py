@@ -0,0 +1,99 @@
+"""Benchmark of the import cost of the station modules: import time (`-X importtime`) and memory (max RSS).
+Each module is imported in a fresh interpreter. The import time counts the modules of the package only
+(self time, i.e. excluding Opentrons and the other dependencies) and the memory is compared to the import of Opentrons alone.
+Modules that must not be imported by the protocols (e.g. the REST server dependencies) are reported as violations too.
+Run with `python -m benchmarks.imports` from the repository root: the exit code is 1 if a budget is exceeded"""
+from typing import Dict, List
+import argparse
+import json
+import subprocess
+import sys
+
+
+MODULES = (
+    "covmatic_stations.a.technogenetics",
+    "covmatic_stations.b.technogenetics",
+    "covmatic_stations.c.technogenetics",
+)
+# Budgets for each module: time spent importing the package modules and RSS on top of `import opentrons`
+IMPORT_TIME_BUDGET_MS = 150.
+RSS_BUDGET_MB = 8.
+FORBIDDEN_MODULES = ("cherrypy", "requests")
+BASELINE_MODULE = "opentrons"
+
+_probe = """
+import resource, sys, json
+import {module}
+print(json.dumps({{
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": [m for m in {forbidden!r} if m in sys.modules],
+}}))
+"""
+
+
+def probe(module: str, forbidden=FORBIDDEN_MODULES) -> dict:
+    """Import a module in a new interpreter
+    :returns: the max RSS in kB, the forbidden modules imported and the self and cumulative import times in µs of the package modules"""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _probe.format(module=module, forbidden=tuple(forbidden))],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    if p.returncode:
+        raise RuntimeError("cannot import {}:\n{}".format(module, p.stderr[-2000:]))
+    result = json.loads(p.stdout.strip().splitlines()[-1])
+    times: Dict[str, List[int]] = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = (f.strip() for f in line[len("import time:"):].split("|"))
+        if self_us.isdigit() and name.startswith("covmatic_stations"):
+            times[name] = [int(self_us), int(cumulative_us)]
+    result["times"] = times
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-m', '--modules', type=str, nargs='+', default=MODULES, help='Modules to import')
+    parser.add_argument('--time-budget', metavar='MS', type=float, default=IMPORT_TIME_BUDGET_MS, help='Import time budget of the package modules in ms')
+    parser.add_argument('--rss-budget', metavar='MB', type=float, default=RSS_BUDGET_MB, help='RSS budget on top of the baseline in MB')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Imports of each module (the best one is taken)')
+    parser.add_argument('--top', type=int, default=5, help='Number of the slowest package modules to show')
+    parser.add_argument('-o', '--output', metavar='F', type=str, default=None, help='The file path where to save the results')
+    args = parser.parse_args()
+
+    baseline_kb = min(probe(BASELINE_MODULE, ())["rss_kb"] for _ in range(args.repeat))
+    print("baseline ({}): {:.1f} MB".format(BASELINE_MODULE, baseline_kb / 1024))
+    print("{:<42}{:>12}{:>12}  {}".format("module", "time [ms]", "RSS [MB]", "forbidden imports"))
+    results = []
+    violations = []
+    for module in args.modules:
+        runs = [probe(module) for _ in range(args.repeat)]
+        best = min(runs, key=lambda r: sum(t[0] for t in r["times"].values()))
+        r = {
+            "module": module,
+            "time_ms": sum(t[0] for t in best["times"].values()) / 1000,
+            "rss_mb": (min(r["rss_kb"] for r in runs) - baseline_kb) / 1024,
+            "forbidden": best["modules"],
+            "slowest": sorted(best["times"].items(), key=lambda kv: -kv[1][0])[:args.top],
+        }
+        results.append(r)
+        print("{module:<42}{time_ms:>12.1f}{rss_mb:>12.1f}  {0}".format(", ".join(r["forbidden"]) or "-", **r))
+        for name, (self_us, cumulative_us) in r["slowest"]:
+            print("    {:<38}{:>12.1f}".format(name, self_us / 1000))
+        if r["time_ms"] > args.time_budget:
+            violations.append("{}: import time {:.1f} ms > {:.1f} ms".format(module, r["time_ms"], args.time_budget))
+        if r["rss_mb"] > args.rss_budget:
+            violations.append("{}: RSS {:.1f} MB > {:.1f} MB".format(module, r["rss_mb"], args.rss_budget))
+        if r["forbidden"]:
+            violations.append("{}: imports {}".format(module, ", ".join(r["forbidden"])))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for v in violations:
+        print("budget exceeded - {}".format(v))
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
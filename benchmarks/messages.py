@@ -0,0 +1,62 @@
+"""Benchmark for the message catalogue: loading cost and per-lookup cost, compared to the per-class JSON files and MRO walk.
+Run with `python -m benchmarks.messages` from the repository root"""
+from covmatic_stations import messages
+import json
+import os
+import timeit
+
+
+# Same hierarchy (by name) as StationBTechnogeneticsWashBRemoval
+_names = ["Station", "StationB", "StationBTechnogenetics", "StationBTechnogeneticsShort", "StationBTechnogeneticsWashBRemoval"]
+
+
+def hierarchy() -> type:
+    cls = object
+    for n in _names:
+        cls = type(n, (cls,), {})
+    return cls
+
+
+def legacy_load(classes) -> None:
+    for c in classes:
+        try:
+            with open(os.path.join(messages.msg_folder, '{}.json'.format(c.__name__))) as f:
+                c._messages = json.load(f)
+        except FileNotFoundError:
+            c._messages = {}
+
+
+def legacy_get_message(cls, key: str, lan: str = 'ENG'):
+    for c in cls.__mro__:
+        d = getattr(c, '_messages', {})
+        if key in d:
+            d = d[key]
+            if lan in d:
+                return d[lan]
+    return key
+
+
+def catalogue_load() -> None:
+    messages._raw = None
+    messages._flat.clear()
+    messages.raw()
+
+
+def main(number: int = 100000, load_number: int = 100):
+    cls = hierarchy()
+    # At import time, a file is looked up for every station class
+    classes = [type(n, (), {}) for n in sorted(messages._sources())]
+    key = "refill tips"
+    results = {
+        "load_legacy_ms": 1000 * timeit.timeit(lambda: legacy_load(classes), number=load_number) / load_number,
+        "load_catalogue_ms": 1000 * timeit.timeit(catalogue_load, number=load_number) / load_number,
+    }
+    legacy_load(cls.__mro__[:-1])
+    assert legacy_get_message(cls, key) == messages.get_message(cls, key)
+    results["lookup_legacy_us"] = 1e6 * timeit.timeit(lambda: legacy_get_message(cls, key), number=number) / number
+    results["lookup_catalogue_us"] = 1e6 * timeit.timeit(lambda: messages.get_message(cls, key), number=number) / number
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
@@ -0,0 +1,140 @@
+"""Benchmark for the protocols: simulation cost and run efficiency.
+Every protocol in the `protocols` folder is simulated for a matrix of sample counts with the Opentrons simulator
+(`opentrons.simulate`, the simulation run when a protocol is uploaded), recording its wall time.
+The protocol is also dry-run, recording the wall time of the dry run, the command count, the tips consumed per rack,
+the gantry travel, the number of pauses and the estimated robot time.
+Results are compared to a stored baseline: metrics that grow beyond their threshold are reported as regressions.
+Run with `python -m benchmarks.protocols` from the repository root
+(`--update-baseline` stores the current results as the new baseline)"""
+from covmatic_stations.dryrun import dry_run
+from covmatic_stations.estimator import estimate, TimingModel
+from covmatic_stations.simcache import record
+from typing import Dict, List, Optional, Tuple
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+
+protocols_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocols')
+baseline_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+DEFAULT_SAMPLES = (8, 48, 96)
+# Maximum relative and absolute increase of each metric before it is considered a regression
+THRESHOLDS = {
+    "simulation_ms": (1.0, 200.),
+    "wall_time_ms": (1.0, 20.),
+    "commands": (0., 0.),
+    "tips": (0., 0.),
+    "travel_mm": (0.01, 1.),
+    "pauses": (0., 0.),
+    "estimated_seconds": (0.01, 1.),
+}
+
+
+def load_protocol(filepath: str):
+    """Import a protocol file and return its station"""
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(filepath))[0], filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.station
+
+
+def protocol_filepaths(folder: str = protocols_folder) -> List[str]:
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith('.py')]
+
+
+def measure(cls: type, model: Optional[TimingModel] = None, repeat: int = 3, simulate_repeat: int = 1, **kwargs) -> dict:
+    """Metrics of a simulation and of a dry run of a station
+    (the wall times are the best of `simulate_repeat` simulations and of `repeat` dry runs; no simulation if `simulate_repeat` is 0)"""
+    simulation_time = None
+    for _ in range(max(simulate_repeat, 0)):
+        t = record(cls(**kwargs), "simulator")["seconds"]
+        simulation_time = t if simulation_time is None else min(simulation_time, t)
+    wall_time = float('inf')
+    for _ in range(max(repeat, 1)):
+        t = time.perf_counter()
+        ctx = dry_run(cls, **kwargs)
+        wall_time = min(wall_time, time.perf_counter() - t)
+    summary = ctx.summary()
+    est = estimate(ctx.commands, model)
+    return {
+        "simulation_ms": None if simulation_time is None else 1000 * simulation_time,
+        "wall_time_ms": 1000 * wall_time,
+        "commands": summary["commands"],
+        "tips": sum(summary["tips"].values()),
+        "tips_per_rack": summary["tips"],
+        "travel_mm": est["travel_mm"],
+        "pauses": summary["pauses"],
+        "estimated_seconds": est["total"],
+        "errors": summary["errors"],
+    }
+
+
+def run(samples=DEFAULT_SAMPLES, folder: str = protocols_folder, model_filepath: Optional[str] = None, repeat: int = 3, simulate_repeat: int = 1) -> Dict[str, dict]:
+    """Metrics for each protocol and sample count, keyed by '<protocol>[<num_samples>]'"""
+    model = TimingModel.from_file(model_filepath)
+    results = {}
+    for fp in protocol_filepaths(folder):
+        station = load_protocol(fp)
+        name = os.path.splitext(os.path.basename(fp))[0]
+        for n in samples:
+            kwargs = dict(station._init_kwargs, num_samples=n, tip_track=False)
+            results["{}[{}]".format(name, n)] = measure(type(station), model, repeat, simulate_repeat, **kwargs)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], thresholds: Dict[str, Tuple[float, float]] = THRESHOLDS) -> List[str]:
+    """Regressions of the results with respect to the baseline"""
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for m, (rel, tol) in thresholds.items():
+            old, new = baseline[key].get(m, None), metrics[m]
+            if old is not None and new is not None and new > old * (1 + rel) and new > old + tol:
+                regressions.append("{} {}: {:.6g} -> {:.6g} ({:+.1%})".format(key, m, old, new, (new - old) / old if old else float('inf')))
+        for rack, n in metrics["tips_per_rack"].items():
+            old = baseline[key].get("tips_per_rack", {}).get(rack, None)
+            if old is not None and n > old:
+                regressions.append("{} tips on {}: {} -> {}".format(key, rack, old, n))
+        if metrics["errors"] and not baseline[key].get("errors", []):
+            regressions.append("{} errors: {}".format(key, "; ".join(metrics["errors"])))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--samples', metavar='N', type=int, nargs='+', default=DEFAULT_SAMPLES, help='Sample counts to run each protocol with')
+    parser.add_argument('-o', '--output', metavar='F', type=str, default=None, help='The file path where to save the results (default: print them)')
+    parser.add_argument('-b', '--baseline', metavar='F', type=str, default=baseline_filepath, help='The baseline file path')
+    parser.add_argument('-r', '--repeat', metavar='R', type=int, default=3, help='Dry runs per configuration for the wall time')
+    parser.add_argument('-s', '--simulate-repeat', metavar='S', type=int, default=1, help='Simulations per configuration for the wall time (0 to skip the simulation)')
+    parser.add_argument('-m', '--model', metavar='F', type=str, default=None, help='The timing model file path')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    args = parser.parse_args()
+
+    results = run(args.samples, model_filepath=args.model, repeat=args.repeat, simulate_repeat=args.simulate_repeat)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print("no baseline found in {}: run with --update-baseline to store one".format(args.baseline), file=sys.stderr)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f))
+    for r in regressions:
+        print("REGRESSION {}".format(r), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
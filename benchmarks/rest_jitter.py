@@ -0,0 +1,119 @@
+"""Benchmark of the jitter of the protocol thread while the REST server is being polled,
+with the server in a thread of the protocol process or in a child process (`rest_server_process`).
+The protocol thread runs a periodic loop (sleep, some work, a status update every few iterations)
+and measures how late each iteration wakes up, while client processes poll `/log` as fast as they can.
+Run with `python -m benchmarks.rest_jitter` from the repository root (requires CherryPy)"""
+from covmatic_stations.b.technogenetics import StationBTechnogenetics
+from covmatic_stations.catalogue import DRY_RUN_KWARGS, quiet_logger
+from covmatic_stations.dryrun import DryRunContext
+from covmatic_stations.request import StationRESTServerProcess, StationRESTServerThread
+import argparse
+import json
+import multiprocessing
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+MODES = ("none", "thread", "process")
+
+
+def poll(url: str, seconds: float, threads: int, counts):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def client(_) -> tuple:
+        n = errors = 0
+        t = time.monotonic() + seconds
+        while time.monotonic() < t:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as r:
+                    r.read()
+                n += 1
+            except (urllib.error.URLError, OSError):
+                errors += 1
+                time.sleep(0.01)
+        return n, errors
+
+    with ThreadPoolExecutor(threads) as pool:
+        counts.put(tuple(map(sum, zip(*pool.map(client, range(threads))))))
+
+
+def measure(mode: str, seconds: float, period: float, clients: int, threads: int, port: int) -> dict:
+    s = StationBTechnogenetics(logger=quiet_logger(), **DRY_RUN_KWARGS)
+    s._ctx = DryRunContext()
+    server = None
+    if mode != "none":
+        s._status_publisher.enabled = True
+        config = {"global": {"server.socket_host": "127.0.0.1", "server.socket_port": port, "engine.autoreload.on": False, "log.screen": False}}
+        server = (StationRESTServerProcess if mode == "process" else StationRESTServerThread)(s._ctx, station=s, config=config)
+        s._request = server
+        server.start()
+        time.sleep(2)
+    mp = multiprocessing.get_context("spawn")
+    counts = mp.Queue()
+    pollers = [mp.Process(target=poll, args=("http://127.0.0.1:{}/log".format(port), seconds, threads, counts)) for _ in range(clients if server else 0)]
+    for p in pollers:
+        p.start()
+    lateness = []
+    i = 0
+    t_end = time.monotonic() + seconds
+    expected = time.monotonic() + period
+    while time.monotonic() < t_end:
+        time.sleep(max(0., expected - time.monotonic()))
+        lateness.append(time.monotonic() - expected)
+        sum(j * j for j in range(2000))
+        i += 1
+        if i % 10 == 0:
+            s.msg_format("num samples", i)
+        expected += period
+    polls = [counts.get() for _ in pollers]
+    requests = sum(n for n, _ in polls)
+    errors = sum(e for _, e in polls)
+    for p in pollers:
+        p.join()
+    if server is not None:
+        server.join(2)
+    lateness.sort()
+    return {
+        "mode": mode,
+        "iterations": len(lateness),
+        "requests": requests,
+        "errors": errors,
+        "mean_ms": 1000 * statistics.mean(lateness),
+        "p50_ms": 1000 * lateness[len(lateness) // 2],
+        "p99_ms": 1000 * lateness[int(len(lateness) * 0.99)],
+        "max_ms": 1000 * lateness[-1],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-m', '--modes', type=str, nargs='+', choices=MODES, default=MODES, help='Server modes')
+    parser.add_argument('-s', '--seconds', type=float, default=10, help='Duration of each measurement')
+    parser.add_argument('-p', '--period', type=float, default=0.01, help='Period of the protocol loop in seconds')
+    parser.add_argument('-c', '--clients', type=int, default=2, help='Number of client processes')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of threads per client process')
+    parser.add_argument('--port', type=int, default=8089, help='Port of the server')
+    parser.add_argument('-o', '--output', metavar='F', type=str, default=None, help='The file path where to save the results')
+    args = parser.parse_args()
+
+    results = []
+    print("{:<10}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}".format("mode", "iterations", "requests", "errors", "mean [ms]", "p50 [ms]", "p99 [ms]", "max [ms]"))
+    for mode in args.modes:
+        r = measure(mode, args.seconds, args.period, args.clients, args.threads, args.port)
+        results.append(r)
+        print("{mode:<10}{iterations:>12}{requests:>12}{errors:>12}{mean_ms:>12.3f}{p50_ms:>12.3f}{p99_ms:>12.3f}{max_ms:>12.3f}".format(**r))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    # Without successful polls the server is not loaded, and the comparison is meaningless
+    failed = [r["mode"] for r in results if r["mode"] != "none" and (r["requests"] == 0 or r["errors"] > 0)]
+    if failed:
+        print("polls failed in mode(s): {}".format(", ".join(failed)), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
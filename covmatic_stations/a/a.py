@@ -7,7 +7,9 @@ import logging
 from typing import Optional, Tuple
 
 
-class StationA(Station):    
+class StationA(Station):
+    _checkpoint_attrs = ("_lysis_tube_volume",)
+    
     def __init__(
         self,
         air_gap_dest_multi: float = 5,
@@ -264,6 +266,16 @@ class StationA(Station):
         self._lysis_tube.fill(self.initlial_volume_lys)
         self.logger.info(self.msg_format("lysis geometry", math.ceil(self._lysis_tube.volume), self._lysis_tube.height))
     
+    @property
+    def _lysis_tube_volume(self) -> Optional[float]:
+        lysis_tube = getattr(self, "_lysis_tube", None)
+        return None if lysis_tube is None else lysis_tube.volume
+    
+    @_lysis_tube_volume.setter
+    def _lysis_tube_volume(self, value: Optional[float]):
+        if value is not None:
+            self._lysis_tube.volume = value
+    
     def transfer_sample(self, source, dest):
         self.logger.debug("transferring from {} to {}".format(source, dest))
         self.pick_up(self._p_main)
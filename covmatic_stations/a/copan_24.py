@@ -6,12 +6,16 @@ This file can be
     This file acts as a test protocol for the custom labware.
  - executed with python:  e.g. `python -m covmatic_stations.a.copan_24`.
     This script generates the json file for the custom labware"""
+from covmatic_stations.labware_cache import default_cache
 import json
 from collections import OrderedDict
+from functools import lru_cache
 from itertools import product, chain
-from typing import List, Tuple
-from opentrons_shared_data.labware.dev_types import LabwareDefinition
-from opentrons.protocol_api import ProtocolContext
+from typing import List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from opentrons_shared_data.labware.dev_types import LabwareDefinition
+    from opentrons.protocol_api import ProtocolContext
 
 
 class JsonProperty(property):
@@ -29,6 +33,15 @@ class JsonProperty(property):
 json_property = JsonProperty
 
 
+@lru_cache(maxsize=None)
+def _json_properties(cls: type) -> Tuple[str, ...]:
+    """Names of the JSON properties of the class, in definition order"""
+    return tuple(sorted(
+        filter(lambda a: isinstance(getattr(cls, a, None), json_property), dir(cls)),
+        key=lambda a: int(getattr(cls, a, 0))
+    ))
+
+
 class Copan24Specs:
     def __init__(self,
                  nrows: int = 4,
@@ -144,18 +157,17 @@ class Copan24Specs:
         }
     
     def toJSON(self) -> dict:
-        return OrderedDict((k, getattr(self, k)) for k in sorted(
-            filter(lambda a: isinstance(getattr(type(self), a, None), json_property), dir(self)),
-            key=lambda a: int(getattr(type(self), a, 0))
-        ))
+        return OrderedDict((k, getattr(self, k)) for k in _json_properties(type(self)))
     
-    def labware_definition(self) -> LabwareDefinition:
-        return LabwareDefinition(self.toJSON())
+    def labware_definition(self, cache: bool = True) -> 'LabwareDefinition':
+        """The labware definition
+        :param cache: get it from the labware definition cache (shared: it must not be modified)"""
+        return default_cache.specs_definition(self) if cache else dict(self.toJSON())
     
     def __str__(self) -> str:
         return json.dumps(self.toJSON(), indent=4).replace(r"\u00b5", "\u00b5")
     
-    def run_test(self, ctx: ProtocolContext):
+    def run_test(self, ctx: 'ProtocolContext'):
         """Test protocol"""
         ctx.comment("Test the custom '{}' rack".format(self.metadata["displayName"]))
         
@@ -174,7 +186,7 @@ class Copan24Specs:
         p1000.drop_tip()
         
 
-def run(ctx: ProtocolContext):
+def run(ctx: 'ProtocolContext'):
     Copan24Specs().run_test(ctx)
 
 
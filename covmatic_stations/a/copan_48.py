@@ -7,12 +7,14 @@ This file can be
  - executed with python:  e.g. `python -m covmatic_stations.a.copan_48`.
     This script generates the json file for the custom labware"""
 from covmatic_stations.a.copan_24 import Copan24Specs, json_property
-from opentrons.protocol_api import ProtocolContext
-from typing import Tuple
+from covmatic_stations.registry import LayeredJsonRegistry
+from typing import Tuple, TYPE_CHECKING
 import inspect
 import copy
 import os
-import json
+
+if TYPE_CHECKING:
+    from opentrons.protocol_api import ProtocolContext
 
 
 _a1_offset = (27.5, 12)
@@ -72,15 +74,27 @@ class StaggeredCopan48SpecsCorrected(StaggeredCopan48Specs):
 
 copan_48_correction_env_key = "OT_COPAN_48_CORRECT"
 copan_48_correction_file = os.path.join(os.path.dirname(__file__), "copan_48_correction.json")
+copan_48_correction_registry = LayeredJsonRegistry(copan_48_correction_file, copan_48_correction_env_key)
 copan_48_correction_file = os.environ.get(copan_48_correction_env_key, copan_48_correction_file)
-with open(copan_48_correction_file, "r") as f:
-    copan_48_correction = json.load(f)
 
 
-copan_48_corrected_specs = StaggeredCopan48SpecsCorrected(**copan_48_correction)
+def _corrected() -> Tuple[dict, StaggeredCopan48SpecsCorrected]:
+    return copan_48_correction_registry.derived("specs", lambda layers: (
+        copan_48_correction_registry.merged(),
+        StaggeredCopan48SpecsCorrected(**copan_48_correction_registry.merged()),
+    ))
+
+
+def __getattr__(name: str):
+    # The correction is read when first needed (and again if its files change), not at import
+    if name == "copan_48_correction":
+        return dict(_corrected()[0])
+    if name == "copan_48_corrected_specs":
+        return _corrected()[1]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
-def run(ctx: ProtocolContext):
+def run(ctx: 'ProtocolContext'):
     StaggeredCopan48Specs().run_test(ctx)
 
 
@@ -1,5 +1,5 @@
 from .a import StationA
-import json
+from ..labware_cache import load_definition
 import os
 
 
@@ -31,8 +31,7 @@ class StationAP1000(StationA):
     def _load_source_racks(self):
         if self.jupyter:
             # If it is executed in python, the definition must be loaded from JSON
-            with open(self._source_racks_definition_filepath) as labware_file:
-                labware_def = json.load(labware_file)
+            labware_def = load_definition(self._source_racks_definition_filepath)
             self._source_racks = [
                 self._ctx.load_labware_from_definition(
                     labware_def, slot,
@@ -5,6 +5,8 @@ import math
 
 # Mixin allows for finer control over the mro
 class StationAReloadMixin(metaclass=StationMeta):
+    _checkpoint_attrs = ("_done_samples",)
+    
     @property
     def max_samples_per_set(self) -> int:
         return len(self._sources)
@@ -217,7 +217,7 @@ class StationB(Station):
         self._magdeck = self._ctx.load_module('Magnetic Module Gen2', '4')
         self._magdeck.disengage()
         if (self._magheight_load):
-            self._magheight = magnets.height.by_serial.get(self._magdeck._module._driver.get_device_info()['serial'], self._magheight)
+            self._magheight = magnets.registry.get(self._magdeck._module._driver.get_device_info()['serial'], by="serial", field="height", default=self._magheight)
     
     @labware_loader(3, "_magplate")
     def load_magplate(self):
@@ -1,23 +1,22 @@
-import json
+"""Magnet settings of the magnetic modules, by serial or by station.
+The packaged `magnet_heights.json` can be replaced by a custom file set in `OT_MAGNET_JSON`.
+For compatibility, fields can also be read as module attributes, e.g. `magnets.height.by_serial[serial]`"""
+from ..registry import RecordRegistry
 import os
-from collections import namedtuple
 
 
 _env_key = "OT_MAGNET_JSON"
-_keys = ["serial", "station", "height"]
-_getter_c = namedtuple("getter", list(map("by_{}".format, _keys)))
+_keys = ["serial", "station"]
+_indexes = ["height"]
+registry = RecordRegistry(os.path.join(os.path.dirname(__file__), "magnet_heights.json"), _env_key, _keys, _indexes)
 
 
 def __getattr__(name: str):
     if name == "specs":
-        fp = os.environ.get(_env_key, os.path.join(os.path.split(__file__)[0], "magnet_heights.json"))
-        with open(fp, "r") as f:
-            j = json.load(f)
-        return j
-    
-    if name in _keys:
-        specs = __getattr__("specs")
-        return _getter_c(**{"by_{}".format(k): {s[k]: s[name] for s in specs} for k in _keys})
+        return registry.specs
+    if name in _keys or name in _indexes:
+        return registry.getter(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 # Copyright (c) 2020 Covmatic.
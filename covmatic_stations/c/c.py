@@ -8,6 +8,7 @@ from typing import Optional, Tuple
 
 class StationC(Station):
     _protocol_description = "station C protocol"
+    _checkpoint_attrs = ("_remaining_samples", "_samples_this_cycle")
     
     def __init__(
         self,
@@ -0,0 +1,102 @@
+from .utils import command_types
+from typing import Dict, List, Optional, Tuple
+import copy
+import json
+import logging
+
+
+# Overrides for a dry run without side effects (files, servers, lights)
+DRY_RUN_KWARGS = dict(
+    dummy_lights=True,
+    resume=False,
+    simulation_log_file=False,
+    simulation_log_lws=False,
+    start_at=None,
+    tip_track=False,
+    wait_first_log=False,
+)
+DEFAULT_METADATA = {'apiLevel': '2.3'}
+
+
+_cache: Dict[Tuple[type, str], List[dict]] = {}
+
+
+def quiet_logger() -> logging.getLoggerClass():
+    """Logger for the stations of dry runs, not propagated to the root logger"""
+    logger = logging.getLogger("covmatic_stations.catalogue")
+    logger.propagate = False
+    return logger
+
+
+class StageRecorder:
+    """Accumulates the commands, tips and volumes of each stage of a station"""
+    def __init__(self, station: 'Station'):
+        self._station = station
+        self.stages: List[dict] = [self._entry(0, None)]
+        station._stage_listeners.append(self.on_stage)
+
+    @staticmethod
+    def _entry(index: int, name: Optional[str]) -> dict:
+        return {"index": index, "name": name, "commands": 0, "tips": 0, "aspirated": 0., "dispensed": 0.}
+
+    def on_stage(self, index: int, name: str):
+        self.stages.append(self._entry(index, name))
+
+    def __call__(self, record: dict):
+        if record.get('$') != 'before':
+            return
+        entry = self.stages[-1]
+        entry["commands"] += 1
+        name = record.get('name')
+        if name == command_types.PICK_UP_TIP:
+            entry["tips"] += 1
+        elif name == command_types.ASPIRATE:
+            entry["aspirated"] += record.get('payload', {}).get('volume', 0) or 0
+        elif name == command_types.DISPENSE:
+            entry["dispensed"] += record.get('payload', {}).get('volume', 0) or 0
+
+    @property
+    def catalogue(self) -> List[dict]:
+        # Commands issued before the first stage (setup) are only kept if any
+        return self.stages if self.stages[0]["commands"] else self.stages[1:]
+
+
+def cache_key(cls: type, kwargs: dict) -> Tuple[type, str]:
+    return cls, json.dumps(kwargs, sort_keys=True, default=str)
+
+
+def stage_catalogue(cls: type, simulator: bool = False, **kwargs) -> List[dict]:
+    """Ordered list of the stages that a station executes with the given configuration.
+    Each stage reports its name, its index and the commands, tips and volumes it involves.
+    Results are cached per class and keyword arguments. The dry run always logs to a quiet logger
+    :param cls: the station class
+    :param simulator: use the Opentrons simulator instead of the dry-run engine
+    :param kwargs: keyword arguments for the station constructor"""
+    kwargs.pop("logger", None)
+    key = cache_key(cls, dict(kwargs, _simulator=simulator))
+    if key not in _cache:
+        kw = dict(kwargs, **DRY_RUN_KWARGS)
+        kw["logger"] = quiet_logger()
+        kw["metadata"] = kw.get("metadata", None) or DEFAULT_METADATA
+        station = cls(**kw)
+        if simulator:
+            from opentrons import simulate
+            ctx = simulate.get_protocol_api(station.metadata["apiLevel"])
+        else:
+            from .dryrun import DryRunContext
+            ctx = DryRunContext(station.metadata["apiLevel"])
+            station._stage_listeners.append(lambda index, stage: setattr(ctx, "stage", stage))
+        recorder = StageRecorder(station)
+        unsubscribe = ctx.broker.subscribe(command_types.COMMAND, recorder)
+        try:
+            station.run(ctx)
+        finally:
+            unsubscribe()
+        _cache[key] = recorder.catalogue
+    return copy.deepcopy(_cache[key])
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,90 @@
+"""Run control: a global speed multiplier for the gantry and the flow rates of the pipettes.
+The multiplier is applied to the pipette of each command just before it is executed (from the command broker),
+so it takes effect at the next command and survives the flow rates set by the protocol along the way:
+a value that differs from the last one applied is taken as the new base value to scale,
+unless it is a scaled value read back by the protocol (e.g. to restore it later)."""
+from threading import Lock
+from typing import Dict, Tuple
+
+
+MIN_SPEED_FACTOR = 0.1
+MAX_SPEED_FACTOR = 2.0
+FLOW_RATES = ("aspirate", "dispense", "blow_out")
+
+
+class SpeedControl:
+    def __init__(self, factor: float = 1.):
+        """
+        :param factor: initial speed multiplier
+        """
+        self._lock = Lock()
+        self._factor = 1.
+        self.factor = factor
+        # Values set by the protocol and values applied, for each pipette
+        self._base: Dict[int, Dict[str, float]] = {}
+        self._applied: Dict[int, Tuple[float, Dict[str, float]]] = {}
+        # Base values of the scaled values applied, for each pipette and speed
+        self._unscaled: Dict[int, Dict[str, Dict[float, float]]] = {}
+
+    @property
+    def factor(self) -> float:
+        return self._factor
+
+    @factor.setter
+    def factor(self, value: float):
+        value = float(value)
+        if not MIN_SPEED_FACTOR <= value <= MAX_SPEED_FACTOR:
+            raise ValueError("speed factor must be between {} and {}: {}".format(MIN_SPEED_FACTOR, MAX_SPEED_FACTOR, value))
+        with self._lock:
+            self._factor = value
+
+    @staticmethod
+    def _read(pip) -> Dict[str, float]:
+        values = {a: getattr(pip.flow_rate, a) for a in FLOW_RATES}
+        values["default_speed"] = pip.default_speed
+        return values
+
+    @staticmethod
+    def _write(pip, values: Dict[str, float]):
+        for a in FLOW_RATES:
+            setattr(pip.flow_rate, a, values[a])
+        pip.default_speed = values["default_speed"]
+
+    def apply(self, pip):
+        """Scale the speeds of the pipette by the current factor"""
+        key = id(pip)
+        with self._lock:
+            factor = self._factor
+        entry = self._applied.get(key, None)
+        if entry is None and factor == 1:
+            return
+        current = self._read(pip)
+        if entry is None:
+            base = self._base[key] = current
+        else:
+            applied_factor, applied = entry
+            if factor == applied_factor and current == applied:
+                return
+            base = self._base[key]
+            unscaled = self._unscaled[key]
+            base.update((k, unscaled[k].get(v, v)) for k, v in current.items() if v != applied[k])
+        scaled = {k: v * factor for k, v in base.items()}
+        self._write(pip, scaled)
+        for k, v in scaled.items():
+            self._unscaled.setdefault(key, {}).setdefault(k, {})[v] = base[k]
+        if factor == 1:
+            del self._applied[key]
+        else:
+            self._applied[key] = (factor, scaled)
+
+    def __call__(self, record: dict):
+        if record.get('$') == 'before':
+            pip = record.get('payload', {}).get('instrument', None)
+            if pip is not None and hasattr(pip, 'flow_rate'):
+                self.apply(pip)
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
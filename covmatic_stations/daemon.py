@@ -0,0 +1,205 @@
+"""Station host: a long-lived process that runs stations back to back.
+The REST server, the message catalogue, the imported station modules and their stage catalogues stay resident
+between runs, so consecutive runs do not pay the cold start. Runs are requested over a local (Unix) socket. E.g.
+
+    python -m covmatic_stations.daemon serve --preload covmatic_stations.b.technogenetics.StationBTechnogenetics
+    python -m covmatic_stations.daemon run covmatic_stations.b.technogenetics.StationBTechnogenetics -k '{"num_samples": 48}'
+
+Requests and responses are JSON lines: a run request gets a 'started' line and then a 'finished' line
+with the outcome, the run time and the time to the first command."""
+from . import messages
+from .matrix import load_class
+from .request import DEFAULT_REST_KWARGS, StationRESTServerThread
+from .utils import command_types
+from threading import Lock
+from typing import Iterable, Optional
+import argparse
+import json
+import logging
+import os
+import socketserver
+import sys
+import time
+import traceback
+
+
+default_socket = os.environ.get("COVMATIC_DAEMON_SOCKET", "/tmp/covmatic_stations.sock")
+
+
+class StationHost:
+    def __init__(self,
+        simulate: bool = False,
+        rest_server_kwargs: dict = DEFAULT_REST_KWARGS,
+        logger: Optional[logging.getLoggerClass()] = None,
+    ):
+        """
+        :param simulate: run the stations on the Opentrons simulator instead of the robot
+        :param rest_server_kwargs: keyword arguments for the REST server
+        :param logger: the logger
+        """
+        self._simulate = simulate
+        self._server = StationRESTServerThread(None, **rest_server_kwargs)
+        self._lock = Lock()
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        self.runs = 0
+
+    def start(self):
+        self._server.start()
+
+    def stop(self):
+        self._server.join(2)
+
+    def preload(self, classes: Iterable[str]):
+        """Import the station classes and build their stage catalogues (for the default arguments)"""
+        messages.raw()
+        for path in classes:
+            t = time.perf_counter()
+            load_class(path).stage_catalogue()
+            self.logger.info("preloaded {} in {:.2f}s".format(path, time.perf_counter() - t))
+
+    def _context(self, api_level: str):
+        if self._simulate:
+            from opentrons import simulate
+            return simulate.get_protocol_api(api_level)
+        from opentrons import execute
+        return execute.get_protocol_api(api_level)
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, class_path: str, kwargs: Optional[dict] = None) -> dict:
+        """Run a station on the resident REST server
+        :param class_path: dotted path of the station class
+        :param kwargs: keyword arguments for the station constructor
+        :returns: outcome, run time and time to the first command"""
+        if not self._lock.acquire(blocking=False):
+            return {"ok": False, "error": "another run is in progress"}
+        t0 = time.perf_counter()
+        result = {"ok": False, "error": None, "first_command_seconds": None}
+
+        def on_command(record: dict):
+            if result["first_command_seconds"] is None:
+                result["first_command_seconds"] = time.perf_counter() - t0
+
+        try:
+            station = load_class(class_path)(**(kwargs or {}))
+            station.attach_server(self._server)
+            ctx = self._context((station.metadata or {}).get("apiLevel", "2.3"))
+            unsubscribe = ctx.broker.subscribe(command_types.COMMAND, on_command)
+            try:
+                station.run(ctx)
+            finally:
+                unsubscribe()
+            result["ok"] = True
+        except Exception as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+            result["traceback"] = traceback.format_exc()
+        finally:
+            self.runs += 1
+            self._lock.release()
+        result["seconds"] = time.perf_counter() - t0
+        return result
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def _reply(self, msg: dict):
+        self.wfile.write((json.dumps(msg) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+        host: StationHost = self.server.host
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self._reply({"event": "error", "error": str(e)})
+                continue
+            if not isinstance(request, dict):
+                self._reply({"event": "error", "error": "the request must be a JSON object"})
+                continue
+            command = request.get("command", "run")
+            if command == "status":
+                self._reply({"event": "status", "busy": host.busy, "runs": host.runs})
+            elif command != "run":
+                self._reply({"event": "error", "error": "unknown command: {}".format(command)})
+            elif "class" not in request:
+                self._reply({"event": "error", "error": "missing station class"})
+            elif host.busy:
+                self._reply({"event": "finished", "ok": False, "error": "another run is in progress"})
+            else:
+                self._reply({"event": "started", "class": request["class"]})
+                self._reply(dict(host.run(request["class"], request.get("kwargs", None)), event="finished"))
+
+
+class StationHostServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, host: StationHost, socket_path: str = default_socket):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super(StationHostServer, self).__init__(socket_path, _RequestHandler)
+        self.host = host
+
+
+def submit(class_path: str, kwargs: Optional[dict] = None, socket_path: str = default_socket, stream=None) -> dict:
+    """Request a run to the station host and wait for it to finish
+    :param class_path: dotted path of the station class
+    :param kwargs: keyword arguments for the station constructor
+    :param socket_path: path of the socket of the host
+    :param stream: stream where to print the replies (optional)
+    :returns: the outcome of the run"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps({"class": class_path, "kwargs": kwargs or {}}) + "\n").encode())
+        with s.makefile("r") as f:
+            for line in f:
+                reply = json.loads(line)
+                if stream is not None:
+                    print(json.dumps({k: v for k, v in reply.items() if k != "traceback"}), file=stream, flush=True)
+                if reply["event"] in ("finished", "error"):
+                    return reply
+    return {"event": "error", "error": "connection closed"}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--socket', metavar='PATH', type=str, default=default_socket, help='Path of the socket')
+    subparsers = parser.add_subparsers(dest='action')
+    serve = subparsers.add_parser('serve', help='Start the station host')
+    serve.add_argument('--simulate', action='store_true', help='Run on the Opentrons simulator')
+    serve.add_argument('--preload', metavar='C', type=str, nargs='*', default=(), help='Dotted paths of the station classes to preload')
+    run = subparsers.add_parser('run', help='Run a station on the host')
+    run.add_argument('station_class', metavar='C', type=str, help='Dotted path of the station class')
+    run.add_argument('-k', '--kwargs', metavar='JSON', type=str, default="{}", help='Keyword arguments for the station')
+    args = parser.parse_args()
+
+    if args.action == 'run':
+        return 0 if submit(args.station_class, json.loads(args.kwargs), args.socket, sys.stdout).get("ok", False) else 1
+    if args.action != 'serve':
+        parser.print_help()
+        return 2
+    host = StationHost(simulate=args.simulate)
+    host.preload(args.preload)
+    host.start()
+    server = StationHostServer(host, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        host.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
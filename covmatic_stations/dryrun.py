@@ -0,0 +1,499 @@
+"""Fast dry-run engine for the stations.
+A lightweight stand-in for the Opentrons ProtocolContext that records commands, volumes, tip usage and positions
+while running the unchanged station `body()`. E.g.
+
+    from covmatic_stations.dryrun import dry_run
+    ctx = dry_run(StationBTechnogenetics, num_samples=96)
+    print(ctx.summary())
+
+Geometry is taken from the Opentrons labware definitions when available (otherwise a generic 96-well plate is assumed)
+and module heights are approximate: positions are meant for estimates, not for checking collisions."""
+from .utils import command_types
+from opentrons.types import Location, Point
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Union
+import logging
+import re
+
+
+# Front-left corner of the OT-2 deck slots in mm
+SLOT_ORIGINS = {
+    1: (0, 0), 2: (132.5, 0), 3: (265, 0),
+    4: (0, 90.5), 5: (132.5, 90.5), 6: (265, 90.5),
+    7: (0, 181), 8: (132.5, 181), 9: (265, 181),
+    10: (0, 271.5), 11: (132.5, 271.5), 12: (265, 271.5),
+}
+# Approximate height of the labware surface on the modules in mm
+MODULE_HEIGHTS = {
+    "temperature": 9.,
+    "magnetic": 4.5,
+}
+# Default flow rates by maximum volume of the pipette in uL/s
+DEFAULT_FLOW_RATES = {
+    20: 7.56,
+    300: 46.43,
+    1000: 137.35,
+}
+TRASH_DEFINITION = {
+    "ordering": [["A1"]],
+    "metadata": {"displayName": "Opentrons Fixed Trash"},
+    "parameters": {"loadName": "opentrons_1_trash_1100ml_fixed", "isTiprack": False},
+    "cornerOffsetFromSlot": {"x": 0, "y": 0, "z": 0},
+    "wells": {"A1": {"x": 82.84, "y": 80, "z": 5.39, "depth": 77, "shape": "rectangular", "xDimension": 107.11, "yDimension": 165.67}},
+}
+
+
+def _quiet_logger() -> logging.getLoggerClass():
+    logger = logging.getLogger("covmatic_stations.dryrun")
+    logger.propagate = False
+    return logger
+
+
+def generic_definition(load_name: str, nrows: int = 8, ncols: int = 12) -> dict:
+    return {
+        "ordering": [["{}{}".format(chr(ord("A") + r), c + 1) for r in range(nrows)] for c in range(ncols)],
+        "metadata": {"displayName": load_name},
+        "parameters": {"loadName": load_name, "isTiprack": "tip" in load_name},
+        "cornerOffsetFromSlot": {"x": 0, "y": 0, "z": 0},
+        "wells": {
+            "{}{}".format(chr(ord("A") + r), c + 1): {"x": 14.38 + 9 * c, "y": 74.24 - 9 * r, "z": 1, "depth": 10, "shape": "circular", "diameter": 5}
+            for r in range(nrows) for c in range(ncols)
+        },
+    }
+
+
+@lru_cache(maxsize=None)
+def load_definition(load_name: str) -> dict:
+    """Opentrons labware definition (or a generic 96-well plate if not found)"""
+    try:
+        from opentrons_shared_data.labware import load_definition as _load
+        return _load(load_name, 1)
+    except Exception:
+        return generic_definition(load_name)
+
+
+def location_well(loc) -> Optional['DryRunWell']:
+    """The well of a location (or the well itself)"""
+    if isinstance(loc, DryRunWell):
+        return loc
+    if isinstance(loc, Location):
+        lw = loc.labware
+        lw = getattr(lw, "object", lw)
+        return lw if isinstance(lw, DryRunWell) else None
+    return None
+
+
+class DryRunWell:
+    def __init__(self, labware: 'DryRunLabware', name: str, spec: dict, origin: Point):
+        self.parent = labware
+        self.well_name = name
+        self.depth = spec.get("depth", 0)
+        self.diameter = spec.get("diameter", spec.get("xDimension", 0))
+        self.max_volume = spec.get("totalLiquidVolume", 0)
+        self._bottom = origin + Point(spec["x"], spec["y"], spec["z"])
+
+    @property
+    def display_name(self) -> str:
+        return "{} of {}".format(self.well_name, self.parent)
+
+    def top(self, z: float = 0.0) -> Location:
+        return Location(self._bottom + Point(0, 0, self.depth + z), self)
+
+    def bottom(self, z: float = 0.0) -> Location:
+        return Location(self._bottom + Point(0, 0, z), self)
+
+    def center(self) -> Location:
+        return Location(self._bottom + Point(0, 0, self.depth / 2), self)
+
+    def __str__(self) -> str:
+        return self.display_name
+
+    __repr__ = __str__
+
+
+class DryRunLabware:
+    def __init__(self, definition: dict, slot: int, label: Optional[str] = None, height: float = 0, parent=None):
+        self._definition = definition
+        self.load_name = definition["parameters"]["loadName"]
+        self.is_tiprack = definition["parameters"].get("isTiprack", False)
+        self.parent = str(slot) if parent is None else parent
+        self._name = "{} on {}".format(label or definition["metadata"]["displayName"], slot)
+        corner = definition.get("cornerOffsetFromSlot", {})
+        origin = Point(SLOT_ORIGINS[slot][0] + corner.get("x", 0), SLOT_ORIGINS[slot][1] + corner.get("y", 0), height + corner.get("z", 0))
+        self._columns = [[DryRunWell(self, w, definition["wells"][w], origin) for w in col] for col in definition["ordering"]]
+        self._wells = OrderedDict((w.well_name, w) for col in self._columns for w in col)
+
+    def wells(self) -> List[DryRunWell]:
+        return list(self._wells.values())
+
+    def columns(self) -> List[List[DryRunWell]]:
+        return [list(c) for c in self._columns]
+
+    def rows(self) -> List[List[DryRunWell]]:
+        return [list(r) for r in zip(*self._columns)] if len(set(map(len, self._columns))) == 1 else self._rows_irregular()
+
+    def _rows_irregular(self) -> List[List[DryRunWell]]:
+        rows = OrderedDict()
+        for w in self._wells.values():
+            rows.setdefault(re.match(r"[A-Z]+", w.well_name).group(0), []).append(w)
+        return [rows[k] for k in sorted(rows)]
+
+    def wells_by_name(self) -> Dict[str, DryRunWell]:
+        return dict(self._wells)
+
+    def __getitem__(self, name: str) -> DryRunWell:
+        return self._wells[name]
+
+    def __str__(self) -> str:
+        return self._name
+
+    __repr__ = __str__
+
+
+class DryRunModule:
+    def __init__(self, ctx: 'DryRunContext', name: str, slot: int):
+        self._ctx = ctx
+        self.name = name
+        self.slot = slot
+        self.kind = "magnetic" if "mag" in name.lower() else "temperature"
+        self.labware = None
+        self.temperature = None
+        self.target = None
+        self.status = "idle"
+        self.height = None
+        self._module = SimpleNamespace(_driver=SimpleNamespace(get_device_info=lambda: {"serial": "dry-run", "model": name}))
+
+    def load_labware(self, name: str, label: Optional[str] = None, *args, **kwargs) -> DryRunLabware:
+        self.labware = DryRunLabware(load_definition(name), self.slot, label, MODULE_HEIGHTS[self.kind], parent=self)
+        return self.labware
+
+    def load_labware_from_definition(self, definition: dict, label: Optional[str] = None) -> DryRunLabware:
+        self.labware = DryRunLabware(definition, self.slot, label, MODULE_HEIGHTS[self.kind], parent=self)
+        return self.labware
+
+    def set_temperature(self, celsius: float):
+        self._ctx.record(command_types.TEMPDECK_SET_TEMP, lambda: "Setting Temperature Module temperature to {} °C".format(celsius), module=self.kind, temperature=celsius, previous=self.temperature)
+        self.temperature = self.target = celsius
+
+    def deactivate(self):
+        self._ctx.record(command_types.TEMPDECK_DEACTIVATE, "Deactivating Temperature Module", module=self.kind)
+        self.target = None
+
+    def engage(self, height: Optional[float] = None, offset: Optional[float] = None, **kwargs):
+        self._ctx.record(command_types.MAGDECK_ENGAGE, "Engaging Magnetic Module", module=self.kind, height=height)
+        self.status = "engaged"
+        self.height = height
+
+    def disengage(self):
+        self._ctx.record(command_types.MAGDECK_DISENGAGE, "Disengaging Magnetic Module", module=self.kind)
+        self.status = "disengaged"
+
+    def __str__(self) -> str:
+        return "{} on {}".format(self.name, self.slot)
+
+
+class FlowRates:
+    def __init__(self, rate: float):
+        self.aspirate = rate
+        self.dispense = rate
+        self.blow_out = rate
+
+
+class DryRunPipette:
+    def __init__(self, ctx: 'DryRunContext', name: str, mount: str, tip_racks: Optional[List[DryRunLabware]] = None):
+        self._ctx = ctx
+        self.name = name
+        self.mount = mount
+        self.tip_racks = tip_racks or []
+        self.channels = 8 if "multi" in name else 1
+        self.max_volume = float(re.match(r"p(\d+)", name).group(1))
+        self.flow_rate = FlowRates(DEFAULT_FLOW_RATES.get(int(self.max_volume), 100))
+        self.default_speed = 400.
+        self.current_volume = 0.
+        self.has_tip = False
+        self._last_well: Optional[DryRunWell] = None
+        self._next_tips = None
+
+    def __str__(self) -> str:
+        return "{} on {} mount".format(self.name, self.mount)
+
+    def _location(self, loc, default: Callable[[DryRunWell], Location]) -> Optional[Location]:
+        if loc is None:
+            return None if self._last_well is None else default(self._last_well)
+        if isinstance(loc, DryRunWell):
+            return default(loc)
+        return loc
+
+    def _move(self, loc: Optional[Location]):
+        if loc is not None:
+            self._last_well = location_well(loc) or self._last_well
+
+    def _record(self, name: str, text: Union[str, Callable[[], str]], loc: Optional[Location] = None, **kwargs):
+        self._move(loc)
+        self._ctx.record(name, text, pipette=self, location=loc, **kwargs)
+
+    def move_to(self, location: Location, *args, **kwargs) -> 'DryRunPipette':
+        self._record(command_types.MOVE_TO, lambda: "Moving to {}".format(location_well(location)), location, speed=kwargs.get("speed", None))
+        return self
+
+    def pick_up_tip(self, location=None, *args, **kwargs) -> 'DryRunPipette':
+        if location is None:
+            if self._next_tips is None:
+                self._next_tips = iter([w for rack in self.tip_racks for w in (rack.rows()[0] if self.channels > 1 else rack.wells())])
+            location = next(self._next_tips, None)
+            if location is None:
+                self._ctx.error("{}: out of tips".format(self))
+                return self
+        if self.has_tip:
+            self._ctx.error("{}: picking up a tip with a tip already attached".format(self))
+        loc = self._location(location, DryRunWell.top)
+        self._record(command_types.PICK_UP_TIP, lambda: "Picking up tip from {}".format(location_well(loc)), loc)
+        self._ctx.tips[str(location_well(loc).parent)] += self.channels
+        self.has_tip = True
+        return self
+
+    def drop_tip(self, location=None, *args, **kwargs) -> 'DryRunPipette':
+        loc = self._location(location, DryRunWell.top) if location is not None else self._ctx.loaded_labwares[12].wells()[0].top()
+        if not self.has_tip:
+            self._ctx.error("{}: dropping a tip without a tip attached".format(self))
+        self._record(command_types.DROP_TIP, lambda: "Dropping tip into {}".format(location_well(loc)), loc)
+        self.has_tip = False
+        self.current_volume = 0.
+        return self
+
+    def aspirate(self, volume: Optional[float] = None, location=None, rate: float = 1.0) -> 'DryRunPipette':
+        volume = self.max_volume - self.current_volume if volume is None else volume
+        loc = self._location(location, DryRunWell.bottom)
+        if not self.has_tip:
+            self._ctx.error("{}: aspirating without a tip".format(self))
+        if self.current_volume + volume > self.max_volume + 1e-6:
+            self._ctx.error("{}: aspirating {} uL over the maximum volume ({} uL in the tip)".format(self, volume, self.current_volume))
+        self._record(command_types.ASPIRATE, lambda: "Aspirating {:.1f} uL from {} at {:.1f} uL/sec".format(volume, location_well(loc), self.flow_rate.aspirate * rate), loc, volume=volume, flow_rate=self.flow_rate.aspirate * rate)
+        self.current_volume += volume
+        return self
+
+    def dispense(self, volume: Optional[float] = None, location=None, rate: float = 1.0) -> 'DryRunPipette':
+        volume = self.current_volume if volume is None else volume
+        loc = self._location(location, DryRunWell.bottom)
+        if volume > self.current_volume + 1e-6:
+            self._ctx.error("{}: dispensing {} uL with {} uL in the tip".format(self, volume, self.current_volume))
+        self._record(command_types.DISPENSE, lambda: "Dispensing {:.1f} uL into {} at {:.1f} uL/sec".format(volume, location_well(loc), self.flow_rate.dispense * rate), loc, volume=volume, flow_rate=self.flow_rate.dispense * rate)
+        self.current_volume = max(self.current_volume - volume, 0.)
+        return self
+
+    def air_gap(self, volume: Optional[float] = None, height: Optional[float] = None) -> 'DryRunPipette':
+        loc = None if self._last_well is None else self._last_well.top(5 if height is None else height)
+        with self._ctx.nested(command_types.AIR_GAP, "Air gap", pipette=self, location=loc):
+            self.aspirate(volume, loc)
+        return self
+
+    def blow_out(self, location=None) -> 'DryRunPipette':
+        loc = self._location(location, DryRunWell.top)
+        self._record(command_types.BLOW_OUT, lambda: "Blowing out at {}".format(location_well(loc)), loc, flow_rate=self.flow_rate.blow_out)
+        self.current_volume = 0.
+        return self
+
+    def touch_tip(self, location=None, radius: float = 1.0, v_offset: float = -1.0, speed: float = 60.0) -> 'DryRunPipette':
+        loc = self._location(location, lambda w: w.top(v_offset))
+        self._record(command_types.TOUCH_TIP, "Touching tip", loc, speed=speed)
+        return self
+
+    def mix(self, repetitions: int = 1, volume: Optional[float] = None, location=None, rate: float = 1.0) -> 'DryRunPipette':
+        volume = self.max_volume if volume is None else volume
+        loc = self._location(location, DryRunWell.bottom)
+        with self._ctx.nested(command_types.MIX, lambda: "Mixing {} times with a volume of {:.1f} ul".format(repetitions, volume), pipette=self, location=loc):
+            for _ in range(repetitions):
+                self.aspirate(volume, loc, rate)
+                self.dispense(volume, loc, rate)
+        return self
+
+    def transfer(self, volume: float, source, dest, new_tip: str = 'once', air_gap: float = 0, mix_after: Optional[tuple] = None, mix_before: Optional[tuple] = None, **kwargs) -> 'DryRunPipette':
+        src = self._location(source, DryRunWell.bottom)
+        dst = self._location(dest, DryRunWell.bottom)
+        chunk = self.max_volume - air_gap
+        n = max(int(-(-volume // chunk)), 1)
+        with self._ctx.nested(command_types.TRANSFER, lambda: "Transferring {:.1f} from {} to {}".format(volume, location_well(src), location_well(dst)), pipette=self, location=src):
+            if new_tip != 'never' and not self.has_tip:
+                self.pick_up_tip()
+            for i in range(n):
+                if new_tip == 'always' and i:
+                    self.drop_tip()
+                    self.pick_up_tip()
+                if mix_before:
+                    self.mix(mix_before[0], mix_before[1], src)
+                self.aspirate(volume / n, src)
+                if air_gap:
+                    self.air_gap(air_gap)
+                self.dispense(volume / n + air_gap, dst)
+                if mix_after:
+                    self.mix(mix_after[0], mix_after[1], dst)
+            if new_tip != 'never':
+                self.drop_tip()
+        return self
+
+
+class MaxSpeeds(dict):
+    """Axis speed limits: setting an axis to None removes its limit.
+    `frozen` is a copy shared by the commands recorded until the limits change"""
+    def __init__(self):
+        super().__init__()
+        self.frozen = {}
+
+    def __setitem__(self, axis: str, value: Optional[float]):
+        if value is None:
+            self.pop(axis, None)
+        else:
+            super().__setitem__(axis, value)
+        self.frozen = dict(self)
+
+
+class DryRunBroker:
+    def __init__(self):
+        self._subscribers: List[Callable[[dict], None]] = []
+
+    def subscribe(self, topic: str, handler: Callable[[dict], None]) -> Callable[[], None]:
+        self._subscribers.append(handler)
+        return lambda: self._subscribers.remove(handler) if handler in self._subscribers else None
+
+    def publish(self, message: dict):
+        for s in tuple(self._subscribers):
+            s(message)
+
+
+class DryRunContext:
+    """Stand-in for the Opentrons ProtocolContext that records the commands instead of executing them.
+    Command texts are only formatted when someone subscribed to the broker"""
+    def __init__(self, api_level: str = '2.3'):
+        self.api_level = api_level
+        self.broker = DryRunBroker()
+        self.max_speeds = MaxSpeeds()
+        self.commands: List[dict] = []
+        self.errors: List[str] = []
+        self.tips: Counter = Counter()
+        self.stage: Optional[str] = None
+        self.loaded_labwares: Dict[int, DryRunLabware] = {12: DryRunLabware(TRASH_DEFINITION, 12)}
+        self.loaded_modules: Dict[int, DryRunModule] = {}
+        self.loaded_instruments: Dict[str, DryRunPipette] = {}
+        lights = {"on": False}
+        self._hw_manager = SimpleNamespace(hardware=SimpleNamespace(
+            get_lights=lambda: dict(rails=lights["on"], button=False),
+            set_lights=lambda rails=None, button=None: lights.update(on=rails),
+            _backend=SimpleNamespace(gpio_chardev=SimpleNamespace(set_button_light=lambda **kwargs: None)),
+        ))
+        self._depth = 0
+
+    @staticmethod
+    def is_simulating() -> bool:
+        return True
+
+    def record(self, name: str, text: Union[str, Callable[[], str]], pipette: Optional[DryRunPipette] = None, location: Optional[Location] = None, **kwargs) -> dict:
+        cmd = dict(
+            name=name,
+            stage=self.stage,
+            depth=self._depth,
+            pipette=None if pipette is None else pipette.mount,
+            location=None if location is None else tuple(location.point),
+            max_speeds=self.max_speeds.frozen,
+            **kwargs
+        )
+        self.commands.append(cmd)
+        if self.broker._subscribers:
+            text = text() if callable(text) else text
+            payload = dict(kwargs, text=text.replace("{", "{{").replace("}", "}}"), location=location, instrument=pipette)
+            self.broker.publish({'$': 'before', 'name': name, 'payload': payload})
+            self.broker.publish({'$': 'after', 'name': name, 'payload': payload})
+        return cmd
+
+    @contextmanager
+    def nested(self, name: str, text: Union[str, Callable[[], str]], pipette: Optional[DryRunPipette] = None, location: Optional[Location] = None, **kwargs):
+        """Composite command: nested commands are recorded between its 'before' and 'after' messages"""
+        cmd = dict(name=name, stage=self.stage, depth=self._depth, pipette=None if pipette is None else pipette.mount, location=None if location is None else tuple(location.point), composite=True, **kwargs)
+        self.commands.append(cmd)
+        payload = None
+        if self.broker._subscribers:
+            text = text() if callable(text) else text
+            payload = dict(kwargs, text=text.replace("{", "{{").replace("}", "}}"), location=location, instrument=pipette)
+            self.broker.publish({'$': 'before', 'name': name, 'payload': payload})
+        self._depth += 1
+        try:
+            yield cmd
+        finally:
+            self._depth -= 1
+            if payload is not None:
+                self.broker.publish({'$': 'after', 'name': name, 'payload': payload})
+
+    def error(self, msg: str):
+        self.errors.append("[{}] {}".format(self.stage, msg))
+
+    def load_labware(self, load_name: str, location: Union[int, str], label: Optional[str] = None, *args, **kwargs) -> DryRunLabware:
+        slot = int(location)
+        self.loaded_labwares[slot] = DryRunLabware(load_definition(load_name), slot, label)
+        return self.loaded_labwares[slot]
+
+    def load_labware_from_definition(self, definition: dict, location: Union[int, str], label: Optional[str] = None) -> DryRunLabware:
+        slot = int(location)
+        self.loaded_labwares[slot] = DryRunLabware(definition, slot, label)
+        return self.loaded_labwares[slot]
+
+    def load_module(self, module_name: str, location: Union[int, str, None] = None, *args, **kwargs) -> DryRunModule:
+        slot = int(location)
+        self.loaded_modules[slot] = DryRunModule(self, module_name, slot)
+        return self.loaded_modules[slot]
+
+    def load_instrument(self, instrument_name: str, mount: str, tip_racks: Optional[List[DryRunLabware]] = None, *args, **kwargs) -> DryRunPipette:
+        self.loaded_instruments[mount] = DryRunPipette(self, instrument_name, mount, tip_racks)
+        return self.loaded_instruments[mount]
+
+    def comment(self, msg: str):
+        self.record(command_types.COMMENT, msg)
+
+    def delay(self, seconds: float = 0, minutes: float = 0, msg: Optional[str] = None):
+        self.record(command_types.DELAY, "Delaying for {} minutes and {} seconds".format(minutes, seconds), seconds=seconds + 60 * minutes)
+
+    def pause(self, msg: Optional[str] = None):
+        self.record(command_types.PAUSE, "Pausing robot operation", msg=msg)
+
+    def resume(self):
+        self.record(command_types.RESUME, "Resuming robot operation")
+
+    def home(self):
+        self.record(command_types.HOME, "Homing pipette plunger on mount")
+
+    def summary(self) -> dict:
+        """Command counts, tip usage per rack, volumes per pipette, pauses, delays and errors"""
+        volumes = {}
+        for c in self.commands:
+            if c["name"] in (command_types.ASPIRATE, command_types.DISPENSE):
+                v = volumes.setdefault(c["pipette"], {"aspirated": 0., "dispensed": 0.})
+                v["aspirated" if c["name"] == command_types.ASPIRATE else "dispensed"] += c["volume"]
+        names = Counter(c["name"] for c in self.commands)
+        return {
+            "commands": len(self.commands),
+            "commands_by_type": dict(names),
+            "tips": dict(self.tips),
+            "volumes": volumes,
+            "pauses": names[command_types.PAUSE],
+            "delay_seconds": sum(c.get("seconds", 0) for c in self.commands if c["name"] == command_types.DELAY),
+            "stages": len(OrderedDict.fromkeys(c["stage"] for c in self.commands if c["stage"] is not None)),
+            "errors": list(self.errors),
+        }
+
+
+def dry_run(cls: type, api_level: str = '2.3', **kwargs) -> DryRunContext:
+    """Run a station class on a dry-run context
+    :param cls: the station class
+    :param api_level: API level of the protocol
+    :param kwargs: keyword arguments for the station constructor
+    :returns: the context, holding the recorded commands"""
+    kwargs.setdefault("logger", _quiet_logger())
+    station = cls(**kwargs)
+    return station.dry_run(api_level)
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
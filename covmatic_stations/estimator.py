@@ -0,0 +1,201 @@
+"""Run-duration estimator for the stations.
+The commands recorded by a dry run are replayed through a timing model:
+gantry travel from deck coordinates and speed limits, plunger time from volume and flow rate,
+tip pick-up and drop overheads, delays and module waits. E.g.
+
+    from covmatic_stations.estimator import estimate_station
+    print(estimate_station(StationBTechnogenetics, num_samples=96, wash_1_times=20)["total"])
+
+The model parameters are read from a JSON file (see `timing_model.json`) that can be calibrated per robot.
+Time spent by the operator during pauses is not predictable: it is taken from the `pause` parameter.
+Run with `python -m covmatic_stations.estimator` to estimate every station of the package
+(the exit code is 1 if an estimate fails)."""
+from .utils import command_types
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+import argparse
+import importlib
+import json
+import math
+import os
+import sys
+import traceback
+
+
+default_model_filepath = os.path.join(os.path.dirname(__file__), 'timing_model.json')
+
+CATEGORIES = ("travel", "liquid", "tips", "delay", "modules", "pause", "other")
+STATIONS = (
+    "covmatic_stations.a.p300.StationAP300",
+    "covmatic_stations.a.p1000.StationAP1000",
+    "covmatic_stations.a.p1000reload.StationAP1000Reload",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics24",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics48",
+    "covmatic_stations.b.b.StationB",
+    "covmatic_stations.b.technogenetics.StationBTechnogenetics",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsElutionRemoval",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsWashBRemoval",
+    "covmatic_stations.c.c.StationC",
+    "covmatic_stations.c.technogenetics.StationCTechnogenetics",
+    "covmatic_stations.c.technogenetics.StationCTechnogeneticsM300",
+)
+
+
+class TimingModel:
+    def __init__(self, params: dict):
+        """
+        :param params: model parameters, as in the model file
+        """
+        self.params = params
+
+    @classmethod
+    def from_file(cls, filepath: Optional[str] = None) -> 'TimingModel':
+        """Load the model parameters from a JSON file. Missing parameters are taken from the default model
+        :param filepath: path of the model file (defaults to the one in the package)"""
+        with open(default_model_filepath) as f:
+            params = json.load(f)
+        if filepath is not None and os.path.abspath(filepath) != default_model_filepath:
+            with open(filepath) as f:
+                params.update(json.load(f))
+        return cls(params)
+
+    def _speed(self, axis: str, max_speeds: dict) -> float:
+        s = self.params["axis_speeds"][axis]
+        if axis in "XY":
+            s = min(s, self.params["default_speed"])
+        return min(s, max_speeds.get(axis, s))
+
+    def path(self, start: Tuple[float, float, float], end: Tuple[float, float, float]) -> Tuple[float, float, float]:
+        """Distance travelled along each axis between two points.
+        Short moves are direct, longer ones go up to the safe height and down again"""
+        dx, dy = abs(end[0] - start[0]), abs(end[1] - start[1])
+        if math.hypot(dx, dy) <= self.params["direct_move_distance"]:
+            return dx, dy, abs(end[2] - start[2])
+        return dx, dy, max(self.params["safe_height"] - start[2], 0) + max(self.params["safe_height"] - end[2], 0)
+
+    def travel(self, start: Tuple[float, float, float], end: Tuple[float, float, float], mount: Optional[str], max_speeds: dict) -> float:
+        """Time to move the gantry between two points"""
+        dx, dy, dz = self.path(start, end)
+        z_axis = self.params["mount_axes"].get(mount, "Z")
+        t = max(dx / self._speed("X", max_speeds), dy / self._speed("Y", max_speeds)) + dz / self._speed(z_axis, max_speeds)
+        return t + self.params["move_overhead"] if t else 0.
+
+    def command(self, cmd: dict) -> Tuple[str, float]:
+        """Category and duration of a command, gantry travel excluded"""
+        p = self.params
+        ct = command_types
+        name = cmd["name"]
+        if name in (ct.ASPIRATE, ct.DISPENSE):
+            return "liquid", p["plunger_overhead"] + (cmd["volume"] / cmd["flow_rate"] if cmd.get("flow_rate") else 0)
+        if name == ct.BLOW_OUT:
+            return "liquid", p["blow_out"]
+        if name == ct.TOUCH_TIP:
+            return "liquid", p["touch_tip"]
+        if name == ct.PICK_UP_TIP:
+            return "tips", p["pick_up_tip"]
+        if name == ct.DROP_TIP:
+            return "tips", p["drop_tip"]
+        if name == ct.DELAY:
+            return "delay", cmd.get("seconds", 0)
+        if name == ct.PAUSE:
+            return "pause", p["pause"]
+        if name == ct.HOME:
+            return "other", p["home"]
+        if name == ct.MAGDECK_ENGAGE:
+            return "modules", p["magdeck_engage"]
+        if name == ct.MAGDECK_DISENGAGE:
+            return "modules", p["magdeck_disengage"]
+        if name == ct.TEMPDECK_SET_TEMP:
+            previous = cmd.get("previous", None)
+            delta = abs(cmd["temperature"] - (p["ambient_temperature"] if previous is None else previous))
+            return "modules", delta / p["tempdeck_degrees_per_second"]
+        if name == ct.TEMPDECK_DEACTIVATE:
+            return "modules", p["tempdeck_deactivate"]
+        return "other", 0.
+
+
+def _breakdown() -> Dict[str, float]:
+    return OrderedDict((c, 0.) for c in CATEGORIES)
+
+
+def estimate(cmds: Iterable[dict], model: Optional[TimingModel] = None) -> dict:
+    """Estimate the duration of a command stream
+    :param cmds: commands recorded by a dry run (composite commands are skipped, their nested commands are timed)
+    :param model: the timing model (defaults to the one in the package)
+    :returns: total seconds, breakdown by category, per-stage breakdown and gantry travel in mm"""
+    model = model or TimingModel.from_file()
+    position = tuple(model.params["home_position"])
+    stages = OrderedDict()
+    distance = 0.
+    for cmd in cmds:
+        if cmd.get("composite", False):
+            continue
+        stage = stages.setdefault(cmd["stage"], {"name": cmd["stage"], "seconds": 0., "commands": 0, "breakdown": _breakdown()})
+        stage["commands"] += 1
+        if cmd["location"] is not None:
+            t = model.travel(position, cmd["location"], cmd["pipette"], cmd.get("max_speeds", {}))
+            stage["breakdown"]["travel"] += t
+            stage["seconds"] += t
+            dx, dy, dz = model.path(position, cmd["location"])
+            distance += math.hypot(dx, dy) + dz
+            position = cmd["location"]
+        category, t = model.command(cmd)
+        stage["breakdown"][category] += t
+        stage["seconds"] += t
+        if cmd["name"] == command_types.HOME:
+            position = tuple(model.params["home_position"])
+    total = _breakdown()
+    for s in stages.values():
+        for k, v in s["breakdown"].items():
+            total[k] += v
+    return {
+        "total": sum(total.values()),
+        "breakdown": total,
+        "stages": list(stages.values()),
+        "travel_mm": distance,
+    }
+
+
+def estimate_station(cls: type, model_filepath: Optional[str] = None, **kwargs) -> dict:
+    """Estimate the duration of a station run from a dry run
+    :param cls: the station class
+    :param model_filepath: path of the timing model file (defaults to the one in the package)
+    :param kwargs: keyword arguments for the station constructor"""
+    from .dryrun import dry_run
+    return estimate(dry_run(cls, **kwargs).commands, TimingModel.from_file(model_filepath))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--classes', metavar='C', type=str, nargs='+', default=STATIONS, help='Dotted paths of the station classes')
+    parser.add_argument('-s', '--samples', metavar='N', type=int, nargs='+', default=(8, 96), help='Sample counts')
+    parser.add_argument('-k', '--kwargs', metavar='JSON', type=str, default="{}", help='Other keyword arguments for the station constructors')
+    parser.add_argument('-m', '--model', metavar='F', type=str, default=None, help='The timing model file path')
+    args = parser.parse_args()
+
+    kwargs = dict(json.loads(args.kwargs), tip_track=False)
+    failures = 0
+    for path in args.classes:
+        for n in args.samples:
+            try:
+                module, name = path.rsplit(".", 1)
+                est = estimate_station(getattr(importlib.import_module(module), name), args.model, num_samples=n, **kwargs)
+            except Exception:
+                failures += 1
+                print("FAIL {}[{}]\n{}".format(path.rsplit(".", 1)[-1], n, traceback.format_exc()), flush=True)
+                continue
+            print("OK   {}[{}]: {:.0f} s ({})".format(
+                path.rsplit(".", 1)[-1], n, est["total"],
+                ", ".join("{} {:.0f} s".format(k, v) for k, v in est["breakdown"].items() if v),
+            ), flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
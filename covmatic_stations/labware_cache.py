@@ -0,0 +1,164 @@
+"""Content-addressed cache of generated labware definitions, in memory and on disk.
+Definitions are keyed by a hash of what they are generated from: the class of the specs, their parameters
+(correction factors included, as they are applied to the parameters) and the source of the modules of the class.
+Both caches are bounded: the least recently used definitions are evicted first.
+Definitions returned by the cache are copies, so callers may modify them.
+Definitions read from JSON files are cached in memory and read again only when the file changes."""
+from .registry import json_file
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import Callable, List, Optional
+import copy
+import hashlib
+import inspect
+import json
+import logging
+import os
+
+
+default_folder = os.environ.get("COVMATIC_LABWARE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "covmatic_stations", "labware"))
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def _source_digest(filepath: str) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def specs_key(specs) -> str:
+    """Content hash of labware specs: their class, their parameters and the source of the modules of the class"""
+    cls = type(specs)
+    sources = sorted({inspect.getsourcefile(c) for c in cls.__mro__ if c is not object})
+    content = {
+        "class": "{}.{}".format(cls.__module__, cls.__qualname__),
+        "parameters": json.dumps(vars(specs), sort_keys=True, default=str),
+        "sources": [_source_digest(s) for s in sources],
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class LabwareDefinitionCache:
+    def __init__(
+        self,
+        folder: Optional[str] = default_folder,
+        logger: Optional[logging.getLoggerClass()] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        """
+        :param folder: folder of the definitions on disk (None to cache in memory only)
+        :param logger: the logger
+        :param max_entries: maximum number of definitions kept in memory
+        :param max_bytes: maximum total size of the definitions on disk, after which the least recently used ones are evicted
+        """
+        self.folder = folder
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._definitions: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.folder, "{}.json".format(key))
+
+    def _read(self, key: str) -> Optional[dict]:
+        if self.folder is None:
+            return None
+        fp = self._filepath(key)
+        try:
+            with open(fp, "r") as f:
+                definition = json.load(f)
+            # Access time is tracked with the modification time, as filesystems may be mounted with noatime
+            os.utime(fp)
+        except (OSError, ValueError):
+            return None
+        return definition
+
+    def _write(self, key: str, definition: dict):
+        if self.folder is None:
+            return
+        fp = self._filepath(key)
+        tmp = "{}.{}.tmp".format(fp, os.getpid())
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(definition, f)
+            os.replace(tmp, fp)
+            self.evict()
+        except OSError as e:
+            # e.g. a read-only home folder: the definition is still cached in memory
+            self.logger.warning("cannot store labware definition {}: {}".format(key, e))
+
+    def entries(self) -> List[os.DirEntry]:
+        """Definitions on disk, least recently used first"""
+        if self.folder is None or not os.path.isdir(self.folder):
+            return []
+        return sorted((e for e in os.scandir(self.folder) if e.name.endswith(".json")), key=lambda e: e.stat().st_mtime)
+
+    def evict(self) -> int:
+        """Remove the least recently used definitions on disk until they fit the size limit
+        :returns: the number of definitions removed"""
+        entries = self.entries()
+        size = sum(e.stat().st_size for e in entries)
+        n = 0
+        for e in entries:
+            if size <= self.max_bytes:
+                break
+            size -= e.stat().st_size
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+            n += 1
+        return n
+
+    def get(self, key: str, build: Callable[[], dict]) -> dict:
+        """Copy of the definition for the key, built (and stored) if it is not in the cache
+        :param key: content hash of the definition
+        :param build: function building the definition"""
+        with self._lock:
+            definition = self._definitions.get(key, None)
+            if definition is None:
+                definition = self._read(key)
+                if definition is None:
+                    self.misses += 1
+                    definition = json.loads(json.dumps(build()))
+                    self._write(key, definition)
+                else:
+                    self.hits += 1
+                self._definitions[key] = definition
+                while len(self._definitions) > self.max_entries:
+                    self._definitions.popitem(last=False)
+            else:
+                self.hits += 1
+                self._definitions.move_to_end(key)
+        return copy.deepcopy(definition)
+
+    def specs_definition(self, specs) -> dict:
+        """Labware definition generated by the specs (e.g. `Copan24Specs`)"""
+        return self.get(specs_key(specs), specs.toJSON)
+
+    def clear(self):
+        with self._lock:
+            self._definitions.clear()
+            for e in self.entries():
+                os.remove(e.path)
+
+
+default_cache = LabwareDefinitionCache()
+
+
+def load_definition(filepath: str) -> dict:
+    """Copy of the labware definition in a JSON file, read again only if the file changed"""
+    return copy.deepcopy(json_file(filepath).load()[1])
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
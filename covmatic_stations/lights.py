@@ -1,67 +1,238 @@
-from opentrons.protocol_api import ProtocolContext
-from threading import Thread
+from threading import Lock, Thread
 from functools import wraps
-import requests
+from queue import Empty, Queue
+from typing import Callable, Optional, TYPE_CHECKING
+import logging
 import time
 
+if TYPE_CHECKING:
+    from opentrons.protocol_api import ProtocolContext
+
 
 class Dummyable(type):
     class Dummy: pass
     
-    def __new__(mcs, classname: str, supers: tuple, classdict: dict):
-        cls = super(Dummyable, mcs).__new__(mcs, classname, supers, classdict)
-        if mcs.Dummy not in cls.__mro__:
+    @property
+    def dummy(cls) -> type:
+        """Subclass whose methods do nothing (built on first access)"""
+        if Dummyable.Dummy in cls.__mro__:
+            return cls
+        dummy = cls.__dict__.get("_dummy", None)
+        if dummy is None:
             def emptyfun(*args, **kwargs): pass
-            dummydict = {k: v if k[:2] == "__" else (wraps(v)(emptyfun) if callable(v) else None) for k, v in map(lambda k: (k, getattr(cls, k, None)), dir(cls))}
-            cls.dummy = type("Dummy{}".format(classname), (mcs.Dummy, cls), dummydict)
-        return cls
+            dummydict = {k: v if k[:2] == "__" else (wraps(v)(emptyfun) if callable(v) else None) for k, v in map(lambda k: (k, getattr(cls, k, None)), dir(cls)) if k != "_dummy"}
+            dummy = type("Dummy{}".format(cls.__name__), (Dummyable.Dummy, cls), dummydict)
+            cls._dummy = dummy
+        return dummy
+
 
+HTTP_TIMEOUT = 1.0
 
-class BlinkingLight(Thread, metaclass=Dummyable):
-    def __init__(self, ctx: ProtocolContext, t: float = 1):
-        super(BlinkingLight, self).__init__()
-        self._on = False
-        self._state = True
-        self._state_initial = None
+
+class CircuitBreaker:
+    """Stops calling a failing function for a while after some consecutive failures"""
+    def __init__(self, failures: int = 3, reset_time: float = 30., clock: Callable[[], float] = time.monotonic, logger: Optional[logging.getLoggerClass()] = None):
+        """
+        :param failures: consecutive failures after which the breaker opens
+        :param reset_time: time in seconds after which an open breaker lets a call through again
+        :param clock: clock function in seconds
+        :param logger: the logger
+        """
+        self._max_failures = failures
+        self._reset_time = reset_time
+        self._clock = clock
+        self.logger = logger or logging.getLogger(__name__)
+        self.failures = 0
+        self._opened = None
+
+    @property
+    def open(self) -> bool:
+        return self._opened is not None and self._clock() - self._opened < self._reset_time
+
+    def call(self, fun: Callable, *args, default=None, **kwargs):
+        """Call the function unless the breaker is open
+        :returns: the result of the function, or the default value if the breaker is open or the call failed"""
+        if self.open:
+            return default
+        try:
+            result = fun(*args, **kwargs)
+        except Exception as e:
+            self.failures += 1
+            if self.failures >= self._max_failures:
+                if self._opened is None:
+                    self.logger.warning("{} failed {} times, retrying in {}s: {}".format(getattr(fun, "__name__", fun), self.failures, self._reset_time, e))
+                self._opened = self._clock()
+            return default
+        self.failures = 0
+        self._opened = None
+        return result
+
+
+class HardwareLights:
+    """Rail lights and button light through the hardware controller"""
+    def __init__(self, ctx: 'ProtocolContext'):
         self._ctx = ctx
+
+    def get_rails(self) -> bool:
+        lights = self._ctx._hw_manager.hardware.get_lights()
+        return lights.get('rails', False) if isinstance(lights, dict) else bool(lights)
+
+    def set_rails(self, on: bool):
+        self._ctx._hw_manager.hardware.set_lights(rails=on)
+
+    def set_button(self, red: bool, green: bool, blue: bool):
+        self._ctx._hw_manager.hardware._backend.gpio_chardev.set_button_light(red=red, green=green, blue=blue)
+
+
+class HTTPLights(HardwareLights):
+    """Rail lights through the robot server, with a keep-alive session and a timeout"""
+    _URL = "http://127.0.0.1:31950/robot/lights"
+
+    def __init__(self, ctx: 'ProtocolContext', url: str = _URL, timeout: float = HTTP_TIMEOUT):
+        """
+        :param ctx: the protocol context
+        :param url: URL of the lights endpoint of the robot server
+        :param timeout: timeout of the requests in seconds
+        """
+        super(HTTPLights, self).__init__(ctx)
+        self._url = url
+        self._timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def get_rails(self) -> bool:
+        r = self.session.get(self._url, timeout=self._timeout)
+        r.raise_for_status()
+        return r.json().get('on', False)
+
+    def set_rails(self, on: bool):
+        self.session.post(self._url, json={'on': on}, timeout=self._timeout).raise_for_status()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class LightController(Thread):
+    """Single thread driving the lights of a station: requests are queued and never block the caller.
+    Blinking is timed by the loop itself, and each kind of call has its own circuit breaker,
+    so that an unresponsive robot server does not delay the other calls"""
+    def __init__(self, lights: HardwareLights, logger: Optional[logging.getLoggerClass()] = None, **breaker_kwargs):
+        """
+        :param lights: the lights backend
+        :param logger: the logger
+        :param breaker_kwargs: keyword arguments for the circuit breakers
+        """
+        super(LightController, self).__init__(name="LightController", daemon=True)
+        self._lights = lights
+        self.logger = logger or logging.getLogger(type(self).__name__)
+        self._queue = Queue()
+        self._breakers = {k: CircuitBreaker(logger=self.logger, **breaker_kwargs) for k in ("get_rails", "set_rails", "set_button")}
+        self._start_lock = Lock()
+
+    def _put(self, cmd: str, arg=None):
+        with self._start_lock:
+            if not self.is_alive() and self.ident is None:
+                self.start()
+        self._queue.put((cmd, arg))
+
+    def blink(self, period: float):
+        """Start blinking the rail lights
+        :param period: time in seconds between toggles"""
+        self._put("blink", period)
+
+    def stop_blink(self):
+        """Stop blinking and restore the rail lights as they were before"""
+        self._put("stop")
+
+    def set_button(self, state: dict):
+        self._put("button", state)
+
+    def close(self, timeout: Optional[float] = None):
+        """Stop blinking, process the pending requests and stop the thread"""
+        if self.ident is None:
+            return
+        self._queue.put(("close", None))
+        self.join(timeout)
+
+    def _call(self, name: str, *args, default=None, **kwargs):
+        return self._breakers[name].call(getattr(self._lights, name), *args, default=default, **kwargs)
+
+    def run(self):
+        period = None
+        initial = None
+        state = False
+        next_toggle = 0.
+        while True:
+            try:
+                cmd, arg = self._queue.get(timeout=None if period is None else max(0., next_toggle - time.monotonic()))
+            except Empty:
+                state = not state
+                self._call("set_rails", state)
+                next_toggle = max(next_toggle + period, time.monotonic())
+                continue
+            if cmd == "blink":
+                if period is None:
+                    initial = self._call("get_rails")
+                    state = bool(initial)
+                    next_toggle = time.monotonic()
+                period = arg
+            elif cmd == "button":
+                self._call("set_button", **arg)
+            if cmd in ("stop", "close") and period is not None:
+                period = None
+                if initial is not None:
+                    self._call("set_rails", initial)
+            if cmd == "close":
+                break
+        if hasattr(self._lights, "close"):
+            self._lights.close()
+
+
+class BlinkingLight(LightController, metaclass=Dummyable):
+    """Rail lights blinking between start and stop, on top of a light controller"""
+    _lights_class = HardwareLights
+
+    def __init__(self, ctx: 'ProtocolContext', t: float = 1):
+        """
+        :param ctx: the protocol context
+        :param t: time in seconds between toggles
+        """
+        super(BlinkingLight, self).__init__(self._lights_class(ctx))
         self._t = t
-    
+
+    def start(self):
+        super(BlinkingLight, self).start()
+        self.blink(self._t)
+
     def stop(self):
-        self._on = False
-        self.join()
-    
-    def initial_state(self) -> bool:
-        return self._ctx._hw_manager.hardware.get_lights()
-    
-    def set_light(self, s: bool):
-        self._ctx._hw_manager.hardware.set_lights(rails=s)
-    
-    def run(self):
-        self._on = True
-        self._state_initial = self.initial_state()
-        while self._on:
-            self._state = not self._state
-            self.set_light(self._state)
-            time.sleep(self._t)
-        self.set_light(self._state_initial)
+        """Stop blinking, restore the rail lights and stop the thread"""
+        self.close()
 
 
 class BlinkingLightHTTP(BlinkingLight):
-    _URL = "http://127.0.0.1:31950/robot/lights"
-    
-    def initial_state(self) -> bool:
-        return requests.get(self._URL).json().get('on', False)
-    
-    def set_light(self, s: bool):
-        requests.post(self._URL, json={'on': s})
+    """Rail lights blinking through the robot server"""
+    _lights_class = HTTPLights
 
 
 class Button(metaclass=Dummyable):
     _base_cols = ['red', 'green', 'blue']
     _all_cols = ['black', 'blue', 'green', 'cyan', 'red', 'magenta', 'yellow', 'white']
     
-    def __init__(self, ctx: ProtocolContext, color: str = 'blue'):
+    def __init__(self, ctx: 'ProtocolContext', color: str = 'blue', controller: Optional[LightController] = None):
+        """
+        :param ctx: the protocol context
+        :param color: the initial color (restored when the button is deleted)
+        :param controller: the light controller of the station (if None, the color is set directly)
+        """
         self._ctx = ctx
+        self._controller = controller
         self._default_color = color
         self.color = color
 
@@ -81,7 +252,10 @@ class Button(metaclass=Dummyable):
     @color.setter
     def color(self, color: str):
         self._state = self.encode(color)
-        self._ctx._hw_manager.hardware._backend.gpio_chardev.set_button_light(**self._state)
+        if self._controller is None:
+            HardwareLights(self._ctx).set_button(**self._state)
+        else:
+            self._controller.set_button(self._state)
     
     def __del__(self):
         self.color = self._default_color
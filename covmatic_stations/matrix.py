@@ -0,0 +1,173 @@
+"""Simulation matrix runner.
+Simulates a matrix of station classes x constructor arguments on a pool of worker processes and reports
+failures, tip usage and command counts. Each worker is a fresh (spawned) interpreter with its own Opentrons
+configuration folder, so no global state is shared between simulations running in parallel. E.g.
+
+    python -m covmatic_stations.matrix -s 8 48 96
+    python -m covmatic_stations.matrix -c covmatic_stations.b.technogenetics.StationBTechnogenetics -k '{"wash_1_times": [10, 20]}'
+
+Keyword arguments given as lists are expanded into their cartesian product.
+Results are streamed as they complete and an aggregated report can be saved as JSON.
+With `--cache`, results of identical simulations are reused from the on-disk cache (see `simcache`)."""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
+from itertools import product
+from typing import Iterable, List, Tuple
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+
+DEFAULT_CLASSES = (
+    "covmatic_stations.a.technogenetics.StationATechnogenetics24",
+    "covmatic_stations.a.technogenetics.StationATechnogenetics48",
+    "covmatic_stations.b.technogenetics.StationBTechnogenetics",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsElutionRemoval",
+    "covmatic_stations.b.technogenetics_short.StationBTechnogeneticsWashBRemoval",
+    "covmatic_stations.c.technogenetics.StationCTechnogenetics",
+    "covmatic_stations.c.technogenetics.StationCTechnogeneticsM300",
+)
+DEFAULT_SAMPLES = (8, 16, 24, 48, 72, 96)
+ENGINES = ("simulator", "dryrun")
+
+
+def load_class(path: str) -> type:
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def expand(grid: dict) -> List[dict]:
+    """Cartesian product of the keyword arguments given as lists"""
+    keys = sorted(grid)
+    values = [grid[k] if isinstance(grid[k], list) else [grid[k]] for k in keys]
+    return [dict(zip(keys, v)) for v in product(*values)]
+
+
+def matrix(classes: Iterable[str], grid: dict) -> List[Tuple[str, dict]]:
+    return [(c, kw) for c in classes for kw in expand(grid)]
+
+
+def _init_worker():
+    # Opentrons reads and writes its configuration at import: each worker gets its own folder
+    os.environ["OT_API_CONFIG_DIR"] = tempfile.mkdtemp(prefix="covmatic_matrix_")
+
+
+def simulate(class_path: str, kwargs: dict, engine: str = "simulator", cache: bool = False) -> dict:
+    """Simulate a station configuration
+    :param class_path: dotted path of the station class
+    :param kwargs: keyword arguments for the station constructor
+    :param engine: 'simulator' for the Opentrons simulator, 'dryrun' for the dry-run engine
+    :param cache: reuse the results of identical simulations from the on-disk cache
+    :returns: outcome, command count, tips per rack, stages and elapsed seconds"""
+    result = OrderedDict([("class", class_path), ("kwargs", kwargs), ("engine", engine), ("ok", False), ("error", None), ("cached", False)])
+    t = time.perf_counter()
+    try:
+        # Imported here, so that an import error fails this job only
+        import opentrons.protocol_api  # noqa: F401 (opentrons.commands cannot be imported before it)
+        from .catalogue import DRY_RUN_KWARGS, DEFAULT_METADATA, quiet_logger
+        from . import simcache
+        kw = dict(kwargs, **DRY_RUN_KWARGS)
+        kw.setdefault("logger", quiet_logger())
+        kw["metadata"] = kw.get("metadata", None) or DEFAULT_METADATA
+        station = load_class(class_path)(**kw)
+        sim = simcache.simulate(station, engine, cache)
+        result["cached"] = sim["cached"]
+        result["commands"] = sim["summary"]["commands"]
+        result["tips"] = sim["summary"]["tips"]
+        result["stages"] = len(sim["stages"])
+        if sim["summary"]["errors"]:
+            raise RuntimeError("; ".join(sim["summary"]["errors"]))
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["traceback"] = traceback.format_exc()
+    result["seconds"] = time.perf_counter() - t
+    return result
+
+
+def report(results: List[dict]) -> dict:
+    """Aggregate the results: failures, command counts and tip usage per class"""
+    classes = OrderedDict()
+    for r in results:
+        c = classes.setdefault(r["class"], {"runs": 0, "failures": 0, "commands": {"min": None, "max": None}, "tips": {}})
+        c["runs"] += 1
+        if not r["ok"]:
+            c["failures"] += 1
+        if r.get("commands") is not None:
+            c["commands"]["min"] = r["commands"] if c["commands"]["min"] is None else min(c["commands"]["min"], r["commands"])
+            c["commands"]["max"] = r["commands"] if c["commands"]["max"] is None else max(c["commands"]["max"], r["commands"])
+        for rack, n in r.get("tips", {}).items():
+            c["tips"][rack] = max(c["tips"].get(rack, 0), n)
+    return {
+        "runs": len(results),
+        "failures": [{k: r[k] for k in ("class", "kwargs", "error")} for r in results if not r["ok"]],
+        "classes": classes,
+        "results": results,
+    }
+
+
+def run(jobs: List[Tuple[str, dict]], engine: str = "simulator", workers: int = None, stream=sys.stdout, cache: bool = False) -> dict:
+    """Run the simulations on a process pool, printing a line for each as soon as it completes"""
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker) as pool:
+        futures = {pool.submit(simulate, c, kw, engine, cache): (c, kw) for c, kw in jobs}
+        for i, f in enumerate(as_completed(futures), 1):
+            try:
+                r = f.result()
+            except Exception as e:
+                # e.g. a worker that died
+                c, kw = futures[f]
+                r = OrderedDict([("class", c), ("kwargs", kw), ("engine", engine), ("ok", False), ("error", "{}: {}".format(type(e).__name__, e)), ("cached", False), ("seconds", 0.)])
+            results.append(r)
+            if stream is not None:
+                print("[{}/{}] {} {} {} ({:.1f}s{}){}".format(
+                    i, len(futures),
+                    "OK  " if r["ok"] else "FAIL",
+                    r["class"].rsplit(".", 1)[-1],
+                    json.dumps(r["kwargs"], sort_keys=True),
+                    r["seconds"],
+                    ", cached" if r["cached"] else "",
+                    "" if r["ok"] else ": {}".format(r["error"]),
+                ), file=stream, flush=True)
+    return report(results)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--classes', metavar='C', type=str, nargs='+', default=DEFAULT_CLASSES, help='Dotted paths of the station classes')
+    parser.add_argument('-s', '--samples', metavar='N', type=int, nargs='+', default=DEFAULT_SAMPLES, help='Sample counts')
+    parser.add_argument('-k', '--kwargs', metavar='JSON', type=str, default="{}", help='Other keyword arguments (lists are expanded)')
+    parser.add_argument('-e', '--engine', type=str, choices=ENGINES, default="simulator", help='Simulation engine')
+    parser.add_argument('-j', '--workers', metavar='J', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-o', '--output', metavar='F', type=str, default=None, help='The file path where to save the report')
+    parser.add_argument('--cache', action='store_true', help='Reuse the results of identical simulations from the on-disk cache')
+    args = parser.parse_args()
+
+    grid = dict(json.loads(args.kwargs), num_samples=list(args.samples))
+    rep = run(matrix(args.classes, grid), args.engine, args.workers, cache=args.cache)
+    print("{} runs, {} failures".format(rep["runs"], len(rep["failures"])))
+    for name, c in rep["classes"].items():
+        print("  {}: {}/{} ok, commands {}-{}, tips {}".format(
+            name.rsplit(".", 1)[-1], c["runs"] - c["failures"], c["runs"],
+            c["commands"]["min"], c["commands"]["max"], sum(c["tips"].values()),
+        ))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(rep, f, indent=2)
+    return 1 if rep["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
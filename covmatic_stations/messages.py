@@ -0,0 +1,87 @@
+"""Message catalogue for the stations.
+The messages of each class are stored in a JSON file in the `msg` folder, named after the class.
+All files can be compiled into a single catalogue with `python -m covmatic_stations.messages`:
+the catalogue is loaded lazily at the first lookup (individual files are parsed instead if it is missing or stale).
+Messages are flattened along the MRO once per class and language, so that lookups are a single dict hit."""
+from typing import Dict, Tuple
+import json
+import os
+
+
+msg_folder = os.path.join(os.path.dirname(__file__), 'msg')
+catalogue_filepath = os.path.join(msg_folder, '_catalogue.json')
+
+
+_raw: Dict[str, dict] = None
+_flat: Dict[Tuple[type, str], Dict[str, str]] = {}
+
+
+def _sources() -> Dict[str, str]:
+    return {
+        os.path.splitext(f)[0]: os.path.join(msg_folder, f)
+        for f in os.listdir(msg_folder)
+        if f.endswith('.json') and not f.startswith('_')
+    }
+
+
+def compile_catalogue(filepath: str = catalogue_filepath) -> dict:
+    """Merge all the message files into a single catalogue file"""
+    catalogue = {}
+    for name, fp in sorted(_sources().items()):
+        with open(fp) as f:
+            catalogue[name] = json.load(f)
+    with open(filepath, 'w') as f:
+        json.dump(catalogue, f, indent=1, ensure_ascii=False)
+    return catalogue
+
+
+def raw() -> Dict[str, dict]:
+    """Messages per class name, as in the message files"""
+    global _raw
+    if _raw is None:
+        sources = _sources()
+        if os.path.isfile(catalogue_filepath) and os.path.getmtime(catalogue_filepath) >= max(map(os.path.getmtime, sources.values()), default=0):
+            with open(catalogue_filepath) as f:
+                _raw = json.load(f)
+        else:
+            _raw = {}
+            for name, fp in sources.items():
+                with open(fp) as f:
+                    _raw[name] = json.load(f)
+    return _raw
+
+
+def _flatten(cls: type, lan: str) -> Dict[str, str]:
+    d = {}
+    for c in reversed(cls.__mro__):
+        for k, v in raw().get(c.__name__, {}).items():
+            if lan in v:
+                d[k] = v[lan]
+    _flat[cls, lan] = d
+    return d
+
+
+def messages(cls: type, lan: str = 'ENG') -> Dict[str, str]:
+    """All the messages of a class in the specified language"""
+    try:
+        return _flat[cls, lan]
+    except KeyError:
+        return _flatten(cls, lan)
+
+
+def get_message(cls: type, key: str, lan: str = 'ENG') -> str:
+    return messages(cls, lan).get(key, key)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', metavar='F', type=str, default=catalogue_filepath, help='The file path where to save the catalogue')
+    args = parser.parse_args()
+    print("compiled {} message files into {}".format(len(compile_catalogue(args.output)), args.output))
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
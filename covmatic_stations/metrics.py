@@ -0,0 +1,160 @@
+"""Live metrics of a station run, exposed in the Prometheus plain-text format.
+Counters and histograms are updated from the command broker, from the stage changes and from the pauses of the station;
+gauges (current stage, trash fill, remaining tips, temperature) are read when the metrics are scraped."""
+from .utils import command_types
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+import bisect
+import time
+
+
+PREFIX = "covmatic"
+DURATION_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    return "{{{}}}".format(",".join("{}=\"{}\"".format(k, _escape(v)) for k, v in labels.items())) if labels else ""
+
+
+def _value(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = DURATION_BUCKETS):
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self.counts: List[int] = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, v: float):
+        i = bisect.bisect_left(self.buckets, v)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += v
+
+    def samples(self, name: str, labels: Dict[str, str]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for b, c in zip(self.buckets, self.counts):
+            cumulative += c
+            lines.append("{}_bucket{} {}".format(name, _labels(OrderedDict(labels, le=_value(float(b)))), cumulative))
+        lines.append("{}_bucket{} {}".format(name, _labels(OrderedDict(labels, le="+Inf")), self.count))
+        lines.append("{}_sum{} {}".format(name, _labels(labels), _value(self.sum)))
+        lines.append("{}_count{} {}".format(name, _labels(labels), self.count))
+        return lines
+
+
+class StationMetrics:
+    def __init__(self, station: 'Station', clock=time.monotonic):
+        """
+        :param station: the station (the metrics listen to its stage changes)
+        :param clock: clock function in seconds
+        """
+        self._station = station
+        self._clock = clock
+        self._lock = Lock()
+        self._stack: List[Tuple[str, float]] = []
+        self.commands: Dict[str, Histogram] = OrderedDict()
+        self.tips: Dict[str, int] = OrderedDict()
+        self.drops = 0
+        self.pauses: Dict[str, int] = OrderedDict()
+        self.pause_seconds: Dict[str, float] = OrderedDict()
+        self.stage_seconds: Dict[str, float] = OrderedDict()
+        self._stage: Optional[str] = None
+        self._stage_start = clock()
+        station._stage_listeners.append(self.on_stage)
+
+    def on_stage(self, index: int, stage: str):
+        t = self._clock()
+        with self._lock:
+            if self._stage is not None:
+                self.stage_seconds[self._stage] = self.stage_seconds.get(self._stage, 0.) + t - self._stage_start
+            self._stage = stage
+            self._stage_start = t
+
+    def __call__(self, record: dict):
+        t = self._clock()
+        if record.get('$') == 'before':
+            self._stack.append((record.get('name'), t))
+            return
+        if record.get('$') != 'after' or not self._stack:
+            return
+        name, start = self._stack.pop()
+        with self._lock:
+            self.commands.setdefault(name, Histogram()).observe(t - start)
+            if name == command_types.PICK_UP_TIP:
+                payload = record.get('payload', {})
+                loc = payload.get('location', None)
+                loc = getattr(loc, 'labware', loc)
+                loc = getattr(loc, 'object', loc)
+                rack = str(getattr(loc, 'parent', loc))
+                self.tips[rack] = self.tips.get(rack, 0) + getattr(payload.get('instrument', None), 'channels', 1)
+            elif name == command_types.DROP_TIP:
+                self.drops += 1
+
+    def pause(self, reason: str, seconds: float):
+        with self._lock:
+            self.pauses[reason] = self.pauses.get(reason, 0) + 1
+            self.pause_seconds[reason] = self.pause_seconds.get(reason, 0.) + seconds
+
+    def _gauges(self) -> List[Tuple[str, str, Dict[str, str], float]]:
+        s = self._station
+        gauges = [
+            ("stage_index", "Index of the current stage", {}, getattr(s, "_stage_index", 0)),
+            ("stage_elapsed_seconds", "Time elapsed in the current stage", {"stage": self._stage or ""}, self._clock() - self._stage_start),
+            ("trash_tips", "Tips in the trash since it was last emptied", {}, getattr(s, "_drop_count", 0)),
+        ]
+        allocator = getattr(s, "_tip_allocator", None)
+        if allocator is not None:
+            for t in allocator.tips:
+                gauges.append(("tips_remaining", "Tips left in the tipracks", {"tiprack": t}, allocator.remaining(t)))
+        temp = s.temperature()
+        if temp is not None:
+            gauges.append(("temperature_celsius", "Temperature module reading", {}, temp))
+        return gauges
+
+    def exposition(self) -> str:
+        """Metrics in the Prometheus plain-text exposition format"""
+        lines = []
+
+        def family(name: str, kind: str, doc: str):
+            lines.append("# HELP {}_{} {}".format(PREFIX, name, doc))
+            lines.append("# TYPE {}_{} {}".format(PREFIX, name, kind))
+
+        with self._lock:
+            stage_seconds = dict(self.stage_seconds)
+            if self._stage is not None:
+                stage_seconds[self._stage] = stage_seconds.get(self._stage, 0.) + self._clock() - self._stage_start
+            family("command_duration_seconds", "histogram", "Duration of the commands executed, by type")
+            for name, h in self.commands.items():
+                lines += h.samples("{}_command_duration_seconds".format(PREFIX), {"type": name})
+            family("tips_picked_total", "counter", "Tips picked up, by rack")
+            lines += ["{}_tips_picked_total{} {}".format(PREFIX, _labels({"rack": k}), v) for k, v in self.tips.items()]
+            family("tip_drops_total", "counter", "Tip drops")
+            lines.append("{}_tip_drops_total {}".format(PREFIX, self.drops))
+            family("pauses_total", "counter", "Pauses and delays, by reason")
+            lines += ["{}_pauses_total{} {}".format(PREFIX, _labels({"reason": k}), v) for k, v in self.pauses.items()]
+            family("pause_seconds_total", "counter", "Time spent in pauses and delays, by reason")
+            lines += ["{}_pause_seconds_total{} {}".format(PREFIX, _labels({"reason": k}), _value(v)) for k, v in self.pause_seconds.items()]
+            family("stage_seconds_total", "counter", "Time spent in each stage")
+            lines += ["{}_stage_seconds_total{} {}".format(PREFIX, _labels({"stage": k}), _value(v)) for k, v in stage_seconds.items()]
+        last = None
+        for name, doc, labels, v in self._gauges():
+            if name != last:
+                family(name, "gauge", doc)
+                last = name
+            lines.append("{}_{}{} {}".format(PREFIX, name, _labels(labels), _value(v)))
+        return "\n".join(lines) + "\n"
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
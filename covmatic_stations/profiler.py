@@ -0,0 +1,106 @@
+"""Execution profiler for the stations.
+Times the commands published on the broker of the protocol context, tagging each with the current stage.
+At the end of the run it can write a summary table and a trace in the Chrome trace-event format
+(open it in chrome://tracing or https://ui.perfetto.dev)."""
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+import json
+import time
+
+
+class CommandProfiler:
+    def __init__(self, station: 'Station', clock: Callable[[], float] = time.perf_counter):
+        """
+        :param station: the station (the profiler listens to its stage changes)
+        :param clock: clock function in seconds
+        """
+        self._station = station
+        self._clock = clock
+        self._t0 = clock()
+        self._stack: List[list] = []
+        self.commands: Dict[str, dict] = OrderedDict()
+        self.stages: Dict[str, dict] = OrderedDict()
+        self.events: List[dict] = []
+        self._stage: Optional[str] = None
+        self._stage_start = self._t0
+        station._stage_listeners.append(self.on_stage)
+
+    def _us(self, t: float) -> float:
+        return round(1e6 * (t - self._t0), 1)
+
+    def on_stage(self, index: int, stage: str):
+        self._close_stage(self._clock())
+        self._stage = stage
+
+    def _close_stage(self, t: float):
+        if self._stage is not None:
+            s = self.stages.setdefault(self._stage, {"runs": 0, "wall": 0., "commands": 0})
+            s["runs"] += 1
+            s["wall"] += t - self._stage_start
+            self.events.append({"name": self._stage, "cat": "stage", "ph": "X", "ts": self._us(self._stage_start), "dur": round(1e6 * (t - self._stage_start), 1), "pid": 1, "tid": 0})
+        self._stage_start = t
+
+    def __call__(self, record: dict):
+        t = self._clock()
+        if record.get('$') == 'before':
+            # name, start time, stage, time spent in nested commands
+            self._stack.append([record.get('name'), t, self._station.stage, 0.])
+        elif record.get('$') == 'after' and self._stack:
+            name, start, stage, nested = self._stack.pop()
+            dur = t - start
+            if self._stack:
+                self._stack[-1][3] += dur
+            c = self.commands.setdefault(name, {"count": 0, "total": 0., "self": 0., "max": 0.})
+            c["count"] += 1
+            c["total"] += dur
+            c["self"] += dur - nested
+            c["max"] = max(c["max"], dur)
+            if stage is not None:
+                self.stages.setdefault(stage, {"runs": 0, "wall": 0., "commands": 0})["commands"] += 1
+            payload = record.get('payload', {})
+            try:
+                text = payload.get('text', '').format(**payload)
+            except (KeyError, IndexError, ValueError):
+                text = payload.get('text', '')
+            self.events.append({"name": name, "cat": "command", "ph": "X", "ts": self._us(start), "dur": round(1e6 * dur, 1), "pid": 1, "tid": 1, "args": {"stage": stage, "text": text}})
+
+    def finish(self):
+        """Close the current stage"""
+        self._close_stage(self._clock())
+        self._stage = None
+
+    def summary(self) -> str:
+        """Table of the time spent per command type (total and excluding nested commands) and per stage"""
+        lines = ["{:<28}{:>8}{:>12}{:>12}{:>12}{:>12}".format("command", "count", "total [s]", "self [s]", "mean [s]", "max [s]")]
+        for name, c in sorted(self.commands.items(), key=lambda x: -x[1]["self"]):
+            lines.append("{:<28}{:>8}{:>12.2f}{:>12.2f}{:>12.3f}{:>12.3f}".format(name, c["count"], c["total"], c["self"], c["total"] / c["count"], c["max"]))
+        lines.append("")
+        lines.append("{:<52}{:>8}{:>12}".format("stage", "commands", "wall [s]"))
+        for name, s in self.stages.items():
+            lines.append("{:<52}{:>8}{:>12.2f}".format(name[:51], s["commands"], s["wall"]))
+        lines.append("{:<52}{:>8}{:>12.2f}".format("total", sum(s["commands"] for s in self.stages.values()), sum(s["wall"] for s in self.stages.values())))
+        return "\n".join(lines)
+
+    def trace(self) -> dict:
+        return {
+            "traceEvents": [
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "stages"}},
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "commands"}},
+            ] + self.events,
+            "displayTimeUnit": "ms",
+        }
+
+    def write(self, trace_filepath: str, summary_filepath: Optional[str] = None):
+        """Write the trace (and the summary table) to file"""
+        with open(trace_filepath, "w") as f:
+            json.dump(self.trace(), f)
+        if summary_filepath is not None:
+            with open(summary_filepath, "w") as f:
+                f.write(self.summary())
+                f.write("\n")
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
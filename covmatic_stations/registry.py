@@ -0,0 +1,165 @@
+"""Registries of settings read from JSON files (e.g. the magnet heights and the Copan 48 correction).
+A registry has a packaged file and, optionally, an environment variable with the path of a custom file
+that replaces it. Registries created with `layered=True` layer the custom file over the packaged one instead:
+lookups search the custom file first and fall back to the packaged one.
+Files are parsed once and parsed again only when they change (modification time or size),
+as are the indexes built from them, so that lookups cost a `stat` of the files."""
+from collections import namedtuple
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import json
+import os
+
+
+class JsonFile:
+    def __init__(self, filepath: str):
+        """
+        :param filepath: path of the JSON file
+        """
+        self.filepath = filepath
+        self._lock = Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._data: Any = None
+
+    def stamp(self) -> Tuple[int, int]:
+        st = os.stat(self.filepath)
+        return st.st_mtime_ns, st.st_size
+
+    def load(self) -> Tuple[Tuple[int, int], Any]:
+        """Parsed content of the file, parsed again if the file changed since the last time
+        :returns: the stamp of the file and its content"""
+        stamp = self.stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                with open(self.filepath, "r") as f:
+                    self._data = json.load(f)
+                self._stamp = stamp
+            return self._stamp, self._data
+
+
+_files: Dict[str, JsonFile] = {}
+
+
+def json_file(filepath: str) -> JsonFile:
+    """The cached JSON file for the path (shared by all registries)"""
+    filepath = os.path.abspath(filepath)
+    f = _files.get(filepath, None)
+    if f is None:
+        f = _files.setdefault(filepath, JsonFile(filepath))
+    return f
+
+
+class LayeredJsonRegistry:
+    def __init__(self, filepath: str, env_key: Optional[str] = None, layered: bool = False):
+        """
+        :param filepath: path of the packaged JSON file
+        :param env_key: environment variable with the path of a custom JSON file, replacing the packaged one
+        :param layered: layer the custom file over the packaged one, instead of replacing it
+        """
+        self.filepath = filepath
+        self.env_key = env_key
+        self.layered = layered
+        self._derived: Dict[str, Tuple[tuple, Any]] = {}
+
+    @property
+    def filepaths(self) -> List[str]:
+        """Paths of the layers, from the custom file to the packaged one (only the custom file, if set and not layered)"""
+        custom = os.environ.get(self.env_key, None) if self.env_key else None
+        if custom is None or custom == self.filepath:
+            return [self.filepath]
+        return [custom, self.filepath] if self.layered else [custom]
+
+    def layers(self) -> Tuple[tuple, List[Any]]:
+        """Contents of the layers, from the custom file to the packaged one
+        :returns: the stamps of the files and their contents"""
+        loaded = [(fp, json_file(fp).load()) for fp in self.filepaths]
+        return tuple((fp, stamp) for fp, (stamp, _) in loaded), [data for _, (_, data) in loaded]
+
+    def derived(self, name: str, build: Callable[[List[Any]], Any]) -> Any:
+        """Value built from the layers, built again only if a file changed
+        :param name: name of the value
+        :param build: function building the value from the contents of the layers"""
+        key, layers = self.layers()
+        cached = self._derived.get(name, None)
+        if cached is None or cached[0] != key:
+            cached = self._derived[name] = (key, build(layers))
+        return cached[1]
+
+    def merged(self) -> dict:
+        """Layers of objects merged, keys of the custom file first"""
+        def build(layers: List[dict]) -> dict:
+            d = {}
+            for layer in reversed(layers):
+                d.update(layer)
+            return d
+        return self.derived("merged", build)
+
+
+class RecordRegistry(LayeredJsonRegistry):
+    """Registry of records (arrays of objects), indexed by some of their fields"""
+    def __init__(self, filepath: str, env_key: Optional[str] = None, keys: Iterable[str] = (), indexes: Iterable[str] = (), layered: bool = False):
+        """
+        :param filepath: path of the packaged JSON file
+        :param env_key: environment variable with the path of a custom JSON file, replacing the packaged one
+        :param keys: fields that identify a record (when layered, records of the custom file replace those with the same values)
+        :param indexes: other fields to look records up by, that do not identify them (e.g. a setting shared by several records)
+        :param layered: layer the custom file over the packaged one, instead of replacing it
+        """
+        super(RecordRegistry, self).__init__(filepath, env_key, layered)
+        self.keys = tuple(keys)
+        self.indexes = tuple(i for i in indexes if i not in self.keys)
+        self._getter_c = namedtuple("getter", list(map("by_{}".format, self.keys + self.indexes)))
+
+    @staticmethod
+    def _kept(index: Dict[str, Dict[Any, dict]], r: dict) -> bool:
+        # Whether the record is not replaced by another one with the same key values
+        return all(idx.get(r.get(k, None), r) is r for k, idx in index.items())
+
+    def index(self) -> Dict[str, Dict[Any, dict]]:
+        """Records by the value of each key field and of each index field"""
+        def build(layers: List[List[dict]]) -> Dict[str, Dict[Any, dict]]:
+            index = {k: {} for k in self.keys}
+            for layer in reversed(layers):
+                for r in layer:
+                    for k in self.keys:
+                        if k in r:
+                            index[k][r[k]] = r
+            # Replaced records are not found by any field, not even by the keys they do not share
+            kept = [r for layer in reversed(layers) for r in layer if self._kept(index, r)]
+            lookup = {k: {} for k in self.keys + self.indexes}
+            for r in kept:
+                for k in lookup:
+                    if k in r:
+                        lookup[k][r[k]] = r
+            return lookup
+        return self.derived("index", build)
+
+    @property
+    def specs(self) -> List[dict]:
+        """Records of all the layers, excluding those replaced by the custom file"""
+        def build(layers: List[List[dict]]) -> List[dict]:
+            index = self.index()
+            keys = {k: index[k] for k in self.keys}
+            return [r for layer in layers for r in layer if self._kept(keys, r)]
+        return self.derived("specs", build)
+
+    def get(self, value, by: str, field: str, default=None):
+        """Field of the record with the specified key value
+        :param value: the key value
+        :param by: the key field
+        :param field: the field to read
+        :param default: value returned if there is no such record"""
+        r = self.index()[by].get(value, None)
+        return default if r is None else r.get(field, default)
+
+    def getter(self, field: str):
+        """Field of the records by each key and index field, e.g. `getter("height").by_serial[serial]`"""
+        return self.derived("getter_{}".format(field), lambda layers: self._getter_c(**{
+            "by_{}".format(k): {v: r[field] for v, r in idx.items() if field in r} for k, idx in self.index().items()
+        }))
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -1,21 +1,32 @@
+from .status import DEFAULT_BLOCK_SIZE, StatusBlock, StatusBlockReader, StatusSnapshot, StatusSource
 from opentrons.protocol_api import ProtocolContext
-from typing import Callable, Optional
-from threading import Thread
+from functools import partial
+from multiprocessing.connection import Connection
+from typing import Optional
+from threading import Event, Lock, Thread
 import cherrypy
-import datetime
-import copy
+import hmac
 import json
+import multiprocessing
 import time
 import os
 import ipaddress
 
 
+# Exceptions raised again as such by the operations forwarded from a child process
+REMOTE_ERRORS = {e.__name__: e for e in (PermissionError, ValueError)}
+# Maximum time a long poll (or an event stream, between keep-alives) waits for a change before answering
+MAX_WAIT = 60
+
+
 DEFAULT_REST_KWARGS = dict(
     favicon_url="https://opentrons.com/icons/icon-48x48.png",
     config={
         "global": {
             "server.socket_host": "::",
             "server.socket_port": 8080,
+            # Event streams and long polls hold a thread each while waiting
+            "server.thread_pool": 20,
             "engine.autoreload.on": False,
         },
         "/favicon.ico": {
@@ -45,55 +56,246 @@ class StationRESTServer:
         self._icon_url = favicon_url
         self._status = None
     
-    @cherrypy.expose
-    def log(self) -> str:
+    def attach(self, ctx: ProtocolContext, station: 'Station'):
+        """Serve another run"""
+        self._ctx = ctx
+        self._station = station
+        self._status = None
+    
+    @property
+    def _publisher(self) -> StatusSource:
+        if self._station is None:
+            raise cherrypy.HTTPError(503, "no run yet")
+        return self._station._status_publisher
+    
+    @property
+    def _ttl(self) -> float:
+        """Time to live of the module readings"""
+        return self._station._module_cache.ttl
+    
+    def _dispatch(self, method: str, **kwargs):
+        """Run an operation on the station"""
+        if self._station is None:
+            raise cherrypy.HTTPError(503, "no run yet")
+        return getattr(self, "_station_{}".format(method))(**kwargs)
+    
+    def _station_client(self, ip: str) -> bool:
+        """Point the run log to the client and resume the run if it is waiting for the first log
+        :returns: True if the run was resumed"""
         lws_logger = getattr(self._station, "_lws_logger", None)
-        if lws_logger:
-            ip = cherrypy.request.remote.ip
-            try:
-                ip = ipaddress.ip_address(ip)
-            except ValueError:
-                pass
-            else:
-                ipv4 = ip.ipv4_mapped if isinstance(ip, ipaddress.IPv6Address) else None
-                ip = str(ip) if ipv4 is None else str(ipv4)
-                if ip == "::1":
-                    ip = "127.0.0.1"
+        if lws_logger and lws_logger.ip != ip:
             lws_logger.ip = ip
             self._station.logger.debug("Set runlog URL to: {}".format(lws_logger.url))
-        
         if self._station._wait_first_log and self._station._waiting_first_log:
             self._station._ctx.resume()
-            return json.dumps({})
+            return True
+        return False
+    
+    def _station_refresh(self):
+        self._publisher.refresh(self._ttl)
+    
+    def _station_stages(self) -> dict:
+        return {
+            "stages": self._station.stages,
+            "current": getattr(self._station, "_stage_index", 0),
+        }
+    
+    def _station_metrics(self) -> str:
+        metrics = getattr(self._station, "_metrics", None)
+        return "" if metrics is None else metrics.exposition()
+    
+    def _station_pause(self):
+        self._status = "pause"
+        self._ctx.pause()
+        self._station.publish_status()
+    
+    def _station_resume(self):
+        self._status = None
+        self._ctx.resume()
+        self._station.publish_status()
+    
+    def _station_swap(self, slot: Optional[str] = None, tiprack: Optional[str] = None, rack: Optional[str] = None) -> bool:
+        return self._station.swap_tiprack(slot=slot, tiprack=tiprack, rack=rack)
+    
+    def _station_confirm(self) -> int:
+        return self._station.confirm_interventions()
+    
+    def _station_kill(self, delay: float = 1):
+        KillerThread(delay=delay).start()
+    
+    def _authorize(self, token: Optional[str]):
+        expected = getattr(self._station, "_control_token", None)
+        if expected is None:
+            raise PermissionError("run control is disabled")
+        if token is None or not hmac.compare_digest(str(token), str(expected)):
+            raise PermissionError("invalid token")
+    
+    def _station_end_delay(self, token: Optional[str] = None) -> bool:
+        self._authorize(token)
+        return self._station.end_delay()
+    
+    def _station_skip_to(self, stage: str, token: Optional[str] = None) -> str:
+        self._authorize(token)
+        self._station.skip_to(stage)
+        return stage
+    
+    def _station_speed(self, factor: Optional[str] = None, token: Optional[str] = None) -> float:
+        self._authorize(token)
+        if factor is not None:
+            self._station.speed_factor = float(factor)
+        return self._station.speed_factor
+    
+    def _client(self, ip: str) -> bool:
+        return self._dispatch("client", ip=ip)
+    
+    @cherrypy.expose
+    def log(self, fields: Optional[str] = None, version: Optional[str] = None, timeout: str = '25') -> bytes:
+        """Latest status snapshot of the station. Conditional requests (If-None-Match) get a 304 if it has not changed
+        :param fields: comma-separated names of the fields to return (default: all)
+        :param version: long poll: wait for a snapshot with a version other than this one
+        :param timeout: long poll: maximum time to wait in seconds"""
+        # The body is returned encoded: CherryPy only encodes text/* bodies
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        ip = cherrypy.request.remote.ip
+        try:
+            ip = ipaddress.ip_address(ip)
+        except ValueError:
+            pass
+        else:
+            ipv4 = ip.ipv4_mapped if isinstance(ip, ipaddress.IPv6Address) else None
+            ip = str(ip) if ipv4 is None else str(ipv4)
+            if ip == "::1":
+                ip = "127.0.0.1"
+        if self._client(ip):
+            return json.dumps({}).encode()
         
-        status = getattr(self._station, "status", None)
-        tip_log = copy.deepcopy(getattr(self._station, "_tip_log", {}))
-        if "tips" in tip_log:
-            del tip_log["tips"]
-        return json.dumps({
-            "status": status if status == "finished" or self._status is None else self._status,
-            "stage": getattr(self._station, "stage", None),
-            "msg": getattr(self._station, "msg", None),
-            "external": getattr(self._station, "external", False),
-            "time": datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S:%f"),
-            "temp": getattr(getattr(self._station, "_tempdeck", None), "temperature", None),
-            "tips": tip_log,
-            "runlog": self._station._log_filepath,
-        }, indent=2)
+        publisher = self._publisher
+        if version is not None:
+            self._wait(int(version), min(float(timeout), MAX_WAIT))
+        publisher.refresh(self._ttl)
+        fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        etag = publisher.etag(fields)
+        cherrypy.response.headers["ETag"] = etag
+        if etag in (t.strip() for t in cherrypy.request.headers.get("If-None-Match", "").split(",")):
+            cherrypy.response.status = 304
+            return b""
+        return publisher.body(fields).encode()
+    
+    def _wait(self, version: int, timeout: float) -> StatusSnapshot:
+        """Wait for a snapshot with a version other than the specified one, refreshing the module readings meanwhile"""
+        publisher = self._publisher
+        ttl = self._ttl
+        t = time.monotonic() + timeout
+        snapshot = publisher.refresh(ttl)
+        while snapshot.version == version and time.monotonic() < t:
+            snapshot = publisher.wait(version, min(ttl, t - time.monotonic()))
+            if snapshot.version == version:
+                snapshot = publisher.refresh(ttl)
+        return snapshot
+    
+    @cherrypy.expose
+    def events(self, fields: Optional[str] = None, keepalive: str = '15'):
+        """Stream of Server-Sent Events: a 'snapshot' event with the whole status, then an 'update' event
+        with the changed fields (stage, message, pauses, tips, temperature...) whenever the status changes.
+        Event ids are the snapshot ETags: a reconnecting client that is up to date (Last-Event-ID) does not get the snapshot again
+        :param fields: comma-separated names of the fields to stream (default: all)
+        :param keepalive: seconds between keep-alive comments when nothing changes"""
+        cherrypy.response.headers["Content-Type"] = "text/event-stream"
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        cherrypy.response.headers["X-Accel-Buffering"] = "no"
+        fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        last_id = cherrypy.request.headers.get("Last-Event-ID", None)
+        keepalive = min(float(keepalive), MAX_WAIT)
+        publisher = self._publisher
+        
+        def select(data) -> dict:
+            return {k: data[k] for k in (fields or data.keys()) if k in data and k not in ("time", "version")}
+        
+        def stream():
+            snapshot = publisher.refresh(self._ttl)
+            previous = select(snapshot.data)
+            if last_id is None or last_id.strip('"') != snapshot.etag.strip('"'):
+                yield "event: snapshot\nid: {}\ndata: {}\n\n".format(snapshot.etag.strip('"'), json.dumps(dict(previous, version=snapshot.version)))
+            while snapshot.data["status"] != "finished" and cherrypy.engine.state == cherrypy.engine.states.STARTED:
+                version = snapshot.version
+                snapshot = self._wait(version, keepalive)
+                data = select(snapshot.data)
+                changed = {k: v for k, v in data.items() if previous.get(k, None) != v}
+                previous = data
+                if changed:
+                    yield "event: update\nid: {}\ndata: {}\n\n".format(snapshot.etag.strip('"'), json.dumps(dict(changed, version=snapshot.version)))
+                else:
+                    yield ": keep-alive\n\n"
+        
+        return stream()
+    events._cp_config = {"response.stream": True}
+    
+    @cherrypy.expose
+    def stages(self) -> str:
+        """Ordered catalogue of the stages of the protocol and the index of the current one"""
+        return json.dumps(self._dispatch("stages"))
+    
+    @cherrypy.expose
+    def metrics(self) -> str:
+        """Counters, histograms and gauges of the run in the Prometheus plain-text format"""
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return self._dispatch("metrics")
     
     @cherrypy.expose
     def pause(self):
-        self._status = "pause"
-        self._ctx.pause()
+        self._dispatch("pause")
     
     @cherrypy.expose
     def resume(self):
-        self._status = None
-        self._ctx.resume()
+        self._dispatch("resume")
+    
+    @cherrypy.expose
+    def swap(self, slot: Optional[str] = None, tiprack: Optional[str] = None, rack: Optional[str] = None) -> str:
+        """Confirm that an empty tip rack has been replaced (identified by slot, or by tiprack name and rack index)"""
+        try:
+            return json.dumps({"swapped": self._dispatch("swap", slot=slot, tiprack=tiprack, rack=rack)})
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+    
+    @cherrypy.expose
+    def confirm(self) -> str:
+        """Confirm the interventions requested during the current delay"""
+        return json.dumps({"confirmed": self._dispatch("confirm")})
     
     @cherrypy.expose
     def kill(self, delay: str = '1'):
-        KillerThread(delay=float(delay)).start()
+        self._dispatch("kill", delay=float(delay))
+    
+    def _control(self, method: str, key: str, token: Optional[str] = None, **kwargs) -> str:
+        """Run a run-control operation, authorized by the token in the X-Control-Token header (or parameter)"""
+        token = cherrypy.request.headers.get("X-Control-Token", token)
+        try:
+            return json.dumps({key: self._dispatch(method, token=token, **kwargs)})
+        except PermissionError as e:
+            raise cherrypy.HTTPError(403, str(e))
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+    
+    @cherrypy.expose
+    def end_delay(self, token: Optional[str] = None) -> str:
+        """End the current delay early"""
+        return self._control("end_delay", "ended", token)
+    
+    @cherrypy.expose
+    def skip_to(self, stage: str, token: Optional[str] = None) -> str:
+        """Skip forward to a later stage, from the next stage boundary"""
+        return self._control("skip_to", "stage", token, stage=stage)
+    
+    @cherrypy.expose
+    def speed(self, factor: Optional[str] = None, token: Optional[str] = None) -> str:
+        """Set the multiplier of the gantry speed and of the flow rates, from the next command (and return it)"""
+        return self._control("speed", "factor", token, factor=factor)
+    
+    def serve(self):
+        favicon = (self._config or {}).get("/favicon.ico", {}).get("tools.staticfile.filename", None)
+        if self._icon_url and favicon and not os.path.isfile(favicon):
+            os.system("wget {} -O {}".format(self._icon_url, favicon))
+        cherrypy.quickstart(self, config=self._config)
 
     @staticmethod
     def stop():
@@ -102,9 +304,7 @@ class StationRESTServer:
 
 class StationRESTServerThread(StationRESTServer, Thread):
     def run(self):
-        if self._icon_url and self._config and "tools.staticfile.filename" in self._config.get("/favicon.ico", {}):
-            os.system("wget {} -O {}".format(self._icon_url, self._config["/favicon.ico"]["tools.staticfile.filename"]))
-        cherrypy.quickstart(self, config=self._config)
+        self.serve()
     
     def join(self, timeout=None, after: float = 0):
         if after:
@@ -113,6 +313,129 @@ class StationRESTServerThread(StationRESTServer, Thread):
         super(StationRESTServerThread, self).join(timeout=timeout)
 
 
+class RemoteStationRESTServer(StationRESTServer):
+    """REST server running in a child process: it serves the status from the shared block
+    and forwards the operations on the station to the protocol process through a pipe"""
+    def __init__(self, block_filepath: str, conn: Connection, ttl: float, config: Optional[dict] = None, favicon_url: Optional[str] = None):
+        """
+        :param block_filepath: path of the status block
+        :param conn: connection to the protocol process
+        :param ttl: time to live of the module readings
+        """
+        super(RemoteStationRESTServer, self).__init__(None, config=config, favicon_url=favicon_url)
+        self._conn = conn
+        self._lock = Lock()
+        self._module_ttl = ttl
+        self._reader = StatusBlockReader(StatusBlock(block_filepath), request_refresh=partial(self._send, "refresh"))
+        self._ip = None
+    
+    @property
+    def _publisher(self) -> StatusSource:
+        return self._reader
+    
+    @property
+    def _ttl(self) -> float:
+        return self._module_ttl
+    
+    def _send(self, method: str, reply: bool = False, **kwargs):
+        with self._lock:
+            self._conn.send((method, kwargs, reply))
+            if reply:
+                return self._conn.recv()
+    
+    def _dispatch(self, method: str, **kwargs):
+        ok, result = self._send(method, reply=True, **kwargs)
+        if not ok:
+            name, msg = result
+            # Errors that endpoints turn into HTTP errors are raised as such, the others as runtime errors
+            raise REMOTE_ERRORS.get(name, RuntimeError)("{}: {}".format(name, msg) if name not in REMOTE_ERRORS else msg)
+        return result
+    
+    def _client(self, ip: str) -> bool:
+        # Only bother the protocol process when something has to be done
+        self._reader.current
+        if ip == self._ip and not self._reader.flags & StatusBlock.WAITING_FIRST_LOG:
+            return False
+        self._ip = ip
+        return self._dispatch("client", ip=ip)
+
+
+def _serve_remote(parent_pid: int, *args, **kwargs):
+    server = RemoteStationRESTServer(*args, **kwargs)
+    
+    def watch_parent():
+        # Stop when the protocol process dies (e.g. killed)
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        server.stop()
+    
+    Thread(target=watch_parent, daemon=True).start()
+    server.serve()
+
+
+class StationRESTServerProcess(StationRESTServer):
+    """REST server running in a child process, so that request handling does not compete with the protocol for the GIL.
+    The status is published to a shared-memory block; the operations on the station come back through a pipe"""
+    def __init__(self, ctx: ProtocolContext, station: Optional['Station'] = None, config: Optional[dict] = None, favicon_url: Optional[str] = None, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        :param block_size: size of the status block in bytes
+        """
+        super(StationRESTServerProcess, self).__init__(ctx, station, config, favicon_url)
+        self._block = StatusBlock.create(block_size)
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.get_context("spawn").Process(
+            target=_serve_remote,
+            args=(os.getpid(), self._block.filepath, child_conn, self._ttl, config, favicon_url),
+            daemon=True,
+        )
+        self._listener = Thread(target=self._listen, daemon=True)
+        self._writer = Thread(target=self._write_snapshots, daemon=True)
+        self._stopped = Event()
+    
+    def _write(self, snapshot: StatusSnapshot):
+        try:
+            self._block.write(snapshot, StatusBlock.WAITING_FIRST_LOG if self._station._waiting_first_log else 0)
+        except ValueError as e:
+            self._station.logger.warning(str(e))
+    
+    def _write_snapshots(self):
+        # Snapshots are built and serialized in this thread, not in the protocol thread that publishes them
+        version = None
+        while not self._stopped.is_set():
+            snapshot = self._publisher.wait(version, 0.5)
+            if snapshot.version != version:
+                self._write(snapshot)
+                version = snapshot.version
+    
+    def _listen(self):
+        while True:
+            try:
+                method, kwargs, reply = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                result = (True, self._dispatch(method, **kwargs))
+            except Exception as e:
+                result = (False, (type(e).__name__, str(e)))
+            if reply:
+                self._conn.send(result)
+    
+    def start(self):
+        self._writer.start()
+        self._process.start()
+        self._listener.start()
+    
+    def join(self, timeout=None, after: float = 0):
+        if after:
+            time.sleep(after)
+        self._process.terminate()
+        self._process.join(timeout)
+        self._conn.close()
+        self._stopped.set()
+        self._writer.join(timeout)
+        self._block.close(unlink=True)
+
+
 # Copyright (c) 2020 Covmatic.
 # Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
 # The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
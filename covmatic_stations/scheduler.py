@@ -0,0 +1,89 @@
+from collections import namedtuple
+from typing import List
+import time
+
+
+Intervention = namedtuple("Intervention", ["kind", "target", "msg", "racks"])
+
+
+class PauseScheduler:
+    """Pulls operator interventions that will soon be needed (trash emptying, tip refills, rack swaps)
+    forward into pauses and delays that are already scheduled, instead of stopping the robot for each of them"""
+    def __init__(self, station: 'Station', threshold: float):
+        """
+        :param station: the station
+        :param threshold: fraction of the trash capacity (or of the tips of a tiprack) used after which the intervention is anticipated
+        """
+        self._station = station
+        self._threshold = threshold
+        self.log: List[dict] = []
+        self._requested: List[Intervention] = []
+
+    def due(self) -> List[Intervention]:
+        """Interventions that are needed (or will be needed soon)"""
+        s = self._station
+        items = []
+        if s._drop_count and s._drop_count >= self._threshold * s._drop_threshold:
+            items.append(Intervention("empty tips", None, s.get_msg("empty tips"), ()))
+        allocator = getattr(s, "_tip_allocator", None)
+        if allocator is not None:
+            for t in allocator.tips:
+                # Only the empty racks and the one in use are replaced: the full ones keep their tips
+                racks = sorted(allocator.depleted[t])
+                if allocator.remaining(t) <= (1 - self._threshold) * allocator.max[t]:
+                    current = allocator.current(t)
+                    if current is not None:
+                        racks = sorted(set(racks) | {current})
+                    items.append(Intervention("refill tips", t, s.get_msg_format("refill tips", "\n".join(str(getattr(s, t)[r]) for r in racks)), tuple(racks)))
+                elif racks:
+                    items.append(Intervention("swap tiprack", t, s.get_msg_format("refill tips", "\n".join(str(getattr(s, t)[r]) for r in racks)), tuple(racks)))
+        return items
+
+    def request(self, into: str) -> str:
+        """Collect the due interventions for the upcoming pause or delay
+        :param into: the message of the pause or delay
+        :returns: the message to show the operator (empty if nothing is due)"""
+        self._requested = self.due()
+        for i in self._requested:
+            self.log.append({
+                "kind": i.kind,
+                "target": i.target,
+                "racks": list(i.racks),
+                "into": into,
+                "stage": self._station.stage,
+                "time": time.time(),
+                "done": False,
+            })
+            self._station.logger.info("merging '{}'{} into '{}'".format(i.kind, "" if i.target is None else " ({})".format(i.target), into))
+        return "\n".join(i.msg for i in self._requested)
+
+    def confirm(self) -> int:
+        """The operator performed the requested interventions
+        :returns: the number of interventions confirmed"""
+        s = self._station
+        n = len(self._requested)
+        for i in self._requested:
+            if i.kind == "empty tips":
+                s._drop_count = 0
+            elif i.kind == "refill tips":
+                for r in i.racks:
+                    s._tip_allocator.replace(i.target, r)
+            elif i.kind == "swap tiprack":
+                for r in i.racks:
+                    s._tip_allocator.refill(i.target, r)
+        for e in self.log[len(self.log) - n:]:
+            e["done"] = True
+        if any(i.kind != "empty tips" for i in self._requested):
+            s.track_tip()
+        self._requested = []
+        return n
+
+    def discard(self):
+        """The pause or delay ended without confirmation: the interventions will be requested again later"""
+        self._requested = []
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,245 @@
+"""Content-addressed on-disk cache of simulation results.
+Results are keyed by a hash of everything a simulation depends on:
+the source and data files of the whole package (any module can change the behaviour of a station),
+the constructor arguments of the station resolved against the defaults, the message catalogue,
+the custom files (magnet heights, files passed as arguments), the simulation engine and the installed Opentrons version.
+Each entry stores the command log, the stage list and the tip/volume summary.
+The least recently used entries are evicted when the cache exceeds its size limit."""
+from . import __version__, messages
+from .utils import command_types
+from collections import Counter, OrderedDict
+from typing import List, Optional, Union
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import time
+
+
+default_folder = os.environ.get("COVMATIC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "covmatic_stations", "simulations"))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Constructor arguments that do not affect the simulation results
+IGNORED_KWARGS = ("logger",)
+_package_folder = os.path.dirname(__file__)
+# Extensions of the package files that are part of the key (modules, labware definitions and settings)
+PACKAGE_EXTENSIONS = (".py", ".json")
+
+
+def _file_digest(filepath: str) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def package_files(folder: str = _package_folder) -> List[str]:
+    """Source and data files of the package, sorted"""
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        files += [os.path.join(root, n) for n in names if n.endswith(PACKAGE_EXTENSIONS)]
+    return sorted(files)
+
+
+def _opentrons_version() -> str:
+    try:
+        import opentrons
+        return str(getattr(opentrons, "__version__", ""))
+    except ImportError:
+        return ""
+
+
+def resolved_kwargs(cls: type, kwargs: dict) -> dict:
+    """Constructor arguments merged over the defaults of the `__init__` methods along the MRO"""
+    resolved = {}
+    for c in reversed(cls.__mro__):
+        init = vars(c).get("__init__", None)
+        if init is None:
+            continue
+        for name, p in inspect.signature(init).parameters.items():
+            if p.default is not inspect.Parameter.empty:
+                resolved[name] = p.default
+    resolved.update(kwargs)
+    return {k: v for k, v in resolved.items() if k not in IGNORED_KWARGS}
+
+
+def fingerprint(cls: type, kwargs: dict, engine: str = "simulator") -> str:
+    """Content hash of a simulation
+    :param cls: the station class
+    :param kwargs: keyword arguments for the station constructor
+    :param engine: the simulation engine"""
+    kw = resolved_kwargs(cls, kwargs)
+    data = [os.environ.get("OT_MAGNET_JSON", "")] + [v for v in kw.values() if isinstance(v, str) and os.path.isfile(v)]
+    content = {
+        "class": "{}.{}".format(cls.__module__, cls.__qualname__),
+        "kwargs": json.dumps(kw, sort_keys=True, default=str),
+        "sources": {os.path.relpath(s, _package_folder): _file_digest(s) for s in package_files()},
+        "data": {os.path.basename(d): _file_digest(d) for d in data if os.path.isfile(d)},
+        "messages": hashlib.sha256(json.dumps(messages.raw(), sort_keys=True).encode()).hexdigest(),
+        "engine": engine,
+        "opentrons": _opentrons_version(),
+        "covmatic_stations": __version__,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class SimulationCache:
+    def __init__(self, folder: str = default_folder, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param folder: folder of the cache entries
+        :param max_bytes: maximum total size of the entries, after which the least recently used ones are evicted
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.folder, "{}.json.gz".format(key))
+
+    def get(self, key: str) -> Optional[dict]:
+        fp = self._filepath(key)
+        try:
+            with gzip.open(fp, "rt") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # Access time is tracked with the modification time, as filesystems may be mounted with noatime
+        os.utime(fp)
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict):
+        os.makedirs(self.folder, exist_ok=True)
+        fp = self._filepath(key)
+        tmp = "{}.{}.tmp".format(fp, os.getpid())
+        with gzip.open(tmp, "wt") as f:
+            json.dump(result, f, default=str)
+        os.replace(tmp, fp)
+        self.evict()
+
+    def entries(self) -> List[os.DirEntry]:
+        """Cache entries, least recently used first"""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted((e for e in os.scandir(self.folder) if e.name.endswith(".json.gz")), key=lambda e: e.stat().st_mtime)
+
+    @property
+    def size(self) -> int:
+        return sum(e.stat().st_size for e in self.entries())
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache fits its size limit
+        :returns: the number of entries removed"""
+        entries = self.entries()
+        size = sum(e.stat().st_size for e in entries)
+        n = 0
+        for e in entries:
+            if size <= self.max_bytes:
+                break
+            size -= e.stat().st_size
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+            n += 1
+        return n
+
+    def clear(self):
+        for e in self.entries():
+            os.remove(e.path)
+
+
+class SimulationRecorder:
+    """Records the commands published on the broker of a context, with tips per rack and volumes per pipette"""
+    def __init__(self):
+        self.commands: List[dict] = []
+        self.tips = Counter()
+        self.volumes = OrderedDict()
+
+    def __call__(self, record: dict):
+        if record.get('$') != 'before':
+            return
+        payload = record.get('payload', {})
+        name = record.get('name')
+        try:
+            text = payload.get('text', '').format(**payload)
+        except (KeyError, IndexError, ValueError):
+            text = payload.get('text', '')
+        self.commands.append({"name": name, "text": text})
+        instr = payload.get('instrument', None)
+        if name == command_types.PICK_UP_TIP:
+            loc = payload.get('location', None)
+            loc = getattr(loc, 'labware', loc)
+            loc = getattr(loc, 'object', loc)
+            self.tips[str(getattr(loc, 'parent', loc))] += getattr(instr, 'channels', 1)
+        elif name in (command_types.ASPIRATE, command_types.DISPENSE):
+            v = self.volumes.setdefault(str(getattr(instr, 'mount', instr)), {"aspirated": 0., "dispensed": 0.})
+            v["aspirated" if name == command_types.ASPIRATE else "dispensed"] += payload.get('volume', 0) or 0
+
+    def summary(self) -> dict:
+        return {
+            "commands": len(self.commands),
+            "tips": dict(self.tips),
+            "volumes": self.volumes,
+            "errors": [],
+        }
+
+
+def record(station: 'Station', engine: str = "simulator") -> dict:
+    """Simulate a station, recording the command log, the stage list and the tip/volume summary"""
+    stages = []
+
+    def on_stage(index: int, stage: str):
+        stages.append(stage)
+
+    station._stage_listeners.append(on_stage)
+    t = time.perf_counter()
+    try:
+        if engine == "dryrun":
+            ctx = station.dry_run()
+            cmds, summary = ctx.commands, ctx.summary()
+        else:
+            from opentrons import simulate
+            ctx = simulate.get_protocol_api((station.metadata or {}).get("apiLevel", "2.3"))
+            recorder = SimulationRecorder()
+            unsubscribe = ctx.broker.subscribe(command_types.COMMAND, recorder)
+            try:
+                station.run(ctx)
+            finally:
+                unsubscribe()
+            cmds, summary = recorder.commands, recorder.summary()
+    finally:
+        station._stage_listeners.remove(on_stage)
+    return {
+        "engine": engine,
+        "commands": cmds,
+        "stages": stages,
+        "summary": summary,
+        "seconds": time.perf_counter() - t,
+    }
+
+
+def simulate(station: 'Station', engine: str = "simulator", cache: Union[SimulationCache, bool, None] = None) -> dict:
+    """Simulate a station, reusing the cached results of an identical simulation if available
+    :param station: the station (its constructor arguments are part of the key)
+    :param engine: 'simulator' for the Opentrons simulator, 'dryrun' for the dry-run engine
+    :param cache: the cache (True for the default one, None or False for no cache)
+    :returns: the command log, the stage list and the tip/volume summary. The 'cached' field tells whether it comes from the cache"""
+    if cache is True:
+        cache = SimulationCache()
+    if not cache:
+        return dict(record(station, engine), cached=False)
+    key = fingerprint(type(station), station._init_kwargs, engine)
+    result = cache.get(key)
+    if result is None:
+        result = record(station, engine)
+        cache.put(key, result)
+        return dict(result, cached=False)
+    return dict(result, cached=True)
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
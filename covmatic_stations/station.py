@@ -1,21 +1,34 @@
-from . import __version__, __file__ as module_path
-from .request import StationRESTServerThread, DEFAULT_REST_KWARGS
-from .utils import ProtocolContextLoggingHandler, LocalWebServerLogger
-from .lights import Button, BlinkingLightHTTP, BlinkingLight
-from opentrons.protocol_api import ProtocolContext
+from . import __version__, messages, setup_logging
+from .utils import ProtocolContextLoggingHandler, LocalWebServerLogger, command_types
+from .lights import Button, HardwareLights, HTTPLights, LightController
+from .tips import TipAllocator
+from .scheduler import PauseScheduler
+from .profiler import CommandProfiler
+from .metrics import StationMetrics
+from .status import StatusPublisher, TTLCache
+from .control import SpeedControl
 from opentrons.types import Point
-from opentrons import commands
 from abc import ABCMeta, abstractmethod
 from functools import wraps, partialmethod
 from itertools import chain
 from opentrons.types import Location
-from typing import Optional, Callable, Tuple
+from threading import Event, Lock, RLock
+from typing import Optional, Callable, List, Tuple, TYPE_CHECKING
+import inspect
 import json
 import math
 import os
 import logging
 import time
 
+if TYPE_CHECKING:
+    from opentrons.protocol_api import ProtocolContext
+    from .request import StationRESTServer
+
+
+# Length in seconds of the slices of the delays that can be ended early
+DELAY_SLICE = 1.
+
 
 def loader(key):
     def loader_(idx: int = 0, *items: tuple) -> Callable:
@@ -38,6 +51,21 @@ labware_loader = loader("_labware_load")
 instrument_loader = loader("_instr_load")
 
 
+def fsync_dir(path: str):
+    """Sync a folder to disk, so that the files renamed into it persist"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # e.g. folders cannot be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def wells(rack):
     return rack.wells()
 
@@ -47,29 +75,55 @@ def first_row(rack):
 
 
 class StationMeta(ABCMeta):
+    _loader_keys = ("_labware_load", "_instr_load")
+    
     def __new__(meta, name, bases, classdict):
         c = super(StationMeta, meta).__new__(meta, name, bases, classdict)
-        try:
-            with open(os.path.join(os.path.dirname(module_path), 'msg', '{}.json'.format(name))) as f:
-                c._messages = json.load(f)
-        except FileNotFoundError:
-            c._messages = {}
+        # Loader methods are collected once per class (overrides without decorator are excluded)
+        c._loaders = {}
+        for key in meta._loader_keys:
+            c._loaders[key] = tuple((n, items) for n, _, items in sorted((
+                (n, *getattr(getattr(c, n), key))
+                for n in dir(c) if hasattr(getattr(c, n, None), key)
+            ), key=lambda x: x[1]))
         return c
     
     def get_message(cls, key: str, lan: str = 'ENG'):
-        for c in cls.__mro__:
-            d = getattr(c, '_messages', {})
-            if key in d:
-                d = d[key]
-                if lan in d:
-                    return d[lan]
-        return key
+        return messages.get_message(cls, key, lan)
 
 
 class Station(metaclass=StationMeta):
     _protocol_description = "[BRIEFLY DESCRIBE YOUR PROTOCOL]"
+    # Attributes saved at each stage and restored when resuming (subclasses add their own)
+    _checkpoint_attrs: Tuple[str, ...] = ("_drop_count", "_side_switch")
+    
+    def __new__(cls, *args, **kwargs):
+        self = super(Station, cls).__new__(cls)
+        # Constructor arguments are kept for dry runs of the same configuration
+        self._init_kwargs = cls._bind_kwargs(self, args, kwargs) if args else kwargs
+        return self
+    
+    @classmethod
+    def _bind_kwargs(cls, self, args: tuple, kwargs: dict) -> dict:
+        """Constructor arguments by name (positional arguments are named after the parameters of `__init__`)"""
+        signature = inspect.signature(cls.__init__)
+        bound = signature.bind(self, *args, **kwargs).arguments
+        named = {}
+        for i, (name, value) in enumerate(bound.items()):
+            kind = signature.parameters[name].kind
+            if kind == inspect.Parameter.VAR_KEYWORD:
+                named.update(value)
+            elif kind == inspect.Parameter.VAR_POSITIONAL:
+                if value:
+                    raise TypeError("{} takes its arguments by keyword, got extra positional arguments {}".format(cls.__name__, value))
+            elif i:
+                named[name] = value
+        return named
     
     def __init__(self,
+        checkpoint_filename: str = 'checkpoint.json',
+        checkpoint_every: int = 1,
+        control_token: Optional[str] = None,
         drop_loc_l: float = 0,
         drop_loc_r: float = 0,
         drop_loc_y: float = 0,
@@ -82,8 +136,13 @@ class Station(metaclass=StationMeta):
         logger: Optional[logging.getLoggerClass()] = None,
         language: str = "ENG",
         metadata: Optional[dict] = None,
+        module_read_ttl: float = 2.0,
         num_samples: int = 96,
-        rest_server_kwargs: dict = DEFAULT_REST_KWARGS,
+        pause_coalesce_threshold: Optional[float] = None,
+        profile_filepath: Optional[str] = '/var/lib/jupyter/notebooks/outputs/profile_{}.json',
+        rest_server_kwargs: Optional[dict] = None,
+        rest_server_process: bool = False,
+        resume: bool = False,
         samples_per_col: int = 8,
         skip_delay: bool = False,
         start_at: Optional[str] = None,
@@ -91,10 +150,18 @@ class Station(metaclass=StationMeta):
         simulation_log_lws: bool = False,
         tip_log_filename: str = 'tip_log.json',
         tip_log_folder_path: str = '/var/lib/jupyter/notebooks/outputs',
+        tip_log_journal: bool = True,
+        tip_log_fsync_every: int = 8,
+        tip_log_compact_every: int = 96,
+        tip_start: Optional[dict] = None,
         tip_track: bool = True,
         wait_first_log: bool = False,
         **kwargs,
     ):
+        self._checkpoint_filename = checkpoint_filename
+        self._checkpoint_every = checkpoint_every
+        self._checkpoint_skipped = 0
+        self._control_token = control_token
         self._drop_loc_l = drop_loc_l
         self._drop_loc_r = drop_loc_r
         self._drop_loc_y = drop_loc_y
@@ -106,30 +173,82 @@ class Station(metaclass=StationMeta):
         self._log_lws_ip = log_lws_ip
         self._log_lws_endpoint = log_lws_endpoint
         self._logger = logger
+        # Handlers added for the current run, removed at its end
+        self._log_handlers: List[Tuple[logging.Logger, logging.Handler]] = []
         self.metadata = metadata
+        self._module_cache = TTLCache(module_read_ttl)
         self._num_samples = num_samples
+        self._pause_scheduler = None if pause_coalesce_threshold is None else PauseScheduler(self, pause_coalesce_threshold)
+        self._profile_filepath = profile_filepath and profile_filepath.format(time.strftime("%Y_%m_%d__%H_%M_%S"))
+        self._profiler: Optional[CommandProfiler] = None
+        self._metrics: Optional[StationMetrics] = None
+        self._lights: Optional[LightController] = None
+        self._stages: Optional[List[dict]] = None
+        self._stages_lock = Lock()
         self._rest_server_kwargs = rest_server_kwargs
+        self._rest_server_process = rest_server_process
+        self._request: Optional['StationRESTServer'] = None
+        self._attached_server = False
+        self._resume = resume
         self._samples_per_col = samples_per_col
         self._start_at = start_at
         self._skip_delay = skip_delay
         self._tip_log_filename = tip_log_filename
         self._tip_log_folder_path = tip_log_folder_path
+        self._tip_log_journal = tip_log_journal
+        self._tip_log_fsync_every = tip_log_fsync_every
+        self._tip_log_compact_every = tip_log_compact_every
+        self._tip_start = tip_start or {}
         self._tip_track = tip_track
-        self._ctx: Optional[ProtocolContext] = None
+        self._tip_journal = None
+        self._tip_journal_records = 0
+        self._tip_journal_unsynced = 0
+        # Guards the tip allocator and the tip log files: racks can be swapped (and interventions confirmed) from the REST server
+        self._tip_lock = RLock()
+        self._ctx: Optional['ProtocolContext'] = None
         self._drop_count = 0
         self._side_switch = True
         self._simulation_log_file = simulation_log_file
         self._simulation_log_lws = simulation_log_lws
         self._wait_first_log = wait_first_log
         self._waiting_first_log = False
+        self._status_publisher = StatusPublisher(self)
         self.status = "initializing"
         self.stage = None
         self._msg = ""
         self.external = False
         self._run_stage = self._start_at is None
+        self._stage_index = 0
+        self._stage_listeners: List[Callable[[int, str], None]] = []
+        self._resume_from: Optional[dict] = None
+        self._skip_to: Optional[str] = None
+        self._speed_control = SpeedControl()
+        self._delay_end = Event()
+        self._delaying = False
+    
+    @property
+    def status(self) -> str:
+        return self._status
+    
+    @status.setter
+    def status(self, value: str):
+        self._status = value
+        self.publish_status()
+    
+    def publish_status(self):
+        """Publish a new snapshot of the status for the REST server"""
+        self._status_publisher.publish()
+    
+    def temperature(self) -> Optional[float]:
+        """Temperature module reading, cached for a short time to limit the queries to the hardware"""
+        tempdeck = getattr(self, "_tempdeck", None)
+        if tempdeck is None:
+            return None
+        return self._module_cache.get("temperature", lambda: tempdeck.temperature)
     
     def set_external(self, value: bool = True) -> bool:
         self.external = value
+        self.publish_status()
         return self.external
     
     set_internal = partialmethod(set_external, value=False)
@@ -147,50 +266,204 @@ class Station(metaclass=StationMeta):
     @msg.setter
     def msg(self, value: str):
         self._msg = self.get_msg(value)
+        self.publish_status()
     
     def msg_format(self, value: str, *args, **kwargs) -> str:
         self._msg = self.get_msg_format(value, *args, **kwargs)
+        self.publish_status()
         return self.msg
     
     def run_stage(self, stage: str) -> bool:
         self.stage = stage
+        self._stage_index += 1
+        for listener in self._stage_listeners:
+            listener(self._stage_index, stage)
+        if self._skip_to is not None:
+            self._run_stage = self._skip_to == self.stage
+            if self._run_stage:
+                self._skip_to = None
         if self._start_at == self.stage:
             self._run_stage = True
+        elif self._resume_from is not None and self._resume_from["stage"] == self.stage and self._stage_index >= self._resume_from["index"]:
+            self.restore_checkpoint()
         self.logger.info("[{}] Stage: {}".format("x" if self._run_stage else " ", self.stage))
+        if self._run_stage:
+            self.save_checkpoint()
+        if self._tip_journal_records >= self._tip_log_compact_every:
+            self.track_tip()
+        self.publish_status()
         return self._run_stage
     
+    def skip_to(self, stage: str):
+        """Skip the stages up to the specified one, from the next stage boundary
+        :param stage: name of a later stage"""
+        if stage not in (s["name"] for s in self.stages if s["index"] > self._stage_index):
+            raise ValueError("not a later stage: {}".format(stage))
+        self._skip_to = stage
+        self.logger.info(self.msg_format("skip to stage", stage))
+    
+    def end_delay(self) -> bool:
+        """End the current delay early
+        :returns: True if a delay was in progress"""
+        if not self._delaying:
+            return False
+        self._delay_end.set()
+        self.logger.info(self.msg_format("delay ended"))
+        return True
+    
+    @property
+    def speed_factor(self) -> float:
+        """Multiplier of the gantry speed and of the flow rates of the pipettes"""
+        return self._speed_control.factor
+    
+    @speed_factor.setter
+    def speed_factor(self, value: float):
+        self._speed_control.factor = value
+        self.logger.info(self.msg_format("speed factor", self._speed_control.factor))
+    
+    @classmethod
+    def stage_catalogue(cls, **kwargs) -> List[dict]:
+        """Ordered list of the stages executed by this station class with the given constructor arguments (from a cached dry run)"""
+        from .catalogue import stage_catalogue
+        return stage_catalogue(cls, **kwargs)
+    
+    @classmethod
+    def estimate_duration(cls, model_filepath: Optional[str] = None, **kwargs) -> dict:
+        """Estimated duration of a run of this station class with the given constructor arguments (from a dry run)
+        :param model_filepath: path of the timing model file (defaults to the one in the package)"""
+        from .estimator import estimate_station
+        return estimate_station(cls, model_filepath, **kwargs)
+    
+    @property
+    def stages(self) -> List[dict]:
+        """Ordered list of the stages executed by this station (built once, on first access, e.g. the first `/stages` request)"""
+        with self._stages_lock:
+            if self._stages is None:
+                try:
+                    self._stages = type(self).stage_catalogue(**self._init_kwargs)
+                except Exception as e:
+                    self._stages = []
+                    self.logger.warning("stage catalogue not available: {}".format(e))
+        return self._stages
+    
+    @property
+    def _checkpoint_filepath(self) -> str:
+        return os.path.join(self._tip_log_folder_path, self._checkpoint_filename)
+    
+    @classmethod
+    def checkpoint_attrs(cls) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(chain.from_iterable(vars(c).get("_checkpoint_attrs", ()) for c in reversed(cls.__mro__))))
+    
+    def setup_checkpoint(self):
+        if self._resume and os.path.isfile(self._checkpoint_filepath):
+            try:
+                with open(self._checkpoint_filepath) as f:
+                    checkpoint = json.load(f)
+            except ValueError as e:
+                # Starting over would repeat the stages already done
+                raise RuntimeError("cannot resume from checkpoint {}: {}".format(self._checkpoint_filepath, e))
+            if checkpoint.get("class") != type(self).__name__:
+                self.logger.warning("ignoring checkpoint of {}".format(checkpoint.get("class")))
+                return
+            self._resume_from = checkpoint
+            self._run_stage = False
+            self.logger.info(self.msg_format("resume", self._resume_from["stage"], self._resume_from["index"]))
+    
+    def save_checkpoint(self):
+        """Save the state at the beginning of the current stage.
+        With `checkpoint_every` greater than 1, only one executed stage every `checkpoint_every` is saved
+        (a resumed run restarts from the last saved stage)"""
+        if self._ctx.is_simulating():
+            return
+        self._checkpoint_skipped += 1
+        if self._checkpoint_skipped < self._checkpoint_every:
+            return
+        self._checkpoint_skipped = 0
+        os.makedirs(self._tip_log_folder_path, exist_ok=True)
+        tmp_filepath = self._checkpoint_filepath + ".tmp"
+        with open(tmp_filepath, 'w') as f:
+            json.dump({
+                "class": type(self).__name__,
+                "stage": self.stage,
+                "index": self._stage_index,
+                "state": {k: getattr(self, k, None) for k in self.checkpoint_attrs()},
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, self._checkpoint_filepath)
+        fsync_dir(self._tip_log_folder_path)
+    
+    def restore_checkpoint(self):
+        """Restore the state saved at the beginning of the stage to resume"""
+        for k, v in self._resume_from.get("state", {}).items():
+            if k in self.checkpoint_attrs():
+                setattr(self, k, v)
+        self.logger.debug("restored state: {}".format(self._resume_from.get("state", {})))
+        self._resume_from = None
+        self._run_stage = True
+    
+    def clear_checkpoint(self):
+        if os.path.isfile(self._checkpoint_filepath):
+            os.remove(self._checkpoint_filepath)
+    
     @property
     def logger(self) -> logging.getLoggerClass():
         if ((not hasattr(self, "_logger")) or self._logger is None) and self._ctx is not None:
+            setup_logging()
             self._logger = logging.getLogger(self.logger_name)
-            self._logger.addHandler(ProtocolContextLoggingHandler(self._ctx))
+            self._add_log_handler(self._logger, ProtocolContextLoggingHandler(self._ctx))
         return self._logger
     
+    def _add_log_handler(self, logger: logging.Logger, handler: logging.Handler):
+        logger.addHandler(handler)
+        self._log_handlers.append((logger, handler))
+    
+    def _remove_log_handlers(self):
+        """Remove the handlers added for the run: loggers are shared by the runs of a long-lived process"""
+        for logger, handler in self._log_handlers:
+            logger.removeHandler(handler)
+            handler.close()
+            if isinstance(handler, ProtocolContextLoggingHandler) and logger is self._logger:
+                # Created again (with the context of the next run) when needed
+                self._logger = None
+        self._log_handlers = []
+    
     def setup_opentrons_logger(self):
         stack_logger = logging.getLogger('opentrons')
         stack_logger.setLevel(self.logger.getEffectiveLevel())
         if self._log_filepath and (self._simulation_log_file or not self._ctx.is_simulating()):
             os.makedirs(os.path.dirname(self._log_filepath), exist_ok=True)
-            stack_logger.addHandler(logging.FileHandler(self._log_filepath))
+            self._add_log_handler(stack_logger, logging.FileHandler(self._log_filepath))
         self._lws_logger = LocalWebServerLogger(self._log_lws_ip, self._log_lws_endpoint)
         if self._simulation_log_lws or not self._ctx.is_simulating():
-            self._ctx.broker.subscribe(commands.command_types.COMMAND, self._lws_logger)
+            self._ctx.broker.subscribe(command_types.COMMAND, self._lws_logger)
+        if self._profile_filepath and (self._simulation_log_file or not self._ctx.is_simulating()):
+            self._profiler = CommandProfiler(self)
+            self._ctx.broker.subscribe(command_types.COMMAND, self._profiler)
+    
+    def write_profile(self):
+        """Write the execution profile: a Chrome trace and a summary table (same file path, with extension .txt)"""
+        if self._profiler is not None:
+            self._profiler.finish()
+            os.makedirs(os.path.dirname(self._profile_filepath) or ".", exist_ok=True)
+            self._profiler.write(self._profile_filepath, os.path.splitext(self._profile_filepath)[0] + ".txt")
+            self.logger.debug("profile written to {}".format(self._profile_filepath))
     
     @property
     def logger_name(self) -> str:
         return self.__class__.__name__
     
     @classmethod
-    def loaders(cls, key: str) -> map:
-        return map(lambda x: (x[0], x[2]), sorted(map(lambda x: (x, *getattr(getattr(cls, x), key)), filter(lambda x: hasattr(getattr(cls, x), key), dir(cls))), key=lambda x: x[1]))
+    def loaders(cls, key: str) -> Tuple[Tuple[str, tuple], ...]:
+        return cls._loaders[key]
     
     @classmethod
-    def labware_loaders(cls) -> map:
-        return cls.loaders("_labware_load")
+    def labware_loaders(cls) -> Tuple[Tuple[str, tuple], ...]:
+        return cls._loaders["_labware_load"]
     
     @classmethod
-    def instrument_loaders(cls) -> map:
-        return cls.loaders("_instr_load")
+    def instrument_loaders(cls) -> Tuple[Tuple[str, tuple], ...]:
+        return cls._loaders["_instr_load"]
     
     def load_it(self, it):
         for method_name, _ in it:
@@ -226,62 +499,167 @@ class Station(metaclass=StationMeta):
         """Mapping from tipracks attribute names to associated pipette (attribute names)"""
         pass
     
+    @property
+    def _tip_log_journal_filepath(self) -> str:
+        return self._tip_log_filepath + ".journal"
+    
     def setup_tip_log(self):
         data = {}
+        depleted = {}
+        replayed = False
         if self._tip_track:
             self.logger.info(self.msg_format("tip info log", self._tip_log_filepath))
             if os.path.isfile(self._tip_log_filepath):
                 with open(self._tip_log_filepath) as json_file:
-                    data: dict = json.load(json_file).get("count", {})
+                    snapshot: dict = json.load(json_file)
+                data = snapshot.get("count", {})
+                depleted = snapshot.get("depleted", {})
+            if os.path.isfile(self._tip_log_journal_filepath):
+                # Each journal record holds absolute counts: the last one wins
+                with open(self._tip_log_journal_filepath) as journal_file:
+                    for line in journal_file:
+                        try:
+                            data.update(json.loads(line))
+                        except ValueError:
+                            # Torn record at the tail (e.g. power loss during write)
+                            break
+                        replayed = True
         else:
             self.logger.debug("not using tip log file")
         
+        self._tip_allocator = TipAllocator(on_depleted=self._on_tiprack_depleted, lock=self._tip_lock)
+        for t, p in self._tipracks().items():
+            pip = getattr(self, p)
+            self._tip_allocator.add(
+                t,
+                list(chain.from_iterable(map(first_row if pip.channels > 1 else wells, getattr(self, t)))),
+                pip if getattr(self, t) == pip.tip_racks else None,
+                self._tip_start.get(t, data.get(t, 0)),
+                racks=len(getattr(self, t)),
+                depleted=None if t in self._tip_start else depleted.get(t, None),
+            )
         self._tip_log = {
-            'count': {t: data.get(t, 0) for t in self._tipracks().keys()},
-            'tips': {t: list(chain.from_iterable(map(first_row if getattr(self, p).channels > 1 else wells, getattr(self, t)))) for t, p in self._tipracks().items()},
+            'count': self._tip_allocator.count,
+            'tips': self._tip_allocator.tips,
+            'max': self._tip_allocator.max,
+            'depleted': self._tip_allocator.depleted,
         }
-        self._tip_log['max'] = {t: len(p) for t, p in self._tip_log['tips'].items()}
+        if replayed:
+            self.track_tip()
     
-    def track_tip(self):
-        if self._tip_track and not self._ctx.is_simulating():
-            self.logger.debug(self.get_msg_format("tip log dump", self._tip_log_filepath))
+    def _journal_tip(self, tiprack: str):
+        if self._tip_journal is None:
             os.makedirs(self._tip_log_folder_path, exist_ok=True)
-            with open(self._tip_log_filepath, 'w') as outfile:
-                json.dump({
-                    "count": self._tip_log['count'],
-                    "next": {k: str(self._tip_log['tips'][k][v % self._tip_log['max'][k]]) for k, v in self._tip_log['count'].items()},
-                }, outfile, indent=2)
+            self._tip_journal = open(self._tip_log_journal_filepath, 'a')
+        self._tip_journal.write(json.dumps({tiprack: self._tip_log['count'][tiprack]}) + "\n")
+        self._tip_journal.flush()
+        self._tip_journal_records += 1
+        self._tip_journal_unsynced += 1
+        if self._tip_journal_unsynced >= self._tip_log_fsync_every:
+            os.fsync(self._tip_journal.fileno())
+            self._tip_journal_unsynced = 0
+    
+    def _dump_tip_log(self):
+        self.logger.debug(self.get_msg_format("tip log dump", self._tip_log_filepath))
+        os.makedirs(self._tip_log_folder_path, exist_ok=True)
+        tmp_filepath = self._tip_log_filepath + ".tmp"
+        with open(tmp_filepath, 'w') as outfile:
+            json.dump({
+                "count": self._tip_log['count'],
+                "next": {k: str(self._tip_log['tips'][k][v % self._tip_log['max'][k]]) for k, v in self._tip_log['count'].items()},
+                "depleted": {k: sorted(v) for k, v in self._tip_log['depleted'].items()},
+            }, outfile, indent=2)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_filepath, self._tip_log_filepath)
+        # The journal is only reset after the new snapshot is in place:
+        # replaying it again over the snapshot is harmless because records are absolute
+        if self._tip_journal is not None:
+            self._tip_journal.close()
+            self._tip_journal = None
+        if os.path.isfile(self._tip_log_journal_filepath):
+            os.remove(self._tip_log_journal_filepath)
+        self._tip_journal_records = 0
+        self._tip_journal_unsynced = 0
+    
+    def track_tip(self, tiprack: Optional[str] = None):
+        """Persist the tip counts. In journal mode, a pick-up from the specified tiprack is appended to the journal,
+        otherwise the whole tip log file is rewritten (compacting the journal)"""
+        if self._tip_track and not self._ctx.is_simulating():
+            with self._tip_lock:
+                if self._tip_log_journal and tiprack is not None:
+                    self._journal_tip(tiprack)
+                else:
+                    self._dump_tip_log()
+        self.publish_status()
     
     def pick_up(self, pip, loc: Optional[Location] = None, tiprack: Optional[str] = None):
         if loc is None:
             if tiprack is None:
-                for t in self._tipracks().keys():
-                    if getattr(self, t) == pip.tip_racks:
-                        tiprack = t
-                        break
-            if tiprack is None:
-                raise RuntimeError("no tiprack associated to pipette")
+                tiprack = self._tip_allocator.rack_for(pip)
             
-            if self._tip_log['count'][tiprack] == self._tip_log['max'][tiprack]:
+            if self._tip_allocator.is_empty(tiprack):
                 # If empty, wait for refill
-                self._tip_log['count'][tiprack] = 0
+                self._tip_allocator.reset(tiprack)
                 self.track_tip()
-                self.pause(self.get_msg_format("refill tips", "\n".join(map(str, getattr(self, tiprack)))))
-            self._tip_log['count'][tiprack] += 1
-            self.track_tip()
-            pip.pick_up_tip(self._tip_log['tips'][tiprack][self._tip_log['count'][tiprack] - 1])
-        else:
-            pip.pick_up_tip(loc)
+                self.pause(self.get_msg_format("refill tips", "\n".join(map(str, getattr(self, tiprack)))), reason="refill tips")
+            loc = self._tip_allocator.take(tiprack)
+            self.track_tip(tiprack)
+        pip.pick_up_tip(loc)
+    
+    def _on_tiprack_depleted(self, tiprack: str, rack: int):
+        self.track_tip()
+        if not self._tip_allocator.is_empty(tiprack):
+            # The robot keeps drawing from the other racks: ask for a swap without pausing
+            self.logger.info(self.get_msg_format("swap tiprack", getattr(self, tiprack)[rack]))
+    
+    @property
+    def tipracks_to_swap(self) -> list:
+        """Racks that are empty and can be replaced while the robot is running"""
+        allocator = getattr(self, "_tip_allocator", None)
+        if allocator is None:
+            return []
+        return [{
+            "tiprack": t,
+            "rack": r,
+            "slot": str(getattr(getattr(self, t)[r], "parent", "")),
+            "name": str(getattr(self, t)[r]),
+        } for t, d in allocator.depleted.items() if not allocator.is_empty(t) for r in sorted(d)]
+    
+    def swap_tiprack(self, slot: Optional[str] = None, tiprack: Optional[str] = None, rack: Optional[int] = None) -> bool:
+        """Confirm that an empty rack has been replaced
+        :param slot: deck slot of the replaced rack
+        :param tiprack: name of the tiprack (used if the slot is not specified)
+        :param rack: index of the rack within the tiprack (used if the slot is not specified)
+        :returns: True if an empty rack was marked as full"""
+        if slot is None and rack is not None:
+            try:
+                rack = int(rack)
+            except (TypeError, ValueError):
+                raise ValueError("invalid rack index: {}".format(rack))
+        for t in self._tipracks().keys():
+            for r, lw in enumerate(getattr(self, t)):
+                if (str(getattr(lw, "parent", "")) == str(slot)) if slot is not None else (t == tiprack and r == rack):
+                    with self._tip_lock:
+                        if not self._tip_allocator.refill(t, r):
+                            return False
+                        self.track_tip()
+                    self.logger.info(self.get_msg_format("tiprack swapped", lw))
+                    return True
+        return False
     
     def drop(self, pip):
         # Drop in the Fixed Trash (on 12) at different positions to avoid making a tall heap of tips
         drop_loc = self._ctx.loaded_labwares[12].wells()[0].top().move(Point(x=self._drop_loc_r if self._side_switch else self._drop_loc_l, y=self._drop_loc_y))
         self._side_switch = not self._side_switch
         pip.drop_tip(drop_loc)
-        self._drop_count += pip.channels
-        if self._drop_count >= self._drop_threshold:
+        with self._tip_lock:
+            self._drop_count += pip.channels
+            full = self._drop_count >= self._drop_threshold
+            if full:
+                self._drop_count = 0
+        if full:
             self.pause('empty tips')
-            self._drop_count = 0
     
     def pause(self,
         msg: str = "",
@@ -292,37 +670,85 @@ class Station(metaclass=StationMeta):
         home: bool = True,
         level: int = logging.INFO,
         pause: bool = True,
+        coalesce: bool = True,
+        reason: Optional[str] = None,
     ):
+        t0 = time.monotonic()
+        if reason is None:
+            reason = msg if msg in messages.messages(type(self), self._language) else (self.stage or "pause")
         self.status = "pause"
         old_color = self._button.color
         self._button.color = color
+        if coalesce and self._pause_scheduler is not None:
+            merged = self._pause_scheduler.request(self.get_msg(msg))
+            if merged:
+                self._msg = self.get_msg_format("coalesced interventions", self.get_msg(msg), merged, "" if pause else self.get_msg("confirm interventions"))
+                msg = self._msg
         if msg:
             self.msg = msg
             self.logger.log(level, self.msg)
         if home:
             self._ctx.home()
-        if blink and not self._ctx.is_simulating():
-            lt = (BlinkingLightHTTP if self._dummy_lights else BlinkingLight)(self._ctx, t=blink_period/2)
-            lt.start()
+        if blink and self._lights is not None:
+            self._lights.blink(blink_period/2)
         if delay_time > 0:
-            self._ctx.delay(delay_time)
+            self._wait(delay_time)
         if pause:
             self._ctx.pause()
             self._ctx.delay(0.1)  # pad to avoid pause leaking
-        if blink and not self._ctx.is_simulating():
-            lt.stop()
+        if self._pause_scheduler is not None:
+            if pause:
+                self._pause_scheduler.confirm()
+            else:
+                self._pause_scheduler.discard()
+        if blink and self._lights is not None:
+            self._lights.stop_blink()
         self._button.color = old_color
         self.status = "running"
         self.msg = ""
+        if self._metrics is not None:
+            self._metrics.pause(reason, time.monotonic() - t0)
+    
+    def _wait(self, seconds: float):
+        """Delay that can be ended early with `end_delay` when running on the robot with run control enabled (`control_token`).
+        Such a delay is split into short robot delays, so that it still honours the pauses and the cancellation of the run.
+        Otherwise it is a single robot delay"""
+        if self._ctx.is_simulating() or self._control_token is None:
+            self._ctx.delay(seconds)
+            return
+        self._delay_end.clear()
+        self._delaying = True
+        end = time.monotonic() + seconds
+        try:
+            while not self._delay_end.is_set():
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ctx.delay(min(remaining, DELAY_SLICE))
+        finally:
+            self._delaying = False
+    
+    def confirm_interventions(self) -> int:
+        """Confirm the interventions requested during the current delay"""
+        with self._tip_lock:
+            n = 0 if self._pause_scheduler is None else self._pause_scheduler.confirm()
+        self.publish_status()
+        return n
+    
+    @property
+    def interventions(self) -> list:
+        """Log of the interventions merged into pauses and delays"""
+        return [] if self._pause_scheduler is None else self._pause_scheduler.log
     
     def dual_pause(self, msg: str, cols: Tuple[str, str] = ('red', 'yellow'), between: Optional[Callable] = None, home: Tuple[bool, bool] = (True, False)):
+        reason = msg
         msg = self.get_msg(msg)
         self._msg = "{}.\n{}".format(msg, self.get_msg("stop blink"))
-        self.pause(self.msg, color=cols[0], home=home[0])
+        self.pause(self.msg, color=cols[0], home=home[0], reason=reason)
         if between is not None:
             between()
         self._msg = "{}.\n{}".format(msg, self.get_msg("continue"))
-        self.pause(self.msg, blink=False, color=cols[1], home=home[1])
+        self.pause(self.msg, blink=False, color=cols[1], home=home[1], reason=reason)
     
     def delay(self,
         mins: float,
@@ -339,18 +765,49 @@ class Station(metaclass=StationMeta):
             home=home,
             level=level,
             pause=self._skip_delay,
+            reason="delay",
         )
         
+    def attach_server(self, server: 'StationRESTServer'):
+        """Use a REST server that is already running (e.g. kept by a station host between runs) instead of starting one"""
+        self._request = server
+        self._attached_server = True
+    
     def body(self):
         pass
     
-    def run(self, ctx: ProtocolContext):
+    def run(self, ctx: 'ProtocolContext'):
+        # Handlers bound to the context of a previous run (if any) are removed too
+        self._remove_log_handlers()
+        try:
+            self._run(ctx)
+        finally:
+            self._remove_log_handlers()
+    
+    def _run(self, ctx: 'ProtocolContext'):
+        # The stage counters of a previous run on the same instance (if any) are reset
+        self.stage = None
+        self._stage_index = 0
+        self._run_stage = self._start_at is None
+        self._resume_from = None
+        self._skip_to = None
+        self._checkpoint_skipped = 0
         self.status = "running"
         self._ctx = ctx
-        self._button = (Button.dummy if self._dummy_lights else Button)(self._ctx, 'blue')
+        if not self._ctx.is_simulating():
+            self._lights = LightController((HTTPLights if self._dummy_lights else HardwareLights)(self._ctx), logger=self.logger)
+        self._button = (Button.dummy if self._dummy_lights else Button)(self._ctx, 'blue', controller=self._lights)
         if self._simulation_log_lws or not self._ctx.is_simulating():
-            self._request = StationRESTServerThread(ctx, station=self, **self._rest_server_kwargs)
-            self._request.start()
+            self._metrics = StationMetrics(self)
+            self._ctx.broker.subscribe(command_types.COMMAND, self._metrics)
+            self._ctx.broker.subscribe(command_types.COMMAND, self._speed_control)
+            self._status_publisher.enabled = True
+            if self._attached_server:
+                self._request.attach(ctx, self)
+            else:
+                from .request import DEFAULT_REST_KWARGS, StationRESTServerProcess, StationRESTServerThread
+                self._request = (StationRESTServerProcess if self._rest_server_process else StationRESTServerThread)(ctx, station=self, **(DEFAULT_REST_KWARGS if self._rest_server_kwargs is None else self._rest_server_kwargs))
+                self._request.start()
         
         self.setup_opentrons_logger()
         if self._wait_first_log:
@@ -365,6 +822,7 @@ class Station(metaclass=StationMeta):
         self.load_labware()
         self.load_instruments()
         self.setup_tip_log()
+        self.setup_checkpoint()
         self._button.color = 'white'
         self.msg = ""
         
@@ -372,15 +830,42 @@ class Station(metaclass=StationMeta):
             self.body()
         finally:
             self.status = "finished"
-            if not self._ctx.is_simulating():
+            if not self._ctx.is_simulating() and not self._attached_server:
                 self._request.join(2, 0.5)
             self.track_tip()
+            self.write_profile()
+            self._lws_logger.close(2)
             self._button.color = 'blue'
+            if self._lights is not None:
+                self._lights.close(2)
+                self._lights = None
+        if not self._ctx.is_simulating():
+            self.clear_checkpoint()
         self._ctx.home()
     
-    def simulate(self):
-        from opentrons import simulate
-        self.run(simulate.get_protocol_api(self.metadata["apiLevel"]))
+    def simulate(self, cache: bool = False) -> dict:
+        """Run on the Opentrons simulator
+        :param cache: reuse the results of an identical simulation from the on-disk cache (if any)
+        :returns: the command log, the stage list and the tip/volume summary"""
+        from .simcache import simulate
+        return simulate(self, "simulator", cache)
+
+    def dry_run(self, api_level: Optional[str] = None) -> 'DryRunContext':
+        """Run on the in-package dry-run context instead of the Opentrons simulator
+        :param api_level: API level of the protocol (defaults to the one in the metadata)
+        :returns: the context, holding the recorded commands"""
+        from .dryrun import DryRunContext
+        ctx = DryRunContext(api_level or (self.metadata or {}).get("apiLevel", "2.3"))
+
+        def on_stage(index: int, stage: str):
+            ctx.stage = stage
+
+        self._stage_listeners.append(on_stage)
+        try:
+            self.run(ctx)
+        finally:
+            self._stage_listeners.remove(on_stage)
+        return ctx
 
 
 # Copyright (c) 2020 Covmatic.
@@ -0,0 +1,294 @@
+"""Versioned status snapshots for the REST server.
+The station bumps the version of its status whenever its state changes: that is all the protocol thread does.
+An immutable snapshot is built and serialized lazily, by the first reader of each version (a server thread),
+so that the other polls only cost a lookup, and is tagged with an ETag for conditional requests. Readings of the modules (e.g. the temperature) are cached for a short time.
+Snapshots can also be written to a shared-memory block, to be served by another process."""
+from collections import namedtuple
+from contextlib import nullcontext
+from threading import Condition, Lock
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Optional
+import copy
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+StatusSnapshot = namedtuple("StatusSnapshot", ["version", "time", "data", "body", "etag"])
+
+
+class TTLCache:
+    """Cache of values that are expensive to read (e.g. from the hardware), refreshed after a time to live"""
+    def __init__(self, ttl: float = 2.0, clock: Callable[[], float] = time.monotonic):
+        """
+        :param ttl: time to live of the values in seconds
+        :param clock: clock function in seconds
+        """
+        self.ttl = ttl
+        self._clock = clock
+        self._values: Dict[str, tuple] = {}
+
+    def get(self, key: str, read: Callable[[], Any]) -> Any:
+        """Cached value, read again if older than the time to live"""
+        t = self._clock()
+        v = self._values.get(key, None)
+        if v is None or t - v[0] > self.ttl:
+            v = (t, read())
+            self._values[key] = v
+        return v[1]
+
+    def invalidate(self, key: Optional[str] = None):
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+
+class StatusSource:
+    """Base class of the sources of status snapshots"""
+    @property
+    def current(self) -> StatusSnapshot:
+        raise NotImplementedError
+
+    def refresh(self, ttl: float) -> StatusSnapshot:
+        return self.current
+
+    def wait(self, version: Optional[int] = None, timeout: Optional[float] = None) -> StatusSnapshot:
+        raise NotImplementedError
+
+    def etag(self, fields: Optional[Iterable[str]] = None) -> str:
+        """ETag of the snapshot, with a hash of the field selection (if any): it must not contain commas,
+        as clients may send several ETags separated by commas in If-None-Match"""
+        etag = self.current.etag
+        if not fields:
+            return etag
+        return "{}-{}\"".format(etag[:-1], hashlib.sha1(",".join(sorted(set(fields))).encode()).hexdigest()[:16])
+
+    def body(self, fields: Optional[Iterable[str]] = None) -> str:
+        """Serialized snapshot, optionally restricted to the specified fields"""
+        snapshot = self.current
+        if not fields:
+            return snapshot.body
+        fields = set(fields)
+        # Fields in the order of the snapshot, so that the body only depends on the selection (as the ETag)
+        return json.dumps({k: v for k, v in snapshot.data.items() if k in fields})
+
+
+class StatusPublisher(StatusSource):
+    def __init__(self, station: 'Station'):
+        """
+        :param station: the station whose status is published
+        """
+        self._station = station
+        self._run_id = "{:x}".format(int(time.time() * 1000))
+        self._cond = Condition()
+        self._build_lock = Lock()
+        self.enabled = False
+        self._version = 0
+        self._current: Optional[StatusSnapshot] = None
+
+    def _data(self) -> dict:
+        s = self._station
+        server = getattr(s, "_request", None)
+        status = getattr(s, "status", None)
+        server_status = getattr(server, "_status", None)
+        allocator = getattr(s, "_tip_allocator", None)
+        # Read from a server thread while the protocol thread takes tips
+        with getattr(allocator, "_lock", None) or nullcontext():
+            tips = {
+                k: {kk: sorted(vv) for kk, vv in v.items()} if k == "depleted" else copy.copy(v)
+                for k, v in getattr(s, "_tip_log", {}).items() if k != "tips"
+            }
+            tipracks_to_swap = getattr(s, "tipracks_to_swap", [])
+        return {
+            "status": status if status == "finished" or server_status is None else server_status,
+            "stage": getattr(s, "stage", None),
+            "msg": getattr(s, "msg", None),
+            "external": getattr(s, "external", False),
+            "time": datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S:%f"),
+            "temp": s.temperature() if hasattr(s, "temperature") else None,
+            "tips": tips,
+            "tipracks_to_swap": tipracks_to_swap,
+            "interventions": list(getattr(s, "interventions", [])),
+            "runlog": getattr(s, "_log_filepath", None),
+        }
+
+    def publish(self, force: bool = False) -> Optional[int]:
+        """Mark the status as changed (if enabled): the snapshot is built when it is first read
+        :param force: publish even if not enabled
+        :returns: the new version"""
+        if not (self.enabled or force):
+            return None
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+            return self._version
+
+    def _build(self) -> StatusSnapshot:
+        with self._build_lock:
+            version = self._version
+            if self._current is None or self._current.version != version:
+                data = self._data()
+                data["version"] = version
+                self._current = StatusSnapshot(
+                    version=version,
+                    time=time.time(),
+                    data=MappingProxyType(data),
+                    body=json.dumps(data),
+                    etag="\"{}-{}\"".format(self._run_id, version),
+                )
+            return self._current
+
+    def refresh(self, ttl: float) -> StatusSnapshot:
+        """Publish a new snapshot if the module readings changed since the latest one, older than the time to live.
+        Module readings are the only fields that change without the station publishing"""
+        snapshot = self.current
+        if time.time() - snapshot.time > ttl and self._station.temperature() != snapshot.data["temp"]:
+            self.publish(force=True)
+            snapshot = self.current
+        return snapshot
+
+    def wait(self, version: Optional[int] = None, timeout: Optional[float] = None) -> StatusSnapshot:
+        """Wait for a snapshot with a version other than the specified one
+        :param version: version the caller already has (None to return the latest one at once)
+        :param timeout: maximum time to wait in seconds
+        :returns: the latest snapshot (unchanged on timeout)"""
+        self.current  # publish one if there is none yet
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version, timeout)
+        return self.current
+
+    @property
+    def current(self) -> StatusSnapshot:
+        """The latest snapshot (built now if the status changed since the last one, published now if there is none yet)"""
+        if self._version == 0:
+            self.publish(force=True)
+        snapshot = self._current
+        return snapshot if snapshot is not None and snapshot.version == self._version else self._build()
+
+
+class StatusBlock:
+    """Status snapshots in a memory-mapped file, to be shared between processes.
+    There is a single writer: readers retry while the sequence number is odd (a write is in progress)
+    or has changed while they were reading (seqlock), so neither side ever blocks the other"""
+    # sequence number, version, time, flags, ETag length, body length
+    HEADER = struct.Struct("<QQdIII")
+    ETAG_SIZE = 64
+    # Flags
+    WAITING_FIRST_LOG = 1
+
+    def __init__(self, filepath: str, size: Optional[int] = None):
+        """
+        :param filepath: path of the file (created with the specified size if given)
+        :param size: size of the block in bytes (for the writer)
+        """
+        self.filepath = filepath
+        if size is not None:
+            with open(filepath, "wb") as f:
+                f.truncate(size)
+        with open(filepath, "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        self._offset = self.HEADER.size + self.ETAG_SIZE
+        self._seq = 0
+        self._snapshot: Optional[StatusSnapshot] = None
+        self.flags = 0
+
+    @classmethod
+    def create(cls, size: int = DEFAULT_BLOCK_SIZE) -> 'StatusBlock':
+        """Create a block in a new temporary file (in shared memory if available)"""
+        fd, filepath = tempfile.mkstemp(prefix="covmatic_status_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        os.close(fd)
+        return cls(filepath, size)
+
+    def write(self, snapshot: StatusSnapshot, flags: int = 0):
+        body = snapshot.body.encode()
+        etag = snapshot.etag.encode()
+        if len(etag) > self.ETAG_SIZE or self._offset + len(body) > len(self._mm):
+            raise ValueError("status snapshot {} does not fit in the block ({} bytes)".format(snapshot.version, len(body)))
+        self._seq += 1
+        self.HEADER.pack_into(self._mm, 0, self._seq, snapshot.version, snapshot.time, flags, len(etag), len(body))
+        self._mm[self.HEADER.size:self.HEADER.size + len(etag)] = etag
+        self._mm[self._offset:self._offset + len(body)] = body
+        self._seq += 1
+        struct.pack_into("<Q", self._mm, 0, self._seq)
+
+    def read(self) -> Optional[StatusSnapshot]:
+        """The latest snapshot written (None if there is none yet)"""
+        while True:
+            seq, version, t, flags, etag_len, body_len = self.HEADER.unpack_from(self._mm, 0)
+            if seq == 0:
+                return None
+            if seq & 1:
+                time.sleep(0)
+                continue
+            if seq == self._seq:
+                return self._snapshot
+            etag = self._mm[self.HEADER.size:self.HEADER.size + etag_len]
+            body = self._mm[self._offset:self._offset + body_len]
+            if struct.unpack_from("<Q", self._mm, 0)[0] == seq:
+                break
+        body = body.decode()
+        self._seq = seq
+        self.flags = flags
+        self._snapshot = StatusSnapshot(version=version, time=t, data=MappingProxyType(json.loads(body)), body=body, etag=etag.decode())
+        return self._snapshot
+
+    def close(self, unlink: bool = False):
+        self._mm.close()
+        if unlink:
+            os.remove(self.filepath)
+
+
+class StatusBlockReader(StatusSource):
+    """Source of the snapshots written by another process in a status block"""
+    def __init__(self, block: StatusBlock, request_refresh: Optional[Callable[[], None]] = None, poll_interval: float = 0.05):
+        """
+        :param block: the status block
+        :param request_refresh: function asking the writer to refresh the module readings
+        :param poll_interval: interval in seconds between reads of the block while waiting for a change
+        """
+        self._block = block
+        self._request_refresh = request_refresh
+        self._poll_interval = poll_interval
+        self._refresh_requested = 0.
+
+    @property
+    def current(self) -> StatusSnapshot:
+        snapshot = self._block.read()
+        while snapshot is None:
+            time.sleep(self._poll_interval)
+            snapshot = self._block.read()
+        return snapshot
+
+    @property
+    def flags(self) -> int:
+        return self._block.flags
+
+    def refresh(self, ttl: float) -> StatusSnapshot:
+        snapshot = self.current
+        t = time.time()
+        if self._request_refresh is not None and t - snapshot.time > ttl and t - self._refresh_requested > ttl:
+            # The new snapshot (if any) is picked up at the next read
+            self._refresh_requested = t
+            self._request_refresh()
+        return snapshot
+
+    def wait(self, version: Optional[int] = None, timeout: Optional[float] = None) -> StatusSnapshot:
+        t = None if timeout is None else time.monotonic() + timeout
+        snapshot = self.current
+        while snapshot.version == version and (t is None or time.monotonic() < t):
+            time.sleep(self._poll_interval if t is None else max(0., min(self._poll_interval, t - time.monotonic())))
+            snapshot = self.current
+        return snapshot
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
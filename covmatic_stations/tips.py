@@ -0,0 +1,141 @@
+from threading import Lock, RLock
+from typing import Callable, Dict, Iterable, Optional, Set, Union
+
+
+class TipAllocator:
+    """Constant-time tip allocation for the tipracks of a station.
+    Tipracks are identified by the name of the station attribute that holds them.
+    A tiprack may group several racks: each rack is tracked separately, so that an emptied rack
+    can be replaced while tips are drawn from the others"""
+    def __init__(self, on_depleted: Optional[Callable[[str, int], None]] = None, lock: Optional[RLock] = None):
+        """
+        :param on_depleted: callback called with the tiprack name and the rack index when a rack is emptied
+        :param lock: lock guarding the allocations (e.g. shared with the persistence of the tip counts)
+        """
+        self.count: Dict[str, int] = {}
+        self.tips: Dict[str, list] = {}
+        self.max: Dict[str, int] = {}
+        self.per_rack: Dict[str, int] = {}
+        self.depleted: Dict[str, Set[int]] = {}
+        self._pipettes: Dict[int, str] = {}
+        self._on_depleted = on_depleted
+        self._lock = lock or Lock()
+
+    def add(self, tiprack: str, tips: list, pipette=None, start: Union[int, str] = 0, racks: int = 1, depleted: Optional[Iterable[int]] = None):
+        """Register a tiprack
+        :param tiprack: name of the tiprack
+        :param tips: tips in the order they should be used
+        :param pipette: pipette that draws from this tiprack by default (optional). The first registered tiprack wins
+        :param start: first tip to use, as an index or as a tip name (e.g. 'A4')
+        :param racks: number of racks the tips are evenly split into
+        :param depleted: indices of the racks that are empty. If not specified, the racks before the first tip are considered empty"""
+        self.tips[tiprack] = tips
+        self.max[tiprack] = len(tips)
+        self.per_rack[tiprack] = max(len(tips) // max(racks, 1), 1)
+        self.count[tiprack] = self.index(tiprack, start)
+        self.depleted[tiprack] = set(range(self.rack(tiprack, self.count[tiprack])) if depleted is None else depleted)
+        if not self.is_empty(tiprack):
+            self._skip_depleted(tiprack)
+        if pipette is not None:
+            self._pipettes.setdefault(id(pipette), tiprack)
+
+    def index(self, tiprack: str, tip: Union[int, str]) -> int:
+        if isinstance(tip, str):
+            names = list(map(str, self.tips[tiprack]))
+            if tip in names:
+                return names.index(tip)
+            for i, n in enumerate(names):
+                if n.split(" ")[0] == tip:
+                    return i
+            raise ValueError("tip '{}' not found in tiprack '{}'".format(tip, tiprack))
+        if not 0 <= tip <= self.max[tiprack]:
+            raise ValueError("tip index {} out of range for tiprack '{}'".format(tip, tiprack))
+        return tip
+
+    def rack_for(self, pipette) -> str:
+        try:
+            return self._pipettes[id(pipette)]
+        except KeyError:
+            raise RuntimeError("no tiprack associated to pipette")
+
+    @property
+    def racks(self) -> Dict[str, int]:
+        return {t: self.max[t] // self.per_rack[t] for t in self.tips}
+
+    def rack(self, tiprack: str, idx: int) -> int:
+        """Index of the rack holding the specified tip"""
+        return idx // self.per_rack[tiprack]
+
+    def is_empty(self, tiprack: str) -> bool:
+        """Whether all the racks are empty"""
+        return len(self.depleted[tiprack]) >= self.racks[tiprack]
+
+    def remaining(self, tiprack: str) -> int:
+        """Number of tips left in the racks that are not empty"""
+        if self.is_empty(tiprack):
+            return 0
+        used = self.count[tiprack] % self.per_rack[tiprack]
+        return (self.racks[tiprack] - len(self.depleted[tiprack])) * self.per_rack[tiprack] - used
+
+    def reset(self, tiprack: str):
+        """All the racks have been replaced"""
+        with self._lock:
+            self.count[tiprack] = 0
+            self.depleted[tiprack].clear()
+
+    def refill(self, tiprack: str, rack: int) -> bool:
+        """A single rack has been replaced
+        :returns: True if the rack was empty"""
+        with self._lock:
+            if rack not in self.depleted[tiprack]:
+                return False
+            self.depleted[tiprack].discard(rack)
+            if self.count[tiprack] >= self.max[tiprack] or self.rack(tiprack, self.count[tiprack]) in self.depleted[tiprack]:
+                self._skip_depleted(tiprack)
+            return True
+
+    def replace(self, tiprack: str, rack: int):
+        """A rack has been replaced, even if it was not empty: its tips are all available again"""
+        with self._lock:
+            self.depleted[tiprack].discard(rack)
+            if self.count[tiprack] < self.max[tiprack] and self.rack(tiprack, self.count[tiprack]) == rack:
+                self.count[tiprack] = rack * self.per_rack[tiprack]
+            elif self.count[tiprack] >= self.max[tiprack] or self.rack(tiprack, self.count[tiprack]) in self.depleted[tiprack]:
+                self._skip_depleted(tiprack)
+
+    def current(self, tiprack: str) -> Optional[int]:
+        """Index of the rack the next tip is taken from (None if all the racks are empty)"""
+        return None if self.is_empty(tiprack) else self.rack(tiprack, self.count[tiprack] % self.max[tiprack])
+
+    def _skip_depleted(self, tiprack: str):
+        # Move to the first tip of the first non-empty rack, cycling from the current one
+        n = self.racks[tiprack]
+        pos = self.count[tiprack] % self.max[tiprack]
+        r = self.rack(tiprack, pos)
+        for i in range(n):
+            if (r + i) % n not in self.depleted[tiprack]:
+                self.count[tiprack] = ((r + i) % n) * self.per_rack[tiprack] if i else pos
+                return
+
+    def next(self, tiprack: str):
+        return self.tips[tiprack][self.count[tiprack] % self.max[tiprack]]
+
+    def take(self, tiprack: str):
+        with self._lock:
+            tip = self.tips[tiprack][self.count[tiprack]]
+            self.count[tiprack] += 1
+            emptied = None
+            if self.count[tiprack] % self.per_rack[tiprack] == 0:
+                emptied = self.rack(tiprack, self.count[tiprack] - 1)
+                self.depleted[tiprack].add(emptied)
+                if not self.is_empty(tiprack):
+                    self._skip_depleted(tiprack)
+        if emptied is not None and self._on_depleted is not None:
+            self._on_depleted(tiprack, emptied)
+        return tip
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -1,15 +1,39 @@
-from opentrons.protocol_api import ProtocolContext
 from opentrons.types import Location
 import logging
+import json
 import math
-import requests
+import time
+from collections import deque
+from threading import Thread, Condition
 from itertools import tee, cycle, islice, chain, repeat
-from typing import Tuple, Union, Iterable, Callable, Optional, Dict, Any
+from typing import Tuple, Union, Iterable, Callable, Optional, Dict, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from opentrons.protocol_api import ProtocolContext
+
+
+class _CommandTypes:
+    """Opentrons command types, imported when first used: importing `opentrons.commands`
+    before `opentrons.protocol_api` fails with a circular import on Opentrons 3.x"""
+    # Command types that not all Opentrons versions define
+    MOVE_TO = "command.MOVE_TO"
+
+    def __getattr__(self, name: str) -> str:
+        import opentrons.protocol_api  # noqa: F401 (must come first)
+        from opentrons import commands
+        types = getattr(commands, "command_types", None)
+        if types is None:
+            # Opentrons 4.x
+            from opentrons.commands import types
+        return getattr(types, name)
+
+
+command_types = _CommandTypes()
 
 
 class ProtocolContextLoggingHandler(logging.Handler):
     """Logging Handler that emits logs through the ProtocolContext comment method"""
-    def __init__(self, ctx: ProtocolContext, *args, **kwargs):
+    def __init__(self, ctx: 'ProtocolContext', *args, **kwargs):
         super(ProtocolContextLoggingHandler, self).__init__(*args, **kwargs)
         self._ctx = ctx
     
@@ -21,12 +45,45 @@ class ProtocolContextLoggingHandler(logging.Handler):
 
 
 class LocalWebServerLogger:
-    def __init__(self, ip: Optional[str] = None, endpoint: str = ":5002/log", *args, **kwargs):
+    """Ships the command broker messages to the LocalWebServer.
+    Records are only enqueued on the protocol thread: a background worker sends them in NDJSON batches
+    through a keep-alive session. When the queue is full, the oldest records are dropped (and counted).
+    Records in batches that fail or get an error response are counted as failed"""
+    def __init__(
+        self,
+        ip: Optional[str] = None,
+        endpoint: str = ":5002/log",
+        queue_size: int = 1024,
+        batch_size: int = 64,
+        flush_interval: float = 0.5,
+        timeout: Tuple[float, float] = (0.5, 2),
+        *args,
+        **kwargs
+    ):
+        """
+        :param ip: IP address of the LocalWebServer
+        :param endpoint: port and path of the log endpoint
+        :param queue_size: maximum number of records waiting to be sent
+        :param batch_size: maximum number of records sent in one request
+        :param flush_interval: maximum time a record waits for a batch to fill in seconds
+        :param timeout: connect and read timeouts for the requests in seconds
+        """
         super(LocalWebServerLogger, self).__init__(*args, **kwargs)
         self.ip = ip
         self.endpoint = endpoint
         self.level = 0
         self.last_dollar = None
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._timeout = timeout
+        self._queue = deque(maxlen=queue_size)
+        self._cond = Condition()
+        self._closed = False
+        self._session = None
+        self._worker = None
     
     @property
     def url(self) -> str:
@@ -44,12 +101,64 @@ class LocalWebServerLogger:
     
     def __call__(self, record: Dict[str, Any]):
         s = self.format(record)
-        url = self.url
-        if url and s:
-            try:
-                requests.post(url, s.encode('utf-8'), headers={'Content-type': 'text/plain; charset=utf-8'})
-            except Exception:
-                pass
+        if s and self.ip and not self._closed:
+            with self._cond:
+                if len(self._queue) == self._queue.maxlen:
+                    self.dropped += 1
+                self._queue.append({"time": time.time(), "level": self.level, "text": s})
+                if self._worker is None:
+                    self._worker = Thread(target=self._run, name=type(self).__name__, daemon=True)
+                    self._worker.start()
+                if len(self._queue) >= self._batch_size:
+                    self._cond.notify()
+    
+    def _pop_batch(self) -> list:
+        return [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+    
+    def _send(self, batch: list):
+        if self._session is None:
+            import requests
+            import requests.adapters
+            self._session = requests.Session()
+            self._session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        try:
+            ok = self._session.post(
+                self.url,
+                "".join(json.dumps(r) + "\n" for r in batch).encode('utf-8'),
+                headers={'Content-type': 'application/x-ndjson; charset=utf-8'},
+                timeout=self._timeout,
+            ).ok
+        except Exception:
+            ok = False
+        if ok:
+            self.sent += len(batch)
+        else:
+            self.failed += len(batch)
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._queue) < self._batch_size:
+                    self._cond.wait(self._flush_interval)
+                batch = self._pop_batch()
+                done = self._closed and not self._queue
+            if batch:
+                self._send(batch)
+            if done:
+                break
+        # The session is only closed here, when nothing can use it anymore
+        if self._session is not None:
+            self._session.close()
+    
+    def close(self, timeout: Optional[float] = None):
+        """Send the queued records and stop the worker
+        :param timeout: maximum time to wait for the worker in seconds.
+        If the worker is still sending when it expires, it closes the session itself once done"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._worker is not None:
+            self._worker.join(timeout)
 
 
 def mix_bottom_top(pip, reps: int, vol: float, pos: Callable[[float], Location], bottom: float, top: float):
@@ -33,7 +33,7 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/covmatic/stations",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["tests", "tests.*"]),
     include_package_data=True,
     setup_requires=[
         'opentrons',
@@ -53,6 +53,12 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.7, <3.9',
+    entry_points={
+        'console_scripts': [
+            'covmatic-simulate-matrix=covmatic_stations.matrix:main',
+            'covmatic-station-host=covmatic_stations.daemon:main',
+        ],
+    },
 )
 
 
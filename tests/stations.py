@@ -0,0 +1,29 @@
+"""Stations with their labware loaded on a dry-run context that reports not to be simulating,
+so that the files of a real run (tip log, checkpoint) are written"""
+from covmatic_stations.b.technogenetics import StationBTechnogenetics
+from covmatic_stations.catalogue import DRY_RUN_KWARGS, quiet_logger
+from covmatic_stations.dryrun import DryRunContext
+
+
+class RobotContext(DryRunContext):
+    @staticmethod
+    def is_simulating() -> bool:
+        return False
+
+
+def loaded_station(folder: str, cls: type = StationBTechnogenetics, **kwargs):
+    """Station with its labware and instruments loaded
+    :param folder: folder of the tip log and of the checkpoint
+    :param cls: the station class
+    :param kwargs: other keyword arguments for the station constructor"""
+    station = cls(**dict(DRY_RUN_KWARGS, logger=quiet_logger(), num_samples=8, tip_log_folder_path=folder, **kwargs))
+    station._ctx = RobotContext()
+    station.load_labware()
+    station.load_instruments()
+    return station
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -0,0 +1,85 @@
+from .stations import loaded_station
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.folder = self._folder.name
+        self.filepath = os.path.join(self.folder, "checkpoint.json")
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def station(self, **kwargs):
+        station = loaded_station(self.folder, tip_track=False, **kwargs)
+        station.setup_tip_log()
+        return station
+
+    def test_round_trip(self):
+        s = self.station()
+        s._drop_count = 42
+        s._stage_index = 2
+        s.run_stage("wash")
+        with open(self.filepath) as f:
+            self.assertEqual(json.load(f)["stage"], "wash")
+        self.assertFalse(os.path.exists(self.filepath + ".tmp"))
+
+        r = self.station(resume=True)
+        r.setup_checkpoint()
+        self.assertFalse(r._run_stage)
+        self.assertFalse(r.run_stage("setup"))
+        self.assertEqual(r._drop_count, 0)
+        r._stage_index = 2
+        self.assertTrue(r.run_stage("wash"))
+        self.assertEqual(r._drop_count, 42)
+        self.assertTrue(r.run_stage("elution"))
+
+    def test_no_resume(self):
+        self.station().run_stage("wash")
+        r = self.station()
+        r.setup_checkpoint()
+        self.assertTrue(r._run_stage)
+        self.assertIsNone(r._resume_from)
+
+    def test_other_class_ignored(self):
+        with open(self.filepath, "w") as f:
+            json.dump({"class": "OtherStation", "stage": "wash", "index": 1, "state": {}}, f)
+        r = self.station(resume=True)
+        with self.assertLogs(r.logger, "WARNING"):
+            r.setup_checkpoint()
+        self.assertIsNone(r._resume_from)
+
+    def test_corrupt(self):
+        with open(self.filepath, "w") as f:
+            f.write('{"class": "StationBTechnogenetics", "stage"')
+        r = self.station(resume=True)
+        with self.assertRaises(RuntimeError):
+            r.setup_checkpoint()
+
+    def test_every(self):
+        s = self.station(checkpoint_every=2)
+        s.run_stage("a")
+        self.assertFalse(os.path.exists(self.filepath))
+        s.run_stage("b")
+        with open(self.filepath) as f:
+            self.assertEqual(json.load(f)["stage"], "b")
+
+    def test_clear(self):
+        s = self.station()
+        s.run_stage("a")
+        s.clear_checkpoint()
+        self.assertFalse(os.path.exists(self.filepath))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
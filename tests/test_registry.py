@@ -0,0 +1,80 @@
+from covmatic_stations.registry import LayeredJsonRegistry, RecordRegistry
+import json
+import os
+import tempfile
+import unittest
+
+
+ENV_KEY = "COVMATIC_TEST_REGISTRY"
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.packaged = self.dump("packaged.json", [
+            {"serial": "A", "station": "B1", "height": 6},
+            {"serial": "B", "station": "B2", "height": 7},
+        ])
+        self.custom = self.dump("custom.json", [{"serial": "A", "station": "B3", "height": 8}])
+        os.environ.pop(ENV_KEY, None)
+
+    def tearDown(self):
+        os.environ.pop(ENV_KEY, None)
+        self._folder.cleanup()
+
+    def dump(self, name: str, data) -> str:
+        filepath = os.path.join(self._folder.name, name)
+        with open(filepath, "w") as f:
+            json.dump(data, f)
+        return filepath
+
+    def registry(self, layered: bool = False) -> RecordRegistry:
+        return RecordRegistry(self.packaged, ENV_KEY, ["serial", "station"], ["height"], layered=layered)
+
+    def test_packaged(self):
+        r = self.registry()
+        self.assertEqual(r.get("B", by="serial", field="height"), 7)
+        self.assertEqual(r.getter("height").by_station["B1"], 6)
+        self.assertEqual(r.get("Z", by="serial", field="height", default=5), 5)
+
+    def test_custom_replaces_packaged(self):
+        os.environ[ENV_KEY] = self.custom
+        r = self.registry()
+        self.assertEqual(r.filepaths, [self.custom])
+        self.assertEqual(r.get("A", by="serial", field="height"), 8)
+        self.assertIsNone(r.get("B", by="serial", field="height"))
+        self.assertEqual(r.specs, [{"serial": "A", "station": "B3", "height": 8}])
+
+    def test_custom_layered(self):
+        os.environ[ENV_KEY] = self.custom
+        r = self.registry(layered=True)
+        self.assertEqual(r.filepaths, [self.custom, self.packaged])
+        self.assertEqual(r.get("A", by="serial", field="height"), 8)
+        self.assertEqual(r.get("B", by="serial", field="height"), 7)
+        # The replaced packaged record is not found by any field
+        self.assertIsNone(r.get("B1", by="station", field="height"))
+        self.assertIsNone(r.get(6, by="height", field="serial"))
+        self.assertEqual(len(r.specs), 2)
+
+    def test_reload_on_change(self):
+        r = self.registry()
+        self.assertEqual(r.get("B", by="serial", field="height"), 7)
+        self.dump("packaged.json", [{"serial": "B", "station": "B2", "height": 10.5}])
+        self.assertEqual(r.get("B", by="serial", field="height"), 10.5)
+
+    def test_merged(self):
+        packaged = self.dump("packaged_dict.json", {"a": 1, "b": 2})
+        custom = self.dump("custom_dict.json", {"b": 3})
+        os.environ[ENV_KEY] = custom
+        self.assertEqual(LayeredJsonRegistry(packaged, ENV_KEY).merged(), {"b": 3})
+        self.assertEqual(LayeredJsonRegistry(packaged, ENV_KEY, layered=True).merged(), {"a": 1, "b": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
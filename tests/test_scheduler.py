@@ -0,0 +1,68 @@
+from .stations import loaded_station
+import tempfile
+import unittest
+
+
+class TestPauseScheduler(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.station = loaded_station(self._folder.name, tip_track=False, pause_coalesce_threshold=0.5)
+        self.station.setup_tip_log()
+        self.scheduler = self.station._pause_scheduler
+        self.allocator = self.station._tip_allocator
+        # Five racks of twelve columns each
+        self.tiprack = "_tips300"
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def take(self, n: int):
+        for _ in range(n):
+            self.allocator.take(self.tiprack)
+
+    def test_nothing_due(self):
+        self.assertEqual(self.scheduler.due(), [])
+        self.assertEqual(self.scheduler.request("pause"), "")
+        self.assertEqual(self.scheduler.log, [])
+
+    def test_coalesce_into_pause(self):
+        self.station._drop_count = self.station._drop_threshold // 2
+        self.take(30)
+        msg = self.scheduler.request("pause")
+        self.assertEqual([(e["kind"], e["into"]) for e in self.scheduler.log], [("empty tips", "pause"), ("refill tips", "pause")])
+        self.assertIn(self.station.get_msg("empty tips"), msg)
+        # The empty racks and the one in use
+        self.assertEqual(self.scheduler.log[1]["racks"], [0, 1, 2])
+        self.assertEqual(self.scheduler.confirm(), 2)
+        self.assertTrue(all(e["done"] for e in self.scheduler.log))
+        self.assertEqual(self.station._drop_count, 0)
+        self.assertEqual(self.allocator.depleted[self.tiprack], set())
+        self.assertEqual(self.allocator.remaining(self.tiprack), self.allocator.max[self.tiprack])
+
+    def test_swap_empty_racks_only(self):
+        self.take(12)
+        due = self.scheduler.due()
+        self.assertEqual([(i.kind, i.racks) for i in due], [("swap tiprack", (0,))])
+        self.scheduler.request("delay")
+        self.scheduler.confirm()
+        # The rack in use keeps its position
+        self.assertEqual(self.allocator.depleted[self.tiprack], set())
+        self.assertEqual(self.allocator.count[self.tiprack], 12)
+
+    def test_discard(self):
+        self.take(12)
+        self.scheduler.request("delay")
+        self.scheduler.discard()
+        self.assertEqual(self.scheduler.confirm(), 0)
+        self.assertFalse(self.scheduler.log[0]["done"])
+        self.assertEqual(len(self.scheduler.due()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
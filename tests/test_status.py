@@ -0,0 +1,112 @@
+from covmatic_stations.status import StatusBlock, StatusSnapshot
+from .stations import loaded_station
+from threading import Thread
+import json
+import struct
+import tempfile
+import time
+import unittest
+
+
+def snapshot(version: int, **data) -> StatusSnapshot:
+    data["version"] = version
+    return StatusSnapshot(version=version, time=time.time(), data=data, body=json.dumps(data), etag="\"run-{}\"".format(version))
+
+
+class TestStatusBlock(unittest.TestCase):
+    def setUp(self):
+        self.block = StatusBlock.create(4096)
+        self.reader = StatusBlock(self.block.filepath)
+
+    def tearDown(self):
+        self.reader.close()
+        self.block.close(unlink=True)
+
+    def test_empty(self):
+        self.assertIsNone(self.reader.read())
+
+    def test_round_trip(self):
+        self.block.write(snapshot(3, msg="hello"), StatusBlock.WAITING_FIRST_LOG)
+        s = self.reader.read()
+        self.assertEqual((s.version, s.etag, s.data["msg"]), (3, "\"run-3\"", "hello"))
+        self.assertEqual(self.reader.flags, StatusBlock.WAITING_FIRST_LOG)
+        # Unchanged blocks are not parsed again
+        self.assertIs(self.reader.read(), s)
+        self.block.write(snapshot(4, msg="world"))
+        self.assertEqual(self.reader.read().data["msg"], "world")
+        self.assertEqual(self.reader.flags, 0)
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            self.block.write(snapshot(1, msg="x" * 4096))
+
+    def test_waits_for_write_in_progress(self):
+        self.block.write(snapshot(1))
+        # An odd sequence number marks a write in progress
+        struct.pack_into("<Q", self.block._mm, 0, self.block._seq + 1)
+        result = []
+        t = Thread(target=lambda: result.append(self.reader.read()), daemon=True)
+        t.start()
+        time.sleep(0.1)
+        self.assertTrue(t.is_alive())
+        self.block.write(snapshot(2))
+        t.join(5)
+        self.assertEqual(result[0].version, 2)
+
+    def test_concurrent_reads_are_consistent(self):
+        def write():
+            for v in range(1, 2001):
+                self.block.write(snapshot(v, msg=str(v) * (v % 50)))
+        t = Thread(target=write, daemon=True)
+        t.start()
+        while t.is_alive():
+            s = self.reader.read()
+            if s is not None:
+                self.assertEqual(json.loads(s.body)["version"], s.version)
+                self.assertEqual(s.etag, "\"run-{}\"".format(s.version))
+        t.join()
+        self.assertEqual(self.reader.read().version, 2000)
+
+
+class TestStatusPublisher(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.station = loaded_station(self._folder.name, tip_track=False)
+        self.station.setup_tip_log()
+        self.publisher = self.station._status_publisher
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def test_lazy_snapshot(self):
+        first = self.publisher.current
+        self.publisher.publish(force=True)
+        self.station._msg = "changed"
+        self.publisher.publish(force=True)
+        # Only the latest version is built, when it is read
+        s = self.publisher.current
+        self.assertEqual(s.version, first.version + 2)
+        self.assertEqual(s.data["msg"], "changed")
+        self.assertNotIn("\n", s.body)
+        self.assertIs(self.publisher.current, s)
+
+    def test_disabled(self):
+        version = self.publisher.current.version
+        self.assertIsNone(self.publisher.publish())
+        self.assertEqual(self.publisher.current.version, version)
+
+    def test_wait(self):
+        version = self.publisher.current.version
+        Thread(target=lambda: (time.sleep(0.1), self.publisher.publish(force=True)), daemon=True).start()
+        self.assertEqual(self.publisher.wait(version, 5).version, version + 1)
+        self.assertEqual(self.publisher.wait(version + 1, 0.05).version, version + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
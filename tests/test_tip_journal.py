@@ -0,0 +1,86 @@
+from .stations import loaded_station
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestTipJournal(unittest.TestCase):
+    tiprack = "_tips300"
+
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self.folder = self._folder.name
+        self.tip_log = os.path.join(self.folder, "tip_log.json")
+        self.journal = self.tip_log + ".journal"
+        self.stations = []
+
+    def tearDown(self):
+        for s in self.stations:
+            if s._tip_journal is not None:
+                s._tip_journal.close()
+        self._folder.cleanup()
+
+    def station(self, **kwargs):
+        station = loaded_station(self.folder, tip_track=True, **kwargs)
+        station.setup_tip_log()
+        self.stations.append(station)
+        return station
+
+    def pick(self, station, n: int):
+        for _ in range(n):
+            station._tip_allocator.take(self.tiprack)
+            station.track_tip(self.tiprack)
+
+    def journal_lines(self) -> list:
+        with open(self.journal) as f:
+            return [json.loads(line) for line in f]
+
+    def test_append(self):
+        s = self.station()
+        self.pick(s, 3)
+        self.assertFalse(os.path.exists(self.tip_log))
+        self.assertEqual(self.journal_lines(), [{self.tiprack: 1}, {self.tiprack: 2}, {self.tiprack: 3}])
+
+    def test_replay_and_compact(self):
+        self.pick(self.station(), 14)
+        s = self.station()
+        self.assertEqual(s._tip_allocator.count[self.tiprack], 14)
+        # The replayed journal is compacted into the tip log
+        self.assertFalse(os.path.exists(self.journal))
+        with open(self.tip_log) as f:
+            log = json.load(f)
+        self.assertEqual(log["count"], {self.tiprack: 14})
+        self.assertEqual(log["depleted"], {self.tiprack: [0]})
+
+    def test_torn_tail(self):
+        self.pick(self.station(), 2)
+        with open(self.journal, "a") as f:
+            # Record cut by a power loss
+            f.write(json.dumps({self.tiprack: 9})[:-1])
+        self.assertEqual(self.station()._tip_allocator.count[self.tiprack], 2)
+
+    def test_compact_every(self):
+        s = self.station(tip_log_compact_every=4)
+        self.pick(s, 5)
+        s.run_stage("a")
+        self.assertFalse(os.path.exists(self.journal))
+        with open(self.tip_log) as f:
+            self.assertEqual(json.load(f)["count"], {self.tiprack: 5})
+
+    def test_no_journal(self):
+        s = self.station(tip_log_journal=False)
+        self.pick(s, 2)
+        self.assertFalse(os.path.exists(self.journal))
+        with open(self.tip_log) as f:
+            self.assertEqual(json.load(f)["count"], {self.tiprack: 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
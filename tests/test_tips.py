@@ -0,0 +1,73 @@
+from covmatic_stations.tips import TipAllocator
+import unittest
+
+
+class TestTipAllocator(unittest.TestCase):
+    def setUp(self):
+        self.emptied = []
+        self.allocator = TipAllocator(on_depleted=lambda tiprack, rack: self.emptied.append((tiprack, rack)))
+        # Two racks of four tips each
+        self.allocator.add("tips", ["A{}".format(i) for i in range(8)], racks=2)
+
+    def take(self, n: int) -> list:
+        return [self.allocator.take("tips") for _ in range(n)]
+
+    def test_take_in_order(self):
+        self.assertEqual(self.take(3), ["A0", "A1", "A2"])
+        self.assertEqual(self.allocator.remaining("tips"), 5)
+        self.assertEqual(self.allocator.current("tips"), 0)
+
+    def test_depletion(self):
+        self.take(4)
+        self.assertEqual(self.emptied, [("tips", 0)])
+        self.assertEqual(self.allocator.depleted["tips"], {0})
+        self.assertEqual(self.allocator.current("tips"), 1)
+        self.take(4)
+        self.assertEqual(self.emptied, [("tips", 0), ("tips", 1)])
+        self.assertTrue(self.allocator.is_empty("tips"))
+        self.assertEqual(self.allocator.remaining("tips"), 0)
+        self.assertIsNone(self.allocator.current("tips"))
+
+    def test_start_tip(self):
+        allocator = TipAllocator()
+        allocator.add("tips", ["A{}".format(i) for i in range(8)], start="A5", racks=2)
+        self.assertEqual(allocator.depleted["tips"], {0})
+        self.assertEqual(allocator.next("tips"), "A5")
+        with self.assertRaises(ValueError):
+            allocator.add("tips", ["A{}".format(i) for i in range(8)], start="B1", racks=2)
+
+    def test_swap_empty_rack(self):
+        self.take(4)
+        self.assertTrue(self.allocator.refill("tips", 0))
+        self.assertFalse(self.allocator.refill("tips", 1))
+        # Tips are still drawn from the rack in use, then from the refilled one
+        self.take(4)
+        self.assertEqual(self.take(1), ["A0"])
+
+    def test_swap_cycles_to_refilled_rack(self):
+        self.take(8)
+        self.allocator.refill("tips", 0)
+        self.assertFalse(self.allocator.is_empty("tips"))
+        self.assertEqual(self.take(1), ["A0"])
+
+    def test_replace_rack_in_use(self):
+        self.take(6)
+        self.allocator.replace("tips", 1)
+        self.assertEqual(self.allocator.remaining("tips"), 4)
+        self.assertEqual(self.take(1), ["A4"])
+
+    def test_reset(self):
+        self.take(5)
+        self.allocator.reset("tips")
+        self.assertEqual(self.allocator.depleted["tips"], set())
+        self.assertEqual(self.take(1), ["A0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+# Copyright (c) 2020 Covmatic.
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.